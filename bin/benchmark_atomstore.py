@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Compare memory and access time of the packed AtomStore against per-atom objects with a __dict__,
+the way atoms were stored before. Both are copies of the same loaded structure.
+Run in a folder with run.prm and step2_out.pdb.
+"""
+
+import time
+import tracemalloc
+import argparse
+from pdbio import *
+
+
+class DictAtom:
+    def __init__(self, atom):
+        self.serial = atom.serial
+        self.name = atom.name
+        self.altLoc = atom.altLoc
+        self.resName = atom.resName
+        self.chainID = atom.chainID
+        self.resSeq = atom.resSeq
+        self.iCode = atom.iCode
+        self.xyz = atom.xyz
+        self.confNum = atom.confNum
+        self.atomID = atom.atomID
+        self.confID = atom.confID
+        self.confType = atom.confType
+        self.resID = atom.resID
+        self.r_bound = atom.r_bound
+        self.charge = atom.charge
+        self.r_vdw = atom.r_vdw
+        self.e_vdw = atom.e_vdw
+        self.connectivity_param = atom.connectivity_param
+        self.connect12 = []
+        self.connect13 = []
+        self.connect14 = []
+        self.history = atom.history
+
+
+class DictBlob:
+    def __init__(self, blob):
+        self.center = blob.center
+        self.radius = blob.radius
+
+
+class DictConformer:
+    def __init__(self, conf):
+        self.confID = conf.confID
+        self.resID = conf.resID
+        self.atom = [DictAtom(atom) for atom in conf.atom]
+        self.history = conf.history
+        self.blob = DictBlob(conf.blob)
+
+
+def packed_copy(protein):
+    """Copy the structure into slotted Atom/Conformer objects backed by a new AtomStore."""
+    copy = Protein()
+    for res in protein.residue:
+        new_res = Residue()
+        new_res.resID = res.resID
+        for conf in res.conf:
+            new_conf = Conformer()
+            new_conf.confID = conf.confID
+            new_conf.resID = conf.resID
+            new_conf.history = conf.history
+            for atom in conf.atom:
+                new_atom = Atom()
+                for name in ("serial", "name", "altLoc", "resName", "chainID", "resSeq", "iCode", "xyz", "confNum",
+                             "atomID", "confID", "confType", "resID", "r_bound", "charge", "r_vdw", "e_vdw",
+                             "connectivity_param", "history"):
+                    setattr(new_atom, name, getattr(atom, name))
+                new_conf.atom.append(new_atom)
+            new_res.conf.append(new_conf)
+        copy.residue.append(new_res)
+    copy.index_atoms()
+    return copy
+
+
+def measure(build):
+    tracemalloc.start()
+    current_time = time.time()
+    result = build()
+    elapsed = time.time() - current_time
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def xyz_sum(atoms):
+    x = 0.0
+    for atom in atoms:
+        x += atom.xyz[0] + atom.r_vdw + atom.charge
+    return x
+
+
+if __name__ == "__main__":
+    helpmsg = "Compare memory and access time of packed atom arrays with per-atom dictionaries."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("-f", metavar="pdb", default="step2_out.pdb", help="Structure file, default step2_out.pdb")
+    args = parser.parse_args()
+
+    env.load_runprm()
+    env.load_ftpl()
+
+    loaded = Protein()
+    loaded.loadpdb(args.f)
+    confs = [conf for res in loaded.residue for conf in res.conf]
+
+    protein, packed_size, packed_time = measure(lambda: packed_copy(loaded))
+    dict_confs, dict_size, dict_time = measure(lambda: [DictConformer(conf) for conf in confs])
+    n_atom = len(protein.atoms)
+
+    print("%d atoms in %d conformers" % (n_atom, len(confs)))
+    print("%-24s %12s %12s %12s" % ("", "bytes", "bytes/atom", "seconds"))
+    print("%-24s %12d %12.1f %12.3f" % ("__slots__ + AtomStore", packed_size, packed_size / n_atom, packed_time))
+    print("%-24s %12d %12.1f" % ("  of which arrays", protein.store.nbytes(), protein.store.nbytes() / n_atom))
+    print("%-24s %12d %12.1f %12.3f" % ("__dict__ objects", dict_size, dict_size / n_atom, dict_time))
+
+    dict_atoms = [atom for conf in dict_confs for atom in conf.atom]
+    current_time = time.time()
+    xyz_sum(protein.atoms)
+    print("Attribute scan, AtomStore: %.3f seconds" % (time.time() - current_time))
+    current_time = time.time()
+    xyz_sum(dict_atoms)
+    print("Attribute scan, __dict__:  %.3f seconds" % (time.time() - current_time))
+    current_time = time.time()
+    (protein.store.xyz[:, 0] + protein.store.r_vdw + protein.store.charge).sum()
+    print("Array scan, AtomStore:     %.3f seconds" % (time.time() - current_time))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Compare the microstate grouping and reduction functions of ms_analysis.py on Microstate objects with their array
+versions on a MicrostateStore, and check that they give the same results.
+Run in a folder with head3.lst, on a text or binary microstate file such as ms_out/pH7eH0ms.txt.
+"""
+
+import time
+import argparse
+import ms_analysis as msa
+
+
+def states(groups):
+    return [[(ms.state, ms.E, ms.count) for ms in group] for group in groups]
+
+
+def same_groups(objects, arrays):
+    return states(objects) == states([list(group.microstates()) for group in arrays])
+
+
+def same_values(objects, arrays):
+    if isinstance(objects, dict):
+        return sorted(objects) == sorted(arrays) and all(abs(objects[k] - arrays[k]) < 1e-9 for k in objects)
+    if isinstance(objects, (list, tuple)):
+        return len(objects) == len(arrays) and all(abs(x - y) < 1e-9 for x, y in zip(objects, arrays))
+    return abs(objects - arrays) < 1e-9
+
+
+def timed(function, *args):
+    current_time = time.time()
+    result = function(*args)
+    return result, time.time() - current_time
+
+
+if __name__ == "__main__":
+    helpmsg = "Time microstate grouping and reduction functions on objects and on arrays."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("ms_file", help="text or binary microstate file")
+    parser.add_argument("-c", metavar="confid", default=[], nargs="+",
+                        help="confid substrings for groupms_byconfid, default to the first charged conformer")
+    args = parser.parse_args()
+
+    msout, seconds = timed(msa.MSout, args.ms_file)
+    print("%d microstates, %d unique, loaded in %.2f seconds" % (msout.N_ms, msout.N_uniq, seconds))
+    microstates = list(msout.microstates.values())
+    store = msout.store
+
+    charged = [ic for ic, conf in enumerate(msa.conformers) if abs(conf.crg) > 0.001]
+    confids = args.c or [msa.conformers[charged[0]].confid[:10]]
+    iconfs = charged[:4]
+    step = (msout.highest_E - msout.lowest_E) / 20
+    ticks = [msout.lowest_E + step * (i + 1) for i in range(19)]
+
+    tests = [("ms_counts", msa.ms_counts, (microstates,), msa.ms_counts_store, (store,), same_values),
+             ("groupms_byenergy", msa.groupms_byenergy, (microstates, list(ticks)),
+              msa.groupms_byenergy_store, (store, ticks), same_groups),
+             ("groupms_byiconf", msa.groupms_byiconf, (microstates, iconfs),
+              msa.groupms_byiconf_store, (store, iconfs), same_groups),
+             ("groupms_byconfid", msa.groupms_byconfid, (microstates, confids),
+              msa.groupms_byconfid_store, (store, confids), same_groups),
+             ("ms_energy_stat", msa.ms_energy_stat, (microstates,), msa.ms_energy_stat_store, (store,), same_values),
+             ("ms_convert2occ", msa.ms_convert2occ, (microstates,), msa.ms_convert2occ_store, (store,), same_values),
+             ("ms_convert2sumcrg", msa.ms_convert2sumcrg, (microstates, msout.free_residues),
+              msa.ms_convert2sumcrg_store, (store, msout.free_residues), same_values)]
+
+    print("%-20s %10s %10s %8s %6s" % ("function", "objects", "arrays", "speedup", "match"))
+    for name, objects_function, objects_args, arrays_function, arrays_args, same in tests:
+        objects, objects_time = timed(objects_function, *objects_args)
+        arrays, arrays_time = timed(arrays_function, *arrays_args)
+        print("%-20s %10.3f %10.3f %8.1f %6s" % (name, objects_time, arrays_time,
+                                                 objects_time / max(arrays_time, 1e-6), same(objects, arrays)))
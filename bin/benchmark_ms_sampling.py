@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Time weighted microstate sampling of MSout.sample_ms_indices, a binary search in the cumulative counts, against the
+former per-sample scan np.where((cumsum - c) > 0)[0][0] of get_sampled_ms, and check that both pick the same rows.
+The scan is timed on fewer samples and extrapolated. Run on a text or binary microstate file.
+"""
+
+import time
+import argparse
+import numpy as np
+from ms_analysis import MSout
+
+
+if __name__ == "__main__":
+    helpmsg = "Time binary search sampling of microstates against the former linear scan."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("ms_file", help="text or binary microstate file")
+    parser.add_argument("-n", metavar="samples", default=100000, type=int, help="sample size, default 100000")
+    parser.add_argument("-m", metavar="samples", default=1000, type=int,
+                        help="sample size of the linear scan, default 1000")
+    parser.add_argument("-seed", metavar="seed", default=0, type=int, help="random seed, default 0")
+    args = parser.parse_args()
+
+    msout = MSout(args.ms_file)
+    print("%d microstates, %d unique" % (msout.N_ms, msout.N_uniq))
+    print("%-14s %10s %12s %14s" % ("kind", "samples", "seconds", "us/sample"))
+
+    for kind in ("deterministic", "random", "stratified"):
+        current_time = time.time()
+        rows = msout.sample_ms_indices(args.n, kind, args.seed)
+        elapsed = time.time() - current_time
+        print("%-14s %10d %12.4f %14.3f" % (kind, len(rows), elapsed, elapsed / max(len(rows), 1) * 1e6))
+
+    current_time = time.time()
+    rows = msout.sample_ms_indices(args.n, "random", args.seed, E_range=(msout.lowest_E, msout.average_E))
+    elapsed = time.time() - current_time
+    print("%-14s %10d %12.4f %14.3f" % ("E window", len(rows), elapsed, elapsed / max(len(rows), 1) * 1e6))
+
+    # the former scan, on the first m draws of the same random sample, without the endpoint draw it could not handle
+    sampled_cumsum = np.cumsum(msout.store.count)
+    counts = int(sampled_cumsum[-1])
+    draws = np.random.default_rng(seed=args.seed).integers(low=0, high=counts, size=args.n, endpoint=True)[:args.m]
+    valid = draws < counts
+    current_time = time.time()
+    scanned = np.array([np.where((sampled_cumsum - c) > 0)[0][0] for c in draws[valid]], dtype=np.int64)
+    elapsed = time.time() - current_time
+    per_sample = elapsed / max(len(scanned), 1)
+    print("%-14s %10d %12.4f %14.3f" % ("linear scan", len(scanned), elapsed, per_sample * 1e6))
+    print("Linear scan of %d samples would take %.1f seconds" % (args.n, per_sample * args.n))
+
+    searched = msout.sample_ms_indices(args.n, "random", args.seed)[:args.m][valid]
+    print("Same rows as the linear scan: %s" % bool((scanned == searched).all()))
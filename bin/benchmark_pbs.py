@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Cross-validate the in-process solvers of step3.py (-s fd, gb or coulomb) against stored Delphi results.
+Run in a folder with run.prm, step2_out.pdb and energies/*.raw from a step 3 run with delphi, such as 4lzt/.
+A sample of charged conformers is solved with the chosen solver, and their pairwise single and multi interactions and
+reaction field energies are compared to the stored ones.
+"""
+
+import os
+import time
+import shutil
+import random
+import logging
+import argparse
+import tempfile
+import numpy as np
+import step3
+from step3 import RunOptions, RawTable, is_all_0
+from pdbio import *
+
+
+def stats(name, delphi, solved):
+    diff = solved - delphi
+    if len(diff) > 1:
+        r = np.corrcoef(delphi, solved)[0, 1]
+    else:
+        r = float("nan")
+    print("%-10s %8d %8.3f %8.3f %8.3f %8.3f" % (name, len(diff), r, np.sqrt((diff ** 2).mean()), np.abs(diff).max(),
+                                                 diff.mean()))
+
+
+if __name__ == "__main__":
+    helpmsg = "Compare an in-process solver with stored delphi results in energies/*.raw."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("-n", metavar="conformers", default=10, type=int,
+                        help="number of charged conformers to sample, default 10")
+    parser.add_argument("-seed", metavar="seed", default=0, type=int, help="random seed of the sample, default 0")
+    parser.add_argument("-s", metavar="solver", default="fd", help="fd, gb or coulomb, default fd")
+    parser.add_argument("-d", metavar="epsilon", default="4.0", help="protein dielectric constant, default to 4.0")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.WARNING, datefmt="%D %H:%M:%S")
+
+    env.load_runprm()
+    env.runprm["FTPLDIR"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/param"
+    env.load_ftpl()
+    protein = Protein()
+    protein.loadpdb("step2_out.pdb")
+    protein.update_confcrg()
+    step3.protein = protein
+    step3.run_options = RunOptions(argparse.Namespace(c=[1, 99999], d=args.d, s=args.s, p=1, a=0, t="/tmp", ftpl="",
+                                                      salt=0.15, vdw=False, fly=False, debug=False, refresh=False,
+                                                      incremental=False, resume=False, raw=False, l=""))
+
+    delphi = RawTable(protein)
+    charged = [(ir, ic) for ir in range(len(protein.residue)) for ic in range(1, len(protein.residue[ir].conf))
+               if delphi.done[protein.residue[ir].conf[ic].k] and not is_all_0(protein.residue[ir].conf[ic])]
+    work_load = sorted(random.Random(args.seed).sample(charged, min(args.n, len(charged))))
+
+    folder = tempfile.mkdtemp()
+    step3.energy_folder = folder
+    current_time = time.time()
+    for iric in work_load:
+        step3.pbe(iric)
+    elapsed = time.time() - current_time
+    solved = RawTable(protein, folder)
+    shutil.rmtree(folder)
+
+    # pairs present in either result, 0 if the other has none
+    single = [[], []]
+    multi = [[], []]
+    rxn = [[], []]
+    for ir, ic in work_load:
+        k = protein.residue[ir].conf[ic].k
+        pairs = {}
+        for n, table in enumerate((delphi, solved)):
+            for j in range(table.pw_indptr[k], table.pw_indptr[k + 1]):
+                pairs.setdefault(table.pw_conf[j], [[0.0, 0.0], [0.0, 0.0]])[n] = [table.pw_single[j],
+                                                                                  table.pw_multi[j]]
+            rxn[n].append(table.rxn[k])
+        for value in pairs.values():
+            for n in range(2):
+                single[n].append(value[n][0])
+                multi[n].append(value[n][1])
+
+    print("%d conformers solved in %.1f seconds, %.2f seconds each" % (len(work_load), elapsed,
+                                                                        elapsed / max(len(work_load), 1)))
+    print("%-10s %8s %8s %8s %8s %8s" % ("kcal/mol", "n", "r", "rmsd", "max", "mean"))
+    stats("single", np.array(single[0]), np.array(single[1]))
+    stats("multi", np.array(multi[0]), np.array(multi[1]))
+    stats("rxn", np.array(rxn[0]), np.array(rxn[1]))
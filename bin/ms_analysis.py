@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import json
 import math
+import struct
 import operator
+from collections.abc import Mapping, ValuesView, ItemsView
 from typing import Union
 from pathlib import Path
 import numpy as np
@@ -11,6 +15,10 @@ import zlib
 
 ph2Kcal = 1.364
 Kcal2kT = 1.688
+MS_CHUNK = 1 << 20   # characters read at a time from an ms_out file
+MS_ROWS = 1 << 20    # microstates in a chunk of MicrostateStore.chunks()
+MS_MAGIC = b"MCCEMS01"   # first bytes of a binary microstate file
+MS_ALIGN = 64        # arrays of a binary microstate file start at multiples of this offset
 
 
 class Microstate:
@@ -71,6 +79,344 @@ class Conformer:
         self.crg = float(fields[4])
 
 
+class MicrostateStore:
+    """Unique microstates as arrays: states holds one row per unique microstate and one column per free residue,
+    with the occupied conformer index; E and count are float64 and int64 arrays of the same length.
+    Rows are in the order their microstates first appeared in the MC records."""
+
+    def __init__(self, states: np.ndarray, E: np.ndarray, count: np.ndarray):
+        self.states = states
+        self.E = E
+        self.count = count
+        self.index = None   # row bytes -> row, see find()
+
+    def __len__(self):
+        return len(self.E)
+
+    def find(self, state) -> int:
+        """Row of a state given as a sequence of conformer indices, -1 if not found."""
+        if self.index is None:
+            self.index = {row.tobytes(): i for i, row in enumerate(self.states)}
+        row = np.asarray(state, dtype=self.states.dtype)
+        if row.shape != self.states.shape[1:]:
+            return -1
+        return self.index.get(row.tobytes(), -1)
+
+    def microstate(self, i: int) -> Microstate:
+        return Microstate(self.states[i].tolist(), float(self.E[i]), int(self.count[i]))
+
+    def take(self, rows) -> "MicrostateStore":
+        """A MicrostateStore of the rows selected by an index or boolean array, copied into memory."""
+        return MicrostateStore(np.asarray(self.states[rows]), np.asarray(self.E[rows]), np.asarray(self.count[rows]))
+
+    def slice(self, start: int, end: int) -> "MicrostateStore":
+        return MicrostateStore(self.states[start:end], self.E[start:end], self.count[start:end])
+
+    def chunks(self, rows: int = MS_ROWS):
+        """Yield the store as MicrostateStore slices of up to rows microstates. The slices of a memory-mapped store
+        are views, so a loop over chunks only reads one chunk into memory at a time."""
+        for start in range(0, len(self), rows):
+            yield self.slice(start, start + rows)
+
+    def microstates(self):
+        """Yield a Microstate object of each row, a chunk at a time."""
+        for chunk in self.chunks():
+            for state, E, count in zip(np.asarray(chunk.states).tolist(), chunk.E.tolist(), chunk.count.tolist()):
+                yield Microstate(state, E, count)
+
+
+class MicrostateValues(ValuesView):
+    def __iter__(self):
+        return self._mapping.store.microstates()
+
+
+class MicrostateItems(ItemsView):
+    def __iter__(self):
+        for ms in self._mapping.store.microstates():
+            yield ",".join(["%d" % ic for ic in ms.state]), ms
+
+
+class MicrostateView(Mapping):
+    """Read-only dict-like view of a MicrostateStore, keyed like the former MSout.microstates dict by the
+    comma-joined conformer indices of a state. Microstate objects are created on access, so changing one does not
+    change the store."""
+
+    def __init__(self, store: MicrostateStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        for ms in self.store.microstates():
+            yield ",".join(["%d" % ic for ic in ms.state])
+
+    def __getitem__(self, key: str) -> Microstate:
+        try:
+            state = [int(ic) for ic in key.split(",")]
+        except (AttributeError, ValueError):
+            raise KeyError(key)
+        i = self.store.find(state)
+        if i < 0:
+            raise KeyError(key)
+        return self.store.microstate(i)
+
+    def values(self):
+        return MicrostateValues(self)
+
+    def items(self):
+        return MicrostateItems(self)
+
+
+def read_chunked(fname, chunk: int = MS_CHUNK):
+    """Yield the lines of a text file without line ends, reading chunk characters at a time."""
+    with open(fname) as fh:
+        rest = ""
+        while True:
+            data = fh.read(chunk)
+            if not data:
+                break
+            lines = (rest + data).split("\n")
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+
+def read_msout(fname):
+    """Stream an ms_out file. The first item is the header, a dict of T, pH, Eh, fixed_iconfs and free_residues.
+    The MC records follow as (state_delta, E, count), state_delta being the conformer indices the record flips in.
+    Each MC block starts with its starting state as state_delta, E None and count 0.
+    """
+    lines = read_chunked(fname)
+
+    def next_line():
+        # next line that is not blank or a comment
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0 and line[0] != "#":
+                return line
+        print("This file %s is not a valid microstate file" % fname)
+        sys.exit(-1)
+
+    header = {"T": 273.15, "pH": 7.0, "Eh": 0.0}
+    for field in next_line().split(","):
+        key, value = field.split(":")
+        key = key.strip().upper()
+        value = float(value)
+        if key == "T":
+            header["T"] = value
+        elif key == "PH":
+            header["pH"] = value
+        elif key == "EH":
+            header["Eh"] = value
+
+    # second line, confirm this is from Monte Carlo sampleing
+    key, value = next_line().split(":")
+    if key.strip() != "METHOD" or value.strip() != "MONTERUNS":
+        print("This file %s is not a valid microstate file" % fname)
+        sys.exit(-1)
+
+    # Third line, fixed conformer indicies
+    _, iconfs = next_line().split(":")
+    header["fixed_iconfs"] = [int(i) for i in iconfs.split()]
+
+    # 4th line, free residues
+    _, residues_str = next_line().split(":")
+    header["free_residues"] = [[int(i) for i in f.split()] for f in residues_str.split(";") if f.strip()]
+    yield header
+
+    found_mc = False
+    newmc = False
+    for line in lines:
+        if line.startswith("MC:"):   # ms starts
+            found_mc = True
+            newmc = True
+        elif newmc:
+            _, f2 = line.split(":")
+            yield [int(c) for c in f2.split()], None, 0
+            newmc = False
+        elif found_mc:
+            fields = line.split(",")
+            if len(fields) >= 3:
+                yield [int(c) for c in fields[2].split()], float(fields[0]), int(fields[1])
+
+
+def scan_msout(fname, *kinds):
+    """Feed the records of an ms_out file to one accumulator of each kind, such as UniqueStates, EnergyStats and
+    Occupancy. Return the header and the accumulators."""
+    records = read_msout(fname)
+    header = next(records)
+    accumulators = [kind(header["free_residues"]) for kind in kinds]
+    adds = [acc.add for acc in accumulators]
+    for record in records:
+        for add in adds:
+            add(*record)
+    return header, accumulators
+
+
+class UniqueStates:
+    """Accumulate the unique states of read_msout() records, deduplicated by the bytes of the packed state row.
+    The E of a unique state is the E of its first record."""
+
+    def __init__(self, free_residues: list):
+        self.iconf2ires = {iconf: ires for ires, res in enumerate(free_residues) for iconf in res}
+        self.n_free = len(free_residues)
+        if max(self.iconf2ires, default=0) < 2 ** 15:
+            self.dtype, code = np.int16, "h"
+        else:
+            self.dtype, code = np.int32, "i"
+        self.pack = struct.Struct("<%d%s" % (self.n_free, code)).pack
+        self.state = [0] * self.n_free
+        self.index = {}
+        self.rows = bytearray()
+        self.energies = []
+        self.counts = []
+
+    def add(self, state_delta: list, E: float, count: int):
+        state = self.state
+        for ic in state_delta:
+            state[self.iconf2ires[ic]] = ic
+        if E is None:
+            return
+        key = self.pack(*state)
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.energies)
+            self.rows += key
+            self.energies.append(E)
+            self.counts.append(count)
+        else:
+            self.counts[i] += count
+
+    def store(self) -> MicrostateStore:
+        states = np.frombuffer(bytes(self.rows), dtype=np.dtype(self.dtype).newbyteorder("<")).astype(self.dtype)
+        return MicrostateStore(states.reshape(len(self.energies), self.n_free),
+                               np.array(self.energies, dtype=np.float64), np.array(self.counts, dtype=np.int64))
+
+
+class EnergyStats:
+    """Count weighted lowest, average and highest E of read_msout() records."""
+
+    def __init__(self, free_residues: list = None):
+        self.N_ms = 0
+        self.lowest_E = math.inf
+        self.highest_E = -math.inf
+        self.E_sum = 0.0
+
+    def add(self, state_delta: list, E: float, count: int):
+        if E is None:
+            return
+        self.N_ms += count
+        self.E_sum += E * count
+        if self.lowest_E > E:
+            self.lowest_E = E
+        if self.highest_E < E:
+            self.highest_E = E
+
+    @property
+    def average_E(self) -> float:
+        return self.E_sum / self.N_ms
+
+
+class Occupancy:
+    """Conformer occupancy over read_msout() records, in constant memory.
+    A conformer is credited with the counts since it was flipped in when it is flipped out, so a record only costs as
+    much as its flips."""
+
+    def __init__(self, free_residues: list):
+        self.iconf2ires = {iconf: ires for ires, res in enumerate(free_residues) for iconf in res}
+        self.state = [-1] * len(free_residues)
+        self.since = [0] * len(free_residues)
+        self.counts = [0] * (max(self.iconf2ires, default=0) + 1)
+        self.N_ms = 0
+
+    def add(self, state_delta: list, E: float, count: int):
+        state = self.state
+        for ic in state_delta:
+            ir = self.iconf2ires[ic]
+            old = state[ir]
+            if old != ic:
+                if old >= 0:
+                    self.counts[old] += self.N_ms - self.since[ir]
+                state[ir] = ic
+                self.since[ir] = self.N_ms
+        self.N_ms += count
+
+    def occ(self) -> dict:
+        """Occupancy of conformers that appeared at least once, like ms_convert2occ()."""
+        counts = list(self.counts)
+        for ir, ic in enumerate(self.state):
+            if ic >= 0:
+                counts[ic] += self.N_ms - self.since[ir]
+        return {ic: counts[ic] / self.N_ms for ic in range(len(counts)) if counts[ic] > 0}
+
+
+def msbin_offsets(header_size: int, n_uniq: int, n_free: int, dtype: str) -> tuple:
+    """Offsets of the states, E and count arrays in a binary microstate file."""
+    def align(offset):
+        return -(-offset // MS_ALIGN) * MS_ALIGN
+
+    states_at = align(len(MS_MAGIC) + 8 + header_size)
+    E_at = align(states_at + n_uniq * n_free * np.dtype(dtype).itemsize)
+    count_at = align(E_at + n_uniq * 8)
+    return states_at, E_at, count_at
+
+
+def is_msbin(fname) -> bool:
+    with open(fname, "rb") as fh:
+        return fh.read(len(MS_MAGIC)) == MS_MAGIC
+
+
+def write_msbin(fname, header: dict, store: MicrostateStore):
+    """Write a binary microstate file: MS_MAGIC, the size of a JSON header as a little endian uint64 and the header,
+    then the states, E and count arrays of store, little endian, each at a multiple of MS_ALIGN.
+    The header holds T, pH, Eh, fixed_iconfs, free_residues and the E statistics of MSout, and the array shapes."""
+    dtype = np.dtype(store.states.dtype).newbyteorder("<").str
+    header = dict(header, N_uniq=len(store), n_free=len(header["free_residues"]), dtype=dtype)
+    text = json.dumps(header).encode()
+    offsets = msbin_offsets(len(text), header["N_uniq"], header["n_free"], dtype)
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as fh:
+        fh.write(MS_MAGIC + np.array(len(text), dtype="<u8").tobytes() + text)
+        for offset, array, array_dtype in zip(offsets, (store.states, store.E, store.count), (dtype, "<f8", "<i8")):
+            fh.seek(offset)
+            for start in range(0, len(array), MS_ROWS):
+                fh.write(np.ascontiguousarray(array[start:start + MS_ROWS], dtype=array_dtype).tobytes())
+        fh.truncate(offsets[2] + header["N_uniq"] * 8)
+    os.replace(tmp_fname, fname)
+
+
+def read_msbin(fname) -> tuple:
+    """Header and memory-mapped MicrostateStore of a binary microstate file."""
+    with open(fname, "rb") as fh:
+        if fh.read(len(MS_MAGIC)) != MS_MAGIC:
+            raise ValueError("%s is not a binary microstate file" % fname)
+        size = int(np.frombuffer(fh.read(8), dtype="<u8")[0])
+        header = json.loads(fh.read(size))
+
+    n_uniq = header["N_uniq"]
+    n_free = header["n_free"]
+    states_at, E_at, count_at = msbin_offsets(size, n_uniq, n_free, header["dtype"])
+    if n_uniq == 0:
+        return header, MicrostateStore(np.zeros((0, n_free), dtype=header["dtype"]), np.zeros(0),
+                                       np.zeros(0, dtype=np.int64))
+    if n_free:
+        states = np.memmap(fname, dtype=header["dtype"], mode="r", offset=states_at, shape=(n_uniq, n_free))
+    else:
+        states = np.zeros((n_uniq, 0), dtype=header["dtype"])
+    E = np.memmap(fname, dtype="<f8", mode="r", offset=E_at, shape=(n_uniq,))
+    count = np.memmap(fname, dtype="<i8", mode="r", offset=count_at, shape=(n_uniq,))
+    return header, MicrostateStore(states, E, count)
+
+
+def convert_msout(fname, bin_fname):
+    """Convert a text ms_out file to a binary microstate file, which MSout opens by memory mapping."""
+    msout = MSout(fname)
+    write_msbin(bin_fname, msout.header(), msout.store)
+    return msout
+
+
 class MSout:
     def __init__(self, fname):
         self.T = 273.15
@@ -87,117 +433,58 @@ class MSout:
         self.fixed_nh = 0.0
         self.free_residues = []   # free residues, referred by conformer indices
         self.iconf2ires = {}      # from conformer index to free residue index
-        self.microstates = {}     # dict of Microstate objects
+        self.store = MicrostateStore(np.zeros((0, 0), dtype=np.int16), np.zeros(0), np.zeros(0, dtype=np.int64))
+        self.microstates = MicrostateView(self.store)     # dict-like view of Microstate objects
         self.conformers = []
 
         self.load_msout(fname)
 
     def load_msout(self, fname):
-        lines = open(fname).readlines()
-        #print(f"MSout.load_msout :: {len(lines) = :,}")
-
-        # Get a valid line
-        while True:
-            line = lines.pop(0).strip()
-            if len(line) > 0 and line[0] != "#":
-                break
-
-        fields = line.split(",")
-        for field in fields:
-            key, value = field.split(":")
-            key = key.strip().upper()
-            value = float(value)
-            if key == "T":
-                self.T = value
-            elif key == "PH":
-                self.pH = value
-            elif key == "EH":
-                self.Eh = value
-
-        # second line, confirm this is from Monte Carlo sampleing
-        while True:
-            line = lines.pop(0).strip()
-            if len(line) > 0 and line[0] != "#":
-                break
-
-        key, value = line.split(":")
-        if key.strip() != "METHOD" or value.strip() != "MONTERUNS":
-            print("This file %s is not a valid microstate file" % fname)
-            sys.exit(-1)
-
-        # Third line, fixed conformer indicies
-        while True:
-            line = lines.pop(0).strip()
-            if len(line) > 0 and line[0] != "#":
-                break
-
-        _, iconfs = line.split(":")
-        self.fixed_iconfs = [int(i) for i in iconfs.split()]
-
-        # 4th line, free residues
-        while True:
-            line = lines.pop(0).strip()
-            if len(line) > 0 and line[0] != "#":
-                break
-
-        _, residues_str = line.split(":")
-        residues = residues_str.split(";")
-        self.free_residues = []
-        for f in residues:
-            if f.strip():
-                self.free_residues.append([int(i) for i in f.split()])
-        for i_res in range(len(self.free_residues)):
-            for iconf in self.free_residues[i_res]:
-                self.iconf2ires[iconf] = i_res
-
-        # find the next MC record
-        found_mc = False
-        newmc = False
-        self.N_ms = 0
-
-        for line in lines:
-            if line.find("MC:") == 0:   # ms starts
-                found_mc = True
-                newmc = True
-                continue
-            elif newmc:
-                f1, f2 = line.split(":")
-                current_state = [int(c) for c in f2.split()]
-                newmc = False
-                continue
-            elif found_mc:
-                fields = line.split(",")
-                if len(fields) >= 3:
-                    state_e = float(fields[0])
-                    count = int(fields[1])
-                    flipped = [int(c) for c in fields[2].split()]
-
-                    for ic in flipped:
-                        ir = self.iconf2ires[ic]
-                        current_state[ir] = ic
-
-                    ms = Microstate(list(current_state), state_e, count)
-                    key = ",".join(["%d" % i for i in ms.state])
-                    if key in self.microstates:
-                        self.microstates[key].count += ms.count
-                    else:
-                        self.microstates[key] = ms
+        if is_msbin(fname):
+            self.load_msbin(fname)
+            return
+
+        header, (unique,) = scan_msout(fname, UniqueStates)
+        self.T = header["T"]
+        self.pH = header["pH"]
+        self.Eh = header["Eh"]
+        self.fixed_iconfs = header["fixed_iconfs"]
+        self.free_residues = header["free_residues"]
+        self.iconf2ires = unique.iconf2ires
+        self.store = unique.store()
+        self.microstates = MicrostateView(self.store)
 
         # find N_ms, lowest, highest, averge E
-        self.N_ms = 0
-        E_sum = 0.0
-        self.lowest_E = next(iter(self.microstates.values())).E
-        self.highest_E = next(iter(self.microstates.values())).E
-        msvalues = self.microstates.values()
-        self.N_uniq = len(msvalues)
-        for ms in msvalues:
-            self.N_ms += ms.count
-            E_sum += ms.E * ms.count
-            if self.lowest_E > ms.E:
-                self.lowest_E = ms.E
-            if self.highest_E < ms.E:
-                self.highest_E = ms.E
-        self.average_E = E_sum / self.N_ms
+        if len(self.store) == 0:
+            raise ValueError("%s has no microstates" % fname)
+        self.N_uniq = len(self.store)
+        self.N_ms = int(self.store.count.sum())
+        self.lowest_E = float(self.store.E.min())
+        self.highest_E = float(self.store.E.max())
+        self.average_E = float((self.store.E * self.store.count).sum() / self.N_ms)
+
+    def load_msbin(self, fname):
+        """Open a binary microstate file of convert_msout(). The arrays are memory-mapped, the E statistics come from
+        the header, so nothing is read until it is used."""
+        header, self.store = read_msbin(fname)
+        self.T = header["T"]
+        self.pH = header["pH"]
+        self.Eh = header["Eh"]
+        self.fixed_iconfs = header["fixed_iconfs"]
+        self.free_residues = header["free_residues"]
+        self.iconf2ires = {iconf: ires for ires, res in enumerate(self.free_residues) for iconf in res}
+        self.microstates = MicrostateView(self.store)
+        self.N_uniq = header["N_uniq"]
+        self.N_ms = header["N_ms"]
+        self.lowest_E = header["lowest_E"]
+        self.highest_E = header["highest_E"]
+        self.average_E = header["average_E"]
+
+    def header(self) -> dict:
+        """Run conditions, residues and E statistics, as kept in a binary microstate file."""
+        return {"T": self.T, "pH": self.pH, "Eh": self.Eh, "fixed_iconfs": self.fixed_iconfs,
+                "free_residues": self.free_residues, "N_ms": self.N_ms, "lowest_E": self.lowest_E,
+                "highest_E": self.highest_E, "average_E": self.average_E}
 
     def get_sampled_ms(
         self,
@@ -209,9 +496,9 @@ class MSout:
         Implement a sampling of MSout.microstates depending on `kind`.
         Args:
             size (int): sample size
-            kind (str, 'deterministic'): Sampling kind: one of ['deterministic', 'random'].
+            kind (str, 'deterministic'): Sampling kind: one of ['deterministic', 'random', 'stratified'].
                  If 'deterministic', the microstates in ms_list are sampled at regular intervals
-                 otherwise, the sampling is random. Case insensitive.
+                 otherwise, the sampling is random, see sample_ms_indices. Case insensitive.
             seed (int, None): For testing purposes, fixes random sampling.
         Returns:
             A list of lists: [[selection index, selected microstate], ...]
@@ -221,32 +508,65 @@ class MSout:
             print("The microstates dict is empty.")
             return []
 
+        return [[i, self.store.microstate(i)] for i in self.sample_ms_indices(size, kind, seed).tolist()]
+
+    def sample_ms_indices(
+        self,
+        size: int,
+        kind: str = "deterministic",
+        seed: Union[None, int] = None,
+        E_range: Union[None, tuple] = None,
+    ) -> np.ndarray:
+        """
+        Batch version of get_sampled_ms: sample microstates weighted by their counts and return their rows in
+        MSout.store, found by binary search in the cumulative counts.
+        Args:
+            size (int): sample size
+            kind (str, 'deterministic'): Sampling kind: one of ['deterministic', 'random', 'stratified'].
+                 'deterministic' samples at regular intervals of the cumulative counts, 'random' samples uniformly,
+                 'stratified' samples once at random in each of size equal intervals. Case insensitive.
+            seed (int, None): Seed of 'random' and 'stratified' sampling.
+            E_range (tuple, None): Only sample microstates with low <= E < high, given as (low, high).
+        Returns:
+            An int64 array of rows in MSout.store.
+        """
+
         kind = kind.lower()
-        if kind not in ["deterministic", "random"]:
+        if kind not in ["deterministic", "random", "stratified"]:
             raise ValueError(
-                f"Values for `kind` are 'deterministic' or 'random'; Given: {kind}"
+                f"Values for `kind` are 'deterministic', 'random' or 'stratified'; Given: {kind}"
             )
 
-        ms_sampled = []
-        ms_list = list(self.microstates.values())
-        counts = ms_counts(ms_list)  # total number of ms
-        sampled_cumsum = np.cumsum([mc.count for mc in ms_list])
+        rows = None
+        count = self.store.count
+        if E_range is not None:
+            low, high = E_range
+            rows = np.flatnonzero((self.store.E >= low) & (self.store.E < high))
+            count = count[rows]
+        sampled_cumsum = np.cumsum(count)
+        counts = int(sampled_cumsum[-1]) if len(sampled_cumsum) else 0  # total number of ms
+        if counts == 0:
+            return np.zeros(0, dtype=np.int64)
 
         if kind == "deterministic":
             sampled_ms_indices = np.arange(
                 size, counts - size, counts / size, dtype=int
             )
-        else:
+        elif kind == "random":
             rng = np.random.default_rng(seed=seed)
             sampled_ms_indices = rng.integers(
                 low=0, high=counts, size=size, endpoint=True
             )
+        else:
+            rng = np.random.default_rng(seed=seed)
+            sampled_ms_indices = ((np.arange(size) + rng.random(size)) * (counts / size)).astype(np.int64)
 
-        for i, c in enumerate(sampled_ms_indices):
-            ms_sel_index = np.where((sampled_cumsum - c) > 0)[0][0]
-            ms_sampled.append([ms_sel_index, ms_list[ms_sel_index]])
-
-        return ms_sampled
+        # first row whose cumulative count passes the sampled count, the last row for the endpoint of 'random'
+        selected = np.minimum(np.searchsorted(sampled_cumsum, sampled_ms_indices, side="right"),
+                              len(sampled_cumsum) - 1).astype(np.int64)
+        if rows is not None:
+            selected = rows[selected]
+        return selected
 
     def sort_microstates(self, sort_by:str = "E", sort_reverse:bool = False) -> Union[list,None]:
         """Return the list of microstates sorted by one of these attributes: ["count", "E"],
@@ -341,7 +661,7 @@ def ms_to_charge_ms(microstates:Union[dict, list], conformers:list) -> list:
     Refactored from jmao's MC class method: convert_to_charge_ms
     """
 
-    if isinstance(microstates, dict):
+    if isinstance(microstates, Mapping):
         microstates = list(microstates.values())
 
     charge_microstates = []
@@ -427,10 +747,10 @@ def topN_charge_microstates(charge_microstates:list,
 def ms_counts(microstates):
     """Calculate total counts of microstates, which can be a list or a dict."""
 
-    if not isinstance(microstates, (dict, list)):
+    if not isinstance(microstates, (Mapping, list)):
         raise ValueError(f"`microstates` must be a list or a dict.")
 
-    if isinstance(microstates, dict):
+    if isinstance(microstates, Mapping):
         return sum(ms.count for ms in microstates.values())
     else:
         return sum(ms.count for ms in microstates)
@@ -576,6 +896,92 @@ def ms_convert2sumcrg(microstates, free_res):
     return charges
 
 
+def ms_counts_store(store: MicrostateStore) -> int:
+    """ms_counts() of a MicrostateStore."""
+    return int(sum(int(chunk.count.sum()) for chunk in store.chunks()))
+
+
+def groupms_byenergy_store(store: MicrostateStore, ticks: list) -> list:
+    """groupms_byenergy() of a MicrostateStore, bands are MicrostateStore groups. ticks is not changed."""
+    bins = np.append(np.sort(np.asarray(ticks, dtype=float)), 1.0e100)
+    band = np.concatenate([np.digitize(chunk.E, bins) - 1 for chunk in store.chunks()] + [np.zeros(0, dtype=int)])
+    # rows sorted by band, in their original order within a band, then cut at band boundaries
+    order = np.argsort(band, kind="stable")
+    bounds = np.searchsorted(band[order], np.arange(len(ticks) + 1))
+    grouped = store.take(order[bounds[0]:])
+    return [grouped.slice(start - bounds[0], end - bounds[0]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def iconf_mask(store: MicrostateStore, iconfs) -> np.ndarray:
+    """Rows of store with at least one of the conformer indices iconfs."""
+    iconfs = np.asarray(list(iconfs), dtype=int)
+    masks = [np.zeros(0, dtype=bool)]
+    for chunk in store.chunks():
+        states = np.asarray(chunk.states)
+        selected = np.zeros(max(int(states.max(initial=-1)), int(iconfs.max(initial=-1))) + 1, dtype=bool)
+        selected[iconfs] = True
+        masks.append(selected[states].any(axis=1))
+    return np.concatenate(masks)
+
+
+def groupms_byiconf_store(store: MicrostateStore, iconfs: list) -> tuple:
+    """groupms_byiconf() of a MicrostateStore, the groups are MicrostateStore objects."""
+    mask = iconf_mask(store, iconfs)
+    return store.take(mask), store.take(~mask)
+
+
+def groupms_byconfid_store(store: MicrostateStore, confids: list) -> tuple:
+    """groupms_byconfid() of a MicrostateStore, the groups are MicrostateStore objects.
+    Each confid substring is resolved to the conformer indices it matches once."""
+    mask = np.ones(len(store), dtype=bool)
+    for confid in confids:
+        mask &= iconf_mask(store, [ic for ic, conf in enumerate(conformers) if confid in conf.confid])
+    return store.take(mask), store.take(~mask)
+
+
+def ms_energy_stat_store(store: MicrostateStore) -> tuple:
+    """ms_energy_stat() of a MicrostateStore."""
+    lowest_E = math.inf
+    highest_E = -math.inf
+    N_ms = 0
+    total_E = 0.0
+    for chunk in store.chunks():
+        lowest_E = min(lowest_E, float(chunk.E.min()))
+        highest_E = max(highest_E, float(chunk.E.max()))
+        N_ms += int(chunk.count.sum())
+        total_E += float(np.dot(chunk.E, chunk.count))
+    return lowest_E, total_E/N_ms, highest_E
+
+
+def conf_counts(store: MicrostateStore) -> np.ndarray:
+    """Count weighted occurrence of each conformer index in store."""
+    counts = np.zeros(len(conformers))
+    for chunk in store.chunks():
+        states = np.asarray(chunk.states)
+        weights = chunk.count.astype(float)
+        for column in states.T:   # one bincount per free residue
+            column_counts = np.bincount(column, weights=weights, minlength=len(counts))
+            counts = np.pad(counts, (0, len(column_counts) - len(counts))) + column_counts
+    return counts
+
+
+def ms_convert2occ_store(store: MicrostateStore) -> dict:
+    """ms_convert2occ() of a MicrostateStore."""
+    counts = conf_counts(store)
+    N_ms = ms_counts_store(store)
+    return {int(ic): counts[ic]/N_ms for ic in np.flatnonzero(counts)}
+
+
+def ms_convert2sumcrg_store(store: MicrostateStore, free_res: list) -> list:
+    """ms_convert2sumcrg() of a MicrostateStore."""
+    counts = conf_counts(store)
+    iconfs = np.array([iconf for res in free_res for iconf in res], dtype=int)
+    ires = np.array([i_res for i_res, res in enumerate(free_res) for iconf in res], dtype=int)
+    crg = np.array([conformers[ic].crg for ic in iconfs.tolist()])
+    charges_total = np.bincount(ires, weights=crg * counts[iconfs], minlength=len(free_res))
+    return (charges_total / ms_counts_store(store)).tolist()
+
+
 def e2occ(energies):
     "Given a list of energy values in unit Kacl/mol, calculate the occupancy by Boltzmann Distribution."
     e = np.array(energies)
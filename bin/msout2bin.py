@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+"""
+Convert Monte Carlo microstate files ms_out/pH*eH*ms.txt to the binary microstate format of ms_analysis.py.
+The binary file keeps the header and the unique microstates as states, E and count arrays, and MSout opens it by
+memory mapping instead of parsing the text again:
+    msout = MSout("ms_out/pH7eH0ms.bin")
+"""
+
+import os
+import time
+import argparse
+from ms_analysis import convert_msout
+
+
+if __name__ == "__main__":
+    helpmsg = "Convert text ms_out files to binary microstate files, written next to them as *.bin."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("files", metavar="ms_file", nargs="+", help="text microstate files, such as ms_out/pH7eH0ms.txt")
+    parser.add_argument("-o", metavar="output", default="", help="output file name, only for a single input file")
+    args = parser.parse_args()
+
+    if args.o and len(args.files) > 1:
+        parser.error("-o takes a single input file")
+
+    for fname in args.files:
+        bin_fname = args.o or os.path.splitext(fname)[0] + ".bin"
+        current_time = time.time()
+        msout = convert_msout(fname, bin_fname)
+        print("%s -> %s: %d microstates, %d unique, %.1f seconds" % (fname, bin_fname, msout.N_ms, msout.N_uniq,
+                                                                     time.time() - current_time))
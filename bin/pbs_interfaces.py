@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 import logging
 import os
+import time
+import asyncio
 import subprocess
 import math
-import struct
 import sys
+import numpy as np
+from scipy import fft, ndimage
+from scipy.sparse import diags
+from scipy.sparse.linalg import cg
+
+
+# a boundary line passed to the PB solver: coordinates, radius, charge and the potential the solver returns
+XYZRCP = np.dtype([("x", float), ("y", float), ("z", float), ("r", float), ("c", float), ("p", float)])
 
 
 class PBS_DELPHI:
@@ -24,20 +33,10 @@ class PBS_DELPHI:
 
     def depth(self, bound):
         # determine delphi focusing depth
-        x_min = x_max = bound.single_bnd_xyzrcp[0].x
-        y_min = y_max = bound.single_bnd_xyzrcp[0].y
-        z_min = z_max = bound.single_bnd_xyzrcp[0].z
-        for p in bound.single_bnd_xyzrcp[1:]:
-            if x_min > p.x: x_min = p.x
-            if x_max < p.x: x_max = p.x
-            if y_min > p.y: y_min = p.y
-            if y_max < p.y: y_max = p.y
-            if z_min > p.z: z_min = p.z
-            if z_max < p.z: z_max = p.z
-
-        dx = x_max - x_min
-        dy = y_max - y_min
-        dz = z_max - z_min
+        xyzrcp = bound.single_bnd_xyzrcp
+        dx = xyzrcp.x.max() - xyzrcp.x.min()
+        dy = xyzrcp.y.max() - xyzrcp.y.min()
+        dz = xyzrcp.z.max() - xyzrcp.z.min()
         dm = max(dx, dy, dz)
         dm += self.radius_probe * 2 + 3.4  # expand the largest dimension by the probe radius and safety
 
@@ -50,40 +49,91 @@ class PBS_DELPHI:
         return depth
 
 
-    def write_fort15(self, xyzrcp):
+    def write_fort15(self, xyzrcp, folder="."):
         i = 1
-        with open("fort.15", "w") as fh:
-            for p in xyzrcp:
+        with open(os.path.join(folder, "fort.15"), "w") as fh:
+            for x, y, z in zip(xyzrcp.x.tolist(), xyzrcp.y.tolist(), xyzrcp.z.tolist()):
                 header = "ATOM      0  O   LYS %5d    " % i
-                fh.write("%-30s%8.3f%8.3f%8.3f\n" % (header, p.x, p.y, p.z))
+                fh.write("%-30s%8.3f%8.3f%8.3f\n" % (header, x, y, z))
                 i += 1
         return
 
-    def write_fort13(self, xyzrcp):
-        struct_fmt = '=ifffffi'
-        with open("fort.13", "wb") as fh:
-            for p in xyzrcp:
-                record_unf = struct.pack(struct_fmt, 20, p.x, p.y, p.z, p.r, p.c, 20)
-                fh.write(record_unf)
+    def write_fort13(self, xyzrcp, folder="."):
+        # unformatted fortran records, struct format '=ifffffi'
+        records = np.zeros(len(xyzrcp), dtype=[("head", "=i4"), ("x", "=f4"), ("y", "=f4"), ("z", "=f4"),
+                                               ("r", "=f4"), ("c", "=f4"), ("tail", "=i4")])
+        records["head"] = records["tail"] = 20
+        for name in ("x", "y", "z", "r", "c"):
+            records[name] = xyzrcp[name]
+        with open(os.path.join(folder, "fort.13"), "wb") as fh:
+            records.tofile(fh)
+        return
+
+    def write_fort27(self, xyzrcp, folder="."):
+        # focusing center, the charge weighted center of the boundary
+        center = [0.0, 0.0, 0.0]
+        weight = 0.0
+        p = xyzrcp[np.abs(xyzrcp.c) > 0.00001]
+        if len(p):
+            w = np.abs(p.c)
+            center = [float((p.x * w).sum()), float((p.y * w).sum()), float((p.z * w).sum())]
+            weight = float(w.sum())
+
+        if weight > 0.000001:
+            center = [c/(weight+0.000001) for c in center]
+        else:
+            logging.error("PB solver shouldn't run a conformer has no charged atom.")
+        with open(os.path.join(folder, "fort.27"), "w") as fh:
+            fh.write("ATOM  %5d  C   CEN  %04d    %8.3f%8.3f%8.3f\n" % (1, 1, center[0], center[1], center[2]))
+        return
+
+    def write_fort10(self, depth, i, folder="."):
+        # parameters of focusing run i of depth, run 0 starts from the boundary, later runs from the last phi map
+        with open(os.path.join(folder, "fort.10"), "w") as fh:
+            fh.write("gsize=%d\n" % self.grids_delphi)
+            fh.write("scale=%.2f\n" % (self.grids_per_ang/2**(depth-1-i)))
+            fh.write("in(unpdb,file=\"fort.13\")\n")
+            if i > 0:
+                fh.write("in(phi,file=\"run%02d.phi\")\n" % i)
+            fh.write("indi=%.1f\n" % self.epsilon_prot)
+            fh.write("exdi=%.1f\n" % self.epsilon_solv)
+            fh.write("ionrad=%.1f\n" % self.ionrad)
+            fh.write("salt=%.2f\n" % self.salt)
+            if i > 0:
+                fh.write("bndcon=3\n")
+            else:
+                fh.write("bndcon=2\n")
+            fh.write("center(777, 777, 0)\n")
+            fh.write("out(frc,file=\"run%02d.frc\")\n" % (i+1))
+            fh.write("out(phi,file=\"run%02d.phi\")\n" % (i+1))
+            fh.write("site(a,c,p)\n")
+            fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
+        return
+
+    def prepare(self, xyzrcp, folder="."):
+        # input files shared by the focusing runs of one boundary condition
+        self.write_fort13(xyzrcp, folder)
+        self.write_fort15(xyzrcp, folder)
+        self.write_fort27(xyzrcp, folder)
         return
 
-    def collect_phi(self, depth, xyzrcp):
+    def collect_phi(self, depth, xyzrcp, folder="."):
         # collect results from the log
         try:
-            lines = open("run01.frc", "r").readlines()
+            lines = open(os.path.join(folder, "run01.frc"), "r").readlines()
         except OSError:
             logging.error("Could not open Delphi output file run01.frc.")
             sys.exit()
 
         for counter in range(len(xyzrcp)):
             phi = float(lines[12+counter][20:].split()[0])
-            xyzrcp[counter].p = phi
+            xyzrcp.p[counter] = phi
 
         # If the potential is non 0 in focusing runs, update
         for i in range(1, depth):
             frc_name = "run%02d.frc" % (i+1)
             try:
-                lines = open(frc_name, "r").readlines()
+                lines = open(os.path.join(folder, frc_name), "r").readlines()
             except OSError:
                 logging.error("Could not open Delphi output file %s." % frc_name)
                 sys.exit()
@@ -91,7 +141,7 @@ class PBS_DELPHI:
             for counter in range(len(xyzrcp)):
                 phi = float(lines[12 + counter][20:].split()[0])
                 if abs(phi) > 0.0001:
-                    xyzrcp[counter].p = phi
+                    xyzrcp.p[counter] = phi
 
         return
 
@@ -110,160 +160,402 @@ class PBS_DELPHI:
         return rxn
 
 
-    def run(self, bound, run_options):
+    def run(self, bound, run_options, folder="."):
         """PBE solver interface for delphi. 
         It will generate site p in both boundary conditions 
         and return rxn in single boundary condition.
+        Delphi runs in folder, the current directory is left alone.
         """
 
-        # snippets to check the input and environment
-        # Current working directory
-        # cwd = os.getcwd()
-        # print(cwd)
-        # What are in bound
-        #print(vars(bound))
-
         depth = self.depth(bound)
         logging.info("Delphi focusing depth: %d" % depth)
+        self.epsilon_prot = run_options.d
         rxns = []
 
         # single side chain boundary condition
-        # fort.13
         # The first run starts with fort.13 as dielectric boundary, the following runs will be focusing runs, using the phi
         # as input
-        #
-        self.write_fort13(bound.single_bnd_xyzrcp)
-        self.write_fort15(bound.single_bnd_xyzrcp)
-
-
-        # fort.27
-        center = [0.0, 0.0, 0.0]
-        weight = 0.0
-        for p in bound.single_bnd_xyzrcp:
-            w = abs(p.c)
-            if w > 0.00001:
-                center[0] += p.x * w
-                center[1] += p.y * w
-                center[2] += p.z * w
-                weight += w
-
-        if weight > 0.000001:
-            center = [c/(weight+0.000001) for c in center]
-        else:
-            logging.error("PB solver shouldn't run a conformer has no charged atom.")
-        with open("fort.27", "w") as fh:
-            fh.write("ATOM  %5d  C   CEN  %04d    %8.3f%8.3f%8.3f\n" % (1, 1, center[0], center[1], center[2]))
-
-        # fort.10
-        self.epsilon_prot = run_options.d
-        with open("fort.10", "w") as fh:
-            fh.write("gsize=%d\n" % self.grids_delphi)
-            fh.write("scale=%.2f\n" % (self.grids_per_ang/2**(depth-1)))
-            fh.write("in(unpdb,file=\"fort.13\")\n")
-            fh.write("indi=%.1f\n" % self.epsilon_prot)
-            fh.write("exdi=%.1f\n" % self.epsilon_solv)
-            fh.write("ionrad=%.1f\n" % self.ionrad)
-            fh.write("salt=%.2f\n" % self.salt)
-            fh.write("bndcon=2\n")
-            fh.write("center(777, 777, 0)\n")
-            fh.write("out(frc,file=\"run01.frc\")\n")
-            fh.write("out(phi,file=\"run01.phi\")\n")
-            fh.write("site(a,c,p)\n")
-            fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
-
-        # 1st delphi run
-        result = subprocess.run([self.exe], capture_output=True, text=True)
-        rxns.append(self.collect_rxn(result.stdout))
-
-        # subsequent delphi runs
-        for i in range(1, depth):
-            with open("fort.10", "w") as fh:
-                fh.write("gsize=%d\n" % self.grids_delphi)
-                fh.write("scale=%.2f\n" % (self.grids_per_ang/2**(depth-1-i)))
-                fh.write("in(unpdb,file=\"fort.13\")\n")
-                fh.write("in(phi,file=\"run%02d.phi\")\n" % i)
-                fh.write("indi=%.1f\n" % self.epsilon_prot)
-                fh.write("exdi=%.1f\n" % self.epsilon_solv)
-                fh.write("ionrad=%.1f\n" % self.ionrad)
-                fh.write("salt=%.2f\n" % self.salt)
-                fh.write("bndcon=3\n")
-                fh.write("center(777, 777, 0)\n")
-                fh.write("out(frc,file=\"run%02d.frc\")\n" % (i+1))
-                fh.write("out(phi,file=\"run%02d.phi\")\n" % (i+1))
-                fh.write("site(a,c,p)\n")
-                fh.write("energy(g,an,sol)\n")  # g for grid energy, sol for corrected rxn
-
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+        self.prepare(bound.single_bnd_xyzrcp, folder)
+        for i in range(depth):
+            self.write_fort10(depth, i, folder)
+            result = subprocess.run([self.exe], capture_output=True, text=True, cwd=folder)
             rxns.append(self.collect_rxn(result.stdout))
 
         # collect results from frc files
-        self.collect_phi(depth, bound.single_bnd_xyzrcp)
-
+        self.collect_phi(depth, bound.single_bnd_xyzrcp, folder)
 
         # multi side chain boundary condition
-        # fort.13 for first run
-        self.write_fort13(bound.multi_bnd_xyzrcp)
-        self.write_fort15(bound.multi_bnd_xyzrcp)
+        self.prepare(bound.multi_bnd_xyzrcp, folder)
+        for i in range(depth):
+            self.write_fort10(depth, i, folder)
+            subprocess.run([self.exe], capture_output=True, text=True, cwd=folder)
 
+        # collect results from frc files
+        self.collect_phi(depth, bound.multi_bnd_xyzrcp, folder)
 
-        # fort.27
-        center = [0.0, 0.0, 0.0]
-        weight = 0.0
-        for p in bound.multi_bnd_xyzrcp:
-            w = abs(p.c)
-            if w > 0.00001:
-                center[0] += p.x * w
-                center[1] += p.y * w
-                center[2] += p.z * w
-                weight += w
+        return min(rxns)    # return the most negative value of the focusing runs
 
-        if weight > 0.000001:
-            center = [c/(weight+0.000001) for c in center]
-        else:
-            logging.error("PB solver shouldn't run a conformer has no charged atom.")
-        with open("fort.27", "w") as fh:
-            fh.write("ATOM  %5d  C   CEN  %04d    %8.3f%8.3f%8.3f\n" % (1, 1, center[0], center[1], center[2]))
+    async def run_async(self, bound, run_options, folder, slots, latency):
+        """Asynchronous run(). The two boundary conditions are solved in their own subfolders of folder at the same
+        time, each delphi call waits for one of the slots, a semaphore shared by all conformers in flight.
+        The (boundary, run, seconds) of each call is appended to latency."""
+        depth = self.depth(bound)
+        logging.info("Delphi focusing depth: %d" % depth)
+        self.epsilon_prot = run_options.d
+        single = os.path.join(folder, "single")
+        multi = os.path.join(folder, "multi")
+        os.makedirs(single, exist_ok=True)
+        os.makedirs(multi, exist_ok=True)
+
+        rxns, _ = await asyncio.gather(self.focus_async(bound.single_bnd_xyzrcp, depth, single, slots, latency, True),
+                                       self.focus_async(bound.multi_bnd_xyzrcp, depth, multi, slots, latency))
+        return min(rxns)
+
+    async def focus_async(self, xyzrcp, depth, folder, slots, latency, rxn=False):
+        """Focusing runs of one boundary condition in folder. Input files are written and frc files parsed in a
+        thread, so they overlap with the delphi processes of other conformers. Return rxn of each run if rxn."""
+        await asyncio.to_thread(self.prepare, xyzrcp, folder)
+        rxns = []
+        for i in range(depth):
+            self.write_fort10(depth, i, folder)
+            async with slots:
+                start = time.time()
+                proc = await asyncio.create_subprocess_exec(self.exe, cwd=folder, stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE)
+                stdout, _ = await proc.communicate()
+                latency.append((os.path.basename(folder), i + 1, time.time() - start))
+            if rxn:
+                rxns.append(self.collect_rxn(stdout.decode()))
+        await asyncio.to_thread(self.collect_phi, depth, xyzrcp, folder)
+        return rxns
+
+
+class PBS_FD(PBS_DELPHI):
+    """In-process finite difference solver of the linearized PBE, with the grid, focusing depth and dielectric
+    parameters of PBS_DELPHI. It fills the same site potentials in kT/e and returns the same reaction field energy.
+
+    The dielectric boundary is the molecular surface of the probe, the part of the solvent accessible region that the
+    probe can not reach, found by a distance transform. Ions are excluded within ionrad of atoms. Charges are spread to
+    grid points by trilinear weights. The first focusing run has the Debye screened Coulomb potential in solvent as
+    boundary values, the next runs the potential of the previous run. Each run is solved by conjugate gradients.
+    The reaction field energy is against the same grid with the protein dielectric throughout, solved by a sine
+    transform, so the grid self energy cancels.
+    """
+    def __init__(self):
+        super().__init__()
+        self.coulomb = 332.0637 * self.KCAL2KT   # kT/e at 1 angstrom from a unit charge in vacuum
+        self.tolerance = 1.0e-6   # relative residual of conjugate gradients
+        self.max_iterations = 5000
+        return
 
-        # fort.10
+    def run(self, bound, run_options):
+        """PBE solver interface like PBS_DELPHI.run(), without temporary files."""
+        depth = self.depth(bound)
+        logging.info("FD focusing depth: %d" % depth)
         self.epsilon_prot = run_options.d
-        with open("fort.10", "w") as fh:
-            fh.write("gsize=%d\n" % self.grids_delphi)
-            fh.write("scale=%.2f\n" % (self.grids_per_ang/2**(depth-1)))
-            fh.write("in(unpdb,file=\"fort.13\")\n")
-            fh.write("indi=%.1f\n" % self.epsilon_prot)
-            fh.write("exdi=%.1f\n" % self.epsilon_solv)
-            fh.write("ionrad=%.1f\n" % self.ionrad)
-            fh.write("salt=%.2f\n" % self.salt)
-            fh.write("bndcon=2\n")
-            fh.write("center(777, 777, 0)\n")
-            fh.write("out(frc,file=\"run01.frc\")\n")
-            fh.write("out(phi,file=\"run01.phi\")\n")
-            fh.write("site(a,c,p)\n")
-            fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
+        rxns, phis = self.focus(bound.single_bnd_xyzrcp, depth, rxn=True)
+        # same charges and grids, the single side chain solutions are close to the multi ones
+        self.focus(bound.multi_bnd_xyzrcp, depth, guesses=phis)
+        return min(rxns)    # return the most negative value of the focusing runs
+
+    def focus(self, xyzrcp, depth, rxn=False, guesses=None):
+        """Solve focusing runs from coarse to fine and set potentials xyzrcp.p. Return the reaction field energy of
+        each run in kcal/mol if rxn is True, and the potential grid of each run. guesses are initial potential grids."""
+        n = self.grids_delphi
+        charged = np.abs(xyzrcp.c) > 0.00001
+        q_xyz = np.column_stack((xyzrcp.x[charged], xyzrcp.y[charged], xyzrcp.z[charged]))
+        q = xyzrcp.c[charged]
+        w = np.abs(q)
+        if w.sum() > 0.000001:
+            center = (q_xyz * w[:, None]).sum(axis=0) / (w.sum() + 0.000001)
+        else:
+            center = np.zeros(3)
+            logging.error("PB solver shouldn't run a conformer has no charged atom.")
+        sites = np.column_stack((xyzrcp.x, xyzrcp.y, xyzrcp.z))
 
-        # 1st delphi run
-        result = subprocess.run([self.exe], capture_output=True, text=True)
+        rxns = []
+        phis = []
+        phi = None
+        for i in range(depth):
+            h = 2 ** (depth - 1 - i) / self.grids_per_ang
+            origin = center - h * (n - 1) / 2
+            eps, ion = self.dielectric(xyzrcp, origin, h)
+            q_grid = self.spread(q_xyz, q, origin, h)
+            if phi is None:
+                phi_bnd = self.coulomb_boundary(q_xyz, q, origin, h, self.epsilon_solv, self.ionic())
+            else:
+                # focusing, boundary from the previous run that has twice the grid spacing
+                phi_bnd = self.interpolate(phi, prev_origin, 2 * h, self.grid_points(origin, h))
+            if guesses:
+                phi_bnd[1:-1, 1:-1, 1:-1] = guesses[i][1:-1, 1:-1, 1:-1]
+            phi = self.solve(eps, ion, q_grid, phi_bnd, h)
+            phis.append(phi)
+
+            site_p, inside = self.site_potential(phi, origin, h, sites)
+            if i == 0:
+                xyzrcp.p = site_p
+            else:
+                update = inside & (np.abs(site_p) > 0.0001)
+                xyzrcp.p[update] = site_p[update]
+
+            if rxn:
+                phi_ref = self.solve_uniform(q_grid, self.coulomb_boundary(q_xyz, q, origin, h, self.epsilon_prot, 0.0),
+                                             h, self.epsilon_prot)
+                rxns.append(0.5 * float((q_grid * (phi - phi_ref)).sum()) / self.KCAL2KT)
+            prev_origin = origin
+
+        return rxns, phis
+
+    def ionic(self):
+        """epsilon_solv * kappa^2 in 1/angstrom^2 of the salt concentration."""
+        return 8 * math.pi * self.coulomb * 6.02214e-4 * self.salt
+
+    def grid_points(self, origin, h):
+        n = self.grids_delphi
+        axis = np.arange(n) * h
+        return np.stack(np.meshgrid(axis + origin[0], axis + origin[1], axis + origin[2], indexing="ij"), axis=-1)
+
+    def dielectric(self, xyzrcp, origin, h):
+        """Dielectric constant of grid points and the points that ions can reach."""
+        n = self.grids_delphi
+        vdw = np.zeros((n, n, n), dtype=bool)
+        sas = np.zeros((n, n, n), dtype=bool)
+        excluded = np.zeros((n, n, n), dtype=bool)
+        xyz = np.column_stack((xyzrcp.x, xyzrcp.y, xyzrcp.z))
+        reach = xyzrcp.r + max(self.radius_probe, self.ionrad)
+        lo = np.maximum(np.ceil((xyz - reach[:, None] - origin) / h).astype(int), 0)
+        hi = np.minimum(np.floor((xyz + reach[:, None] - origin) / h).astype(int), n - 1)
+        for a in np.where((xyzrcp.r > 0) & (lo <= hi).all(axis=1))[0]:
+            box = (slice(lo[a, 0], hi[a, 0] + 1), slice(lo[a, 1], hi[a, 1] + 1), slice(lo[a, 2], hi[a, 2] + 1))
+            dx = origin[0] + h * np.arange(lo[a, 0], hi[a, 0] + 1) - xyz[a, 0]
+            dy = origin[1] + h * np.arange(lo[a, 1], hi[a, 1] + 1) - xyz[a, 1]
+            dz = origin[2] + h * np.arange(lo[a, 2], hi[a, 2] + 1) - xyz[a, 2]
+            d2 = (dx * dx)[:, None, None] + (dy * dy)[None, :, None] + (dz * dz)[None, None, :]
+            r = xyzrcp.r[a]
+            vdw[box] |= d2 < r * r
+            sas[box] |= d2 < (r + self.radius_probe) ** 2
+            excluded[box] |= d2 < (r + self.ionrad) ** 2
+
+        # the probe reaches points of the solvent accessible region within its radius from the region's surface
+        inside = vdw | (sas & (ndimage.distance_transform_edt(sas) * h > self.radius_probe))
+        eps = np.where(inside, self.epsilon_prot, self.epsilon_solv)
+        return eps, ~excluded
+
+    def spread(self, q_xyz, q, origin, h):
+        """Charges on grid points by trilinear weights."""
+        n = self.grids_delphi
+        q_grid = np.zeros((n, n, n))
+        g = (q_xyz - origin) / h
+        g0 = np.floor(g).astype(int)
+        f = g - g0
+        for corner in range(8):
+            offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            weight = np.prod(np.where(offset == 1, f, 1.0 - f), axis=1)
+            idx = g0 + offset
+            valid = ((idx >= 0) & (idx < n)).all(axis=1)
+            np.add.at(q_grid, (idx[valid, 0], idx[valid, 1], idx[valid, 2]), q[valid] * weight[valid])
+        return q_grid
+
+    def coulomb_boundary(self, q_xyz, q, origin, h, epsilon, ionic):
+        """Grid with the Debye screened Coulomb potential of the charges on the faces, 0 inside."""
+        n = self.grids_delphi
+        kappa = math.sqrt(ionic / epsilon)
+        phi = np.zeros((n, n, n))
+        face = np.ones((n, n, n), dtype=bool)
+        face[1:-1, 1:-1, 1:-1] = False
+        points = self.grid_points(origin, h)[face]
+        p = np.zeros(len(points))
+        for j in range(len(q)):
+            d = np.sqrt(((points - q_xyz[j]) ** 2).sum(axis=1))
+            p += q[j] * np.exp(-kappa * d) / np.maximum(d, h)
+        phi[face] = p * self.coulomb / epsilon
+        return phi
+
+    def interpolate(self, phi, origin, h, points):
+        """Trilinear interpolation of grid phi at points, 0 outside the grid."""
+        coords = (points - origin) / h
+        shape = coords.shape[:-1]
+        coords = coords.reshape((-1, 3)).T
+        return ndimage.map_coordinates(phi, coords, order=1, mode="constant", cval=0.0).reshape(shape)
+
+    def site_potential(self, phi, origin, h, sites):
+        n = self.grids_delphi
+        coords = (sites - origin) / h
+        inside = ((coords >= 0) & (coords <= n - 1)).all(axis=1)
+        p = self.interpolate(phi, origin, h, sites)
+        p[~inside] = 0.0
+        return p, inside
+
+    def solve(self, eps, ion, q_grid, phi_bnd, h):
+        """Linearized PBE on the grid, with the face values of phi_bnd fixed and its inside as the initial guess."""
+        n = eps.shape[0]
+        m = n - 2
+        # dielectric constant between neighbouring points is the mean of the two
+        ex = (eps[1:] + eps[:-1]) / 2
+        ey = (eps[:, 1:] + eps[:, :-1]) / 2
+        ez = (eps[:, :, 1:] + eps[:, :, :-1]) / 2
+        inner = slice(1, -1)
+        x_lo, x_hi = ex[:-1, inner, inner], ex[1:, inner, inner]
+        y_lo, y_hi = ey[inner, :-1, inner], ey[inner, 1:, inner]
+        z_lo, z_hi = ez[inner, inner, :-1], ez[inner, inner, 1:]
+        diagonal = x_lo + x_hi + y_lo + y_hi + z_lo + z_hi + self.ionic() * h * h * ion[inner, inner, inner]
+
+        # charges, and the fixed face values of neighbours
+        rhs = 4 * math.pi * self.coulomb / h * q_grid[inner, inner, inner]
+        rhs[0] += x_lo[0] * phi_bnd[0, inner, inner]
+        rhs[-1] += x_hi[-1] * phi_bnd[-1, inner, inner]
+        rhs[:, 0] += y_lo[:, 0] * phi_bnd[inner, 0, inner]
+        rhs[:, -1] += y_hi[:, -1] * phi_bnd[inner, -1, inner]
+        rhs[:, :, 0] += z_lo[:, :, 0] * phi_bnd[inner, inner, 0]
+        rhs[:, :, -1] += z_hi[:, :, -1] * phi_bnd[inner, inner, -1]
+
+        # couplings to the next point along each axis, none across the faces
+        off_x = -x_hi[:-1].ravel()
+        off_y = -y_hi.copy()
+        off_y[:, -1] = 0.0
+        off_y = off_y.ravel()[:-m]
+        off_z = -z_hi.copy()
+        off_z[:, :, -1] = 0.0
+        off_z = off_z.ravel()[:-1]
+        a = diags([diagonal.ravel(), off_x, off_x, off_y, off_y, off_z, off_z], [0, m * m, -m * m, m, -m, 1, -1],
+                  format="csr")
+        x, info = cg(a, rhs.ravel(), x0=phi_bnd[inner, inner, inner].ravel(), rtol=self.tolerance,
+                     maxiter=self.max_iterations, M=diags(1.0 / diagonal.ravel()))
+        if info > 0:
+            logging.warning("FD PB solver did not converge in %d iterations" % info)
+        phi = phi_bnd.copy()
+        phi[inner, inner, inner] = x.reshape((m, m, m))
+        return phi
+
+    def solve_uniform(self, q_grid, phi_bnd, h, epsilon):
+        """Poisson equation on the grid in a uniform dielectric by a sine transform, with the face values of phi_bnd
+        fixed."""
+        n = q_grid.shape[0]
+        m = n - 2
+        inner = slice(1, -1)
+        rhs = 4 * math.pi * self.coulomb / (h * epsilon) * q_grid[inner, inner, inner]
+        rhs[0] += phi_bnd[0, inner, inner]
+        rhs[-1] += phi_bnd[-1, inner, inner]
+        rhs[:, 0] += phi_bnd[inner, 0, inner]
+        rhs[:, -1] += phi_bnd[inner, -1, inner]
+        rhs[:, :, 0] += phi_bnd[inner, inner, 0]
+        rhs[:, :, -1] += phi_bnd[inner, inner, -1]
+        eigen = 2 * (1 - np.cos(math.pi * np.arange(1, m + 1) / (m + 1)))
+        eigen = eigen[:, None, None] + eigen[None, :, None] + eigen[None, None, :]
+        phi = phi_bnd.copy()
+        phi[inner, inner, inner] = fft.idstn(fft.dstn(rhs, type=1) / eigen, type=1)
+        return phi
+
+
+class PBS_GB(PBS_DELPHI):
+    """Generalized Born screening in place of a PB solver, for high-throughput triage.
+
+    Site potentials are those of the conformer charges with the GB pair kernel of Still, and rxn is the GB energy of
+    the conformer charges. Born radii of all atoms come from HCT descreening by the atoms of the single side chain
+    boundary. The descreening sums of the boundary of native conformers are made once per process, and each conformer
+    only corrects them for the atoms it swaps in and out. Multi side chain sites take the same radii.
+    """
+    cache = None   # (StaticBoundary, descreening sums of its single boundary atoms on all atoms)
 
-        # subsequent delphi runs
-        for i in range(1, depth):
-            with open("fort.10", "w") as fh:
-                fh.write("gsize=%d\n" % self.grids_delphi)
-                fh.write("scale=%.2f\n" % (self.grids_per_ang/2**(depth-1-i)))
-                fh.write("in(unpdb,file=\"fort.13\")\n")
-                fh.write("in(phi,file=\"run%02d.phi\")\n" % i)
-                fh.write("indi=%.1f\n" % self.epsilon_prot)
-                fh.write("exdi=%.1f\n" % self.epsilon_solv)
-                fh.write("ionrad=%.1f\n" % self.ionrad)
-                fh.write("salt=%.2f\n" % self.salt)
-                fh.write("bndcon=3\n")
-                fh.write("center(777, 777, 0)\n")
-                fh.write("out(frc,file=\"run%02d.frc\")\n" % (i+1))
-                fh.write("out(phi,file=\"run%02d.phi\")\n" % (i+1))
-                fh.write("site(a,c,p)\n")
-                fh.write("energy(g,an,sol)\n")  # g for grid energy, sol for corrected rxn
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+    def __init__(self):
+        super().__init__()
+        self.coulomb = 332.0637   # kcal/mol at 1 angstrom between unit charges in vacuum
+        self.radius_offset = 0.09   # intrinsic radius is the atom radius less this offset
+        self.radius_min = 1.0   # radius of atoms without one, hydrogens for example
+        self.scale = 0.8   # descreening radius scale
+        self.born_max = 30.0
+        return
 
-        # collect results from frc files
-        self.collect_phi(depth, bound.multi_bnd_xyzrcp)
+    def run(self, bound, run_options):
+        """Solver interface like PBS_DELPHI.run(), without temporary files."""
+        self.epsilon_prot = run_options.d
+        static = bound.boundary
+        born = self.born_radii(static, bound.single_bnd_atom)
+
+        single = bound.single_bnd_xyzrcp
+        charged = np.where(np.abs(single.c) > 0.00001)[0]
+        q_atom = bound.single_bnd_atom[charged]
+        q = single.c[charged]
+        q_xyz = static.xyz[q_atom]
+
+        single.p = self.potential(q_xyz, q, born[q_atom], static.xyz[bound.single_bnd_atom],
+                                  born[bound.single_bnd_atom]) * self.KCAL2KT
+        multi_atom = bound.multi_bnd_atom[bound.multi_bnd_indptr[:-1]]   # first atom of each line
+        bound.multi_bnd_xyzrcp.p = self.potential(q_xyz, q, born[q_atom], static.xyz[multi_atom],
+                                                  born[multi_atom]) * self.KCAL2KT
+
+        # GB energy of the conformer charges, the pairs i, j and j, i and the self terms
+        d2 = ((q_xyz[:, None, :] - q_xyz[None, :, :]) ** 2).sum(axis=2)
+        rr = born[q_atom][:, None] * born[q_atom][None, :]
+        f_gb = np.sqrt(d2 + rr * np.exp(-d2 / (4 * rr)))
+        rxn = -0.5 * self.coulomb * (1 / self.epsilon_prot - 1 / self.epsilon_solv) * \
+            float((q[:, None] * q[None, :] / f_gb).sum())
+        return rxn
 
-        return min(rxns)    # return the most negative value of the focusing runs
+    def potential(self, q_xyz, q, q_born, xyz, born):
+        """Potential in kcal/mol/e at xyz of charges q with Born radii."""
+        p = np.zeros(len(xyz))
+        for j in range(len(q)):
+            d2 = ((xyz - q_xyz[j]) ** 2).sum(axis=1)
+            rr = q_born[j] * born
+            f_gb = np.sqrt(d2 + rr * np.exp(-d2 / (4 * rr)))
+            coulomb = np.zeros(len(xyz))
+            apart = d2 > 0.000001
+            coulomb[apart] = 1 / (self.epsilon_prot * np.sqrt(d2[apart]))
+            p += q[j] * (coulomb - (1 / self.epsilon_prot - 1 / self.epsilon_solv) / f_gb)
+        return p * self.coulomb
+
+    def intrinsic(self, r):
+        return np.maximum(r, self.radius_min) - self.radius_offset
+
+    def descreening(self, xyz, r, env_xyz, env_r):
+        """HCT descreening sums of atoms at xyz with radii r by environment atoms."""
+        rho = self.intrinsic(r)
+        sums = np.zeros(len(xyz))
+        env = env_r > 0
+        env_xyz = env_xyz[env]
+        sr = self.scale * self.intrinsic(env_r[env])
+        for start in range(0, len(xyz), 256):
+            end = min(start + 256, len(xyz))
+            d = np.sqrt(((xyz[start:end, None, :] - env_xyz[None, :, :]) ** 2).sum(axis=2))
+            rho_i = rho[start:end, None]
+            upper = d + sr
+            lower = np.maximum(rho_i, np.abs(d - sr))
+            valid = (upper > rho_i) & (d > 0.000001)
+            d = np.where(valid, d, 1.0)
+            lower = np.where(valid, lower, 1.0)
+            upper = np.where(valid, upper, 1.0)
+            term = 1 / lower - 1 / upper + d / 4 * (1 / upper ** 2 - 1 / lower ** 2) + \
+                np.log(lower / upper) / (2 * d) + sr ** 2 / (4 * d) * (1 / lower ** 2 - 1 / upper ** 2)
+            sums[start:end] = np.where(valid, term, 0.0).sum(axis=1)
+        return sums
+
+    def born_radii(self, static, single_atom):
+        """Born radii of all atoms when the single side chain boundary is made of single_atom."""
+        if PBS_GB.cache is None or PBS_GB.cache[0] is not static:
+            PBS_GB.cache = (static, self.descreening(static.xyz, static.r_bound, static.xyz[static.single_atom],
+                                                     static.r_bound[static.single_atom]))
+        sums = PBS_GB.cache[1]
+        removed = np.setdiff1d(static.single_atom, single_atom)
+        added = np.setdiff1d(single_atom, static.single_atom)
+        sums = sums - self.descreening(static.xyz, static.r_bound, static.xyz[removed], static.r_bound[removed]) + \
+            self.descreening(static.xyz, static.r_bound, static.xyz[added], static.r_bound[added])
+        inverse = 1 / self.intrinsic(static.r_bound) - 0.5 * sums
+        return np.minimum(1 / np.maximum(inverse, 1 / self.born_max), self.born_max)
+
+
+class PBS_COULOMB(PBS_GB):
+    """Coulomb interactions with a distance dependent dielectric constant, epsilon_prot * r within 1 to
+    epsilon_solv / epsilon_prot angstroms, in place of a PB solver. rxn is the GB energy as in PBS_GB."""
+    def potential(self, q_xyz, q, q_born, xyz, born):
+        p = np.zeros(len(xyz))
+        for j in range(len(q)):
+            d = np.sqrt(((xyz - q_xyz[j]) ** 2).sum(axis=1))
+            apart = d > 0.001
+            epsilon = np.clip(self.epsilon_prot * d[apart], self.epsilon_prot, self.epsilon_solv)
+            p[apart] += q[j] / (epsilon * d[apart])
+        return p * self.coulomb
+
+
+# solvers that run in the step 3 process, by -s name
+PBS_IN_PROCESS = {"FD": PBS_FD, "GB": PBS_GB, "COULOMB": PBS_COULOMB}
@@ -3,11 +3,16 @@
 
 import math
 import os
+import sys
 import logging
 import glob
 import time
+import hashlib
+import pickle
 import numpy as np
-from scipy.sparse import lil_matrix
+import multiprocessing
+from multiprocessing import shared_memory
+from scipy.sparse import coo_matrix, csr_matrix, identity
 
 
 KCAL2KT = 1.688
@@ -32,8 +37,41 @@ def ddvv(xyz1, xyz2):
     dz=xyz1[2]-xyz2[2]
     return dx*dx+dy*dy+dz*dz
 
+def store_field(field, vector=False):
+    """Property of an atom that reads and writes row atom.i of AtomStore.<field> once the atom is attached to a
+    store, and the local slot _<field> before that. A vector field reads back as a tuple of floats."""
+    local = "_" + field
+
+    def fget(self):
+        if self.store is None:
+            return getattr(self, local)
+        if vector:
+            return tuple(getattr(self.store, field)[self.i].tolist())
+        return float(getattr(self.store, field)[self.i])
+
+    def fset(self, value):
+        if self.store is None:
+            setattr(self, local, value)
+        else:
+            getattr(self.store, field)[self.i] = value
+
+    return property(fget, fset)
+
+
 class Atom:
+    __slots__ = ("serial", "name", "altLoc", "resName", "chainID", "resSeq", "iCode", "confNum", "atomID",
+                 "confID", "confType", "resID", "connectivity_param", "connect12", "connect13", "connect14",
+                 "history", "i", "store", "_xyz", "_r_bound", "_charge", "_r_vdw", "_e_vdw")
+
+    # numeric attributes are views of the AtomStore arrays after Protein.index_atoms()
+    xyz = store_field("xyz", vector=True)
+    r_bound = store_field("r_bound")
+    charge = store_field("charge")
+    r_vdw = store_field("r_vdw")
+    e_vdw = store_field("e_vdw")
+
     def __init__(self):
+        self.store = None
         self.serial = 0
         self.name = "  X "
         self.altLoc = " "
@@ -56,13 +94,17 @@ class Atom:
         self.connect13 = []
         self.connect14 = []
         self.history = ""
+        self.i = 0    # index in packed atom arrays
         return
 
-    def loadline(self, line):
+    def loadline(self, line, param_cache=None):
+        """Parse a fixed-width ATOM/HETATM line.
+        Parameter lookups are shared through param_cache, a dict keyed by (name, confType), when given.
+        """
         self.serial = int(line[6:11])
-        self.name = line[12:16]
+        self.name = sys.intern(line[12:16])
         self.altLoc = line[16]
-        self.resName = line[17:20]
+        self.resName = sys.intern(line[17:20])
         self.chainID = line[21]
         self.resSeq = int(line[22:26])
         self.iCode = line[26]
@@ -70,23 +112,29 @@ class Atom:
         self.xyz = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
         self.r_bound = float(line[54:62])
         self.charge = float(line[62:74])
-        self.confType = "%3s%2s" % (self.resName, line[80:82])
-        self.history = line[80:].strip()
+        self.confType = sys.intern("%3s%2s" % (self.resName, line[80:82]))
+        self.history = sys.intern(line[80:].strip())
 
         self.atomID = "%4s%3s%04d%c%03d" % (self.name, self.resName, self.resSeq, self.chainID, self.confNum)
         self.confID = "%5s%c%04d%c%03d" % (self.confType, self.chainID, self.resSeq, self.iCode, self.confNum)
         self.resID = "%3s%04d%c" % (self.resName, self.resSeq, self.chainID)
 
         # extended records
-        connect_key = ("CONNECT", self.name, self.confType)
-        self.connectivity_param = env.param[connect_key]
-        radius_key = ("RADIUS", self.confType, self.name)
-        if radius_key in env.param:
-            radius_values = env.param[radius_key]
+        param_key = (self.name, self.confType)
+        if param_cache is not None and param_key in param_cache:
+            self.connectivity_param, radius_values = param_cache[param_key]
+        else:
+            connect_key = ("CONNECT", self.name, self.confType)
+            self.connectivity_param = env.param[connect_key]
+            radius_key = ("RADIUS", self.confType, self.name)
+            radius_values = env.param.get(radius_key)
+            if param_cache is not None:
+                param_cache[param_key] = (self.connectivity_param, radius_values)
+        if radius_values is not None:
             self.r_vdw = radius_values.r_vdw
             self.e_vdw = radius_values.e_vdw
         else: # Use default value as C
-            print("Warning, parameter %s not found, using default values as C" % str(radius_key))
+            print("Warning, parameter %s not found, using default values as C" % str(("RADIUS", self.confType, self.name)))
             self.r_vdw = 1.908
             self.e_vdw = 0.086
         return
@@ -99,9 +147,13 @@ class Atom:
         return line
 
 class Blob:
-    def __init__(self, conf):
+    __slots__ = ("center", "radius")
+
+    def __init__(self, conf=None):
         self.center = (0.0, 0.0, 0.0)
         self.radius = 0.0
+        if conf is None:
+            return
         x = 0.0
         y = 0.0
         z = 0.0
@@ -131,18 +183,40 @@ class Blob:
 
 
 class Conformer:
+    __slots__ = ("confID", "resID", "i", "k", "store", "atom_start", "atom_end", "atom", "vdw0", "vdw1", "crg",
+                 "history", "mark", "iconf", "_blob")
+
     def __init__(self):
         self.confID = ""
         self.resID = ""
         self.i = 0    # index in vdw matrix
+        self.k = -1   # index in AtomStore conformer arrays
+        self.store = None
+        self.atom_start = 0    # atoms of this conformer are [atom_start, atom_end) in packed atom arrays
+        self.atom_end = 0
         self.atom = []
         self.vdw0 = 0.0
         self.vdw1 = 0.0
         self.crg = 0.0
         self.history = ""
         self.mark = ""
+        self.iconf = 0
+        self._blob = None
         return
-    
+
+    @property
+    def blob(self):
+        """Sphere enclosing the conformer, to screen vdw calculation."""
+        if self.store is not None:
+            return self.store.blob(self.k)
+        if self._blob is None:
+            self._blob = Blob(self)
+        return self._blob
+
+    @blob.setter
+    def blob(self, value):
+        self._blob = value
+
     def update_crg(self):
         self.crg = 0.0
         for atom in self.atom:
@@ -150,54 +224,520 @@ class Conformer:
         return
 
 class Residue:
+    __slots__ = ("resID", "conf")
+
     def __init__(self):
         self.resID = ""
         self.conf = []
         return
 
+
+class AtomStore:
+    """Structure of arrays for the atoms and conformers of a Protein, packed in residue and conformer order.
+
+    Atoms of a conformer are the slice [conf.atom_start, conf.atom_end). Attached Atom and Conformer objects are
+    thin views: atom coordinates, radii, charges and epsilons are rows of these arrays, and conformer blobs are
+    computed for all conformers at once.
+    """
+
+    def __init__(self, protein):
+        atoms = []
+        self.confs = []
+        conf_ires = []
+        conf_inres = []
+        lens = []
+        for i_res in range(len(protein.residue)):
+            res = protein.residue[i_res]
+            for i_conf in range(len(res.conf)):
+                conf = res.conf[i_conf]
+                self.confs.append(conf)
+                conf_ires.append(i_res)
+                conf_inres.append(i_conf)
+                lens.append(len(conf.atom))
+                atoms += conf.atom
+        self.atoms = atoms
+
+        self.xyz = np.array([atom.xyz for atom in atoms], dtype=float).reshape((-1, 3))
+        self.r_bound = np.array([atom.r_bound for atom in atoms], dtype=float)
+        self.charge = np.array([atom.charge for atom in atoms], dtype=float)
+        self.r_vdw = np.array([atom.r_vdw for atom in atoms], dtype=float)
+        self.e_vdw = np.array([atom.e_vdw for atom in atoms], dtype=float)
+        self.conf_num = np.array([atom.confNum for atom in atoms], dtype=np.int32)
+
+        lens = np.array(lens, dtype=np.int32)
+        self.conf_end = np.cumsum(lens).astype(np.int32)
+        self.conf_start = self.conf_end - lens
+        self.conf_ires = np.array(conf_ires, dtype=np.int32)    # residue index of each conformer
+        self.conf_inres = np.array(conf_inres, dtype=np.int32)  # index within residue, 0 is backbone
+        self.atom_conf = np.repeat(np.arange(len(self.confs), dtype=np.int32), lens)
+        self.atom_ires = self.conf_ires[self.atom_conf]
+        self.update_blobs()
+
+        # connectivity tables and vdw engine, see Protein.make_connect12/13/14() and Protein.calc_vdw()
+        self.connect12 = None
+        self.connect13 = None
+        self.connect14 = None
+        self.vdw_engine = None
+
+        # attach atoms and conformers as views
+        for i in range(len(atoms)):
+            atom = atoms[i]
+            atom.i = i
+            atom.store = self
+            atom._xyz = atom._r_bound = atom._charge = atom._r_vdw = atom._e_vdw = None
+        for k in range(len(self.confs)):
+            conf = self.confs[k]
+            conf.k = k
+            conf.store = self
+            conf.atom_start = int(self.conf_start[k])
+            conf.atom_end = int(self.conf_end[k])
+            conf._blob = None
+        return
+
+    def update_blobs(self):
+        """Center and radius of every conformer blob, same as Blob()."""
+        n_conf = len(self.confs)
+        self.conf_center = np.zeros((n_conf, 3))
+        self.conf_radius = np.zeros(n_conf)
+        lens = self.conf_end - self.conf_start
+        filled = lens > 0
+        if filled.any():
+            starts = self.conf_start[filled]
+            self.conf_center[filled] = np.add.reduceat(self.xyz, starts, axis=0) / lens[filled, np.newaxis]
+            d2 = ((self.xyz - self.conf_center[self.atom_conf]) ** 2).sum(axis=1)
+            self.conf_radius[filled] = np.sqrt(np.maximum.reduceat(d2, starts)) + np.maximum.reduceat(self.r_vdw,
+                                                                                                     starts)
+        self.blob_index = BlobIndex(self.conf_center, self.conf_radius)   # spatial index of conformer blobs
+        return
+
+    def blob(self, k):
+        blob = Blob()
+        blob.center = tuple(self.conf_center[k].tolist())
+        blob.radius = float(self.conf_radius[k])
+        return blob
+
+    def conf_crg(self):
+        """Net charge of every conformer."""
+        crg = np.zeros(len(self.confs))
+        np.add.at(crg, self.atom_conf, self.charge)
+        return crg
+
+    def nbytes(self):
+        return sum([x.nbytes for x in vars(self).values() if isinstance(x, np.ndarray)])
+
+
+def share_arrays(arrays):
+    """Copy a dictionary of numpy arrays into a new shared memory block.
+    Return the block and its layout, a picklable list that attach_arrays() takes in another process."""
+    layout = []
+    size = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout.append((name, array.dtype.str, array.shape, size))
+        size += (array.nbytes + 7) // 8 * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 8))
+    for name, dtype, shape, offset in layout:
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = arrays[name]
+    return shm, layout
+
+
+def attach_arrays(shm, layout):
+    """Dictionary of the arrays in a shared memory block made by share_arrays(), without copying."""
+    arrays = {}
+    for name, dtype, shape, offset in layout:
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+    return arrays
+
+
+def vdw_in_range(delta, d2):
+    """Atom pairs vdw_atom() evaluates: every coordinate difference below VDW_CUTOFF_FAR, and d2 in VDW_CUTOFF_FAR2."""
+    return np.all(delta < VDW_CUTOFF_FAR, axis=-1) & (d2 <= VDW_CUTOFF_FAR2)
+
+
+def vdw_lj(d2, sig_min, eps, scale):
+    """vdw_atom() as arrays for atom pairs in range and not excluded."""
+    p_lj = np.full(len(d2), 999.0)
+    lj = d2 >= VDW_CUTOFF_NEAR2
+    sig_d2 = sig_min[lj] * sig_min[lj] / d2[lj]
+    sig_d6 = sig_d2 * sig_d2 * sig_d2
+    sig_d12 = sig_d6 * sig_d6
+    p_lj[lj] = scale[lj] * (eps[lj] * sig_d12 - 2. * eps[lj] * sig_d6)
+    return p_lj
+
+
+class VdwEngine:
+    """Vectorized vdw calculation over the packed arrays of an AtomStore.
+
+    Connectivity comes from the store's CSR tables, so the 1-2/1-3 exclusion and 1-4 scaling of a conformer can be
+    sliced out and applied as masks to a whole block of atom pairs.
+    The rules are the same as vdw_conf() and vdw_atom().
+    All the engine reads is the numpy arrays named in ARRAYS, so share() can put them in one shared memory block
+    and worker processes attach() to it instead of receiving a copy of the Protein.
+    """
+    ARRAYS = ("xyz", "r_vdw", "e_vdw", "conf_center", "conf_radius", "start", "end", "ires", "conf_i", "backbone",
+              "sidechain", "excl_indptr", "excl_j", "scale14_indptr", "scale14_j")
+
+    def __init__(self, store=None, arrays=None):
+        self.confs = None   # Conformer objects, only in the process that owns the store
+        if arrays is None:
+            arrays = {}
+            n_atom = len(store.r_vdw)
+            excl = ConnectTable(identity(n_atom, dtype=np.int8, format="csr") + store.connect12.matrix()
+                                + store.connect13.matrix())
+            arrays["excl_indptr"], arrays["excl_j"] = excl.indptr, excl.indices
+            arrays["scale14_indptr"], arrays["scale14_j"] = store.connect14.indptr, store.connect14.indices
+            for name in ("xyz", "r_vdw", "e_vdw", "conf_center", "conf_radius"):
+                arrays[name] = getattr(store, name)
+
+            # conformer arrays
+            self.confs = store.confs
+            arrays["ires"] = store.conf_ires
+            arrays["start"] = store.conf_start
+            arrays["end"] = store.conf_end
+            arrays["conf_i"] = np.array([conf.i for conf in self.confs], dtype=int)
+            arrays["backbone"] = np.nonzero(store.conf_inres == 0)[0]
+            arrays["sidechain"] = np.nonzero(store.conf_inres != 0)[0]
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.is_sidechain = np.zeros(len(self.start), dtype=bool)
+        self.is_sidechain[self.sidechain] = True
+        self.blob_index = BlobIndex(self.conf_center, self.conf_radius)
+
+        self.pos = np.full(len(self.r_vdw), -1, dtype=int)   # scratch map from packed atom index to block column
+        return
+
+    def share(self):
+        """Copy the engine arrays into a new shared memory block. Return the block and the layout for attach().
+        The caller closes and unlinks the block."""
+        return share_arrays(dict([(name, getattr(self, name)) for name in self.ARRAYS]))
+
+    @staticmethod
+    def attach(shm, layout):
+        """Engine reading the arrays of a shared memory block made by share()."""
+        return VdwEngine(arrays=attach_arrays(shm, layout))
+
+    def vdw_rows(self, ks1, verbose=False, symmetric=False, evaluated=None):
+        """vdw of side chain conformers ks1 as Protein.calc_vdw() reports them.
+        Return (ks1, vdw0, vdw1, rows, cols, values), where rows, cols and values are the nonzero vdw_pw entries,
+        indexed by conf.i. In symmetric mode each value is written to both sides, and a pair of two conformers that
+        are both evaluated, given by the boolean mask evaluated over all conformers and by default all side chain
+        conformers, is only done by the first one.
+        """
+        ks1 = np.asarray(ks1, dtype=int)
+        if evaluated is None:
+            evaluated = self.is_sidechain
+        vdw0 = np.zeros(len(ks1))
+        vdw1 = np.zeros(len(ks1))
+        rows = []
+        cols = []
+        values = []
+        for n in range(len(ks1)):
+            k1 = ks1[n]
+            if verbose and self.confs is not None:
+                print("   vdw - %s ..." % self.confs[k1].confID)
+
+            # itself, side chain conformers of other residues and backbone pieces, as far as their blobs are in reach
+            near = self.blob_index.neighbors(k1)
+            others = near[self.is_sidechain[near] & (self.ires[near] != self.ires[k1])]
+            if symmetric:
+                others = others[~evaluated[others] | (others > k1)]
+            ks2 = np.concatenate(([k1], others, near[~self.is_sidechain[near]]))
+            vdw = self.vdw_to(k1, ks2)
+
+            # vdw0, self to self vdw
+            vdw0[n] = vdw[0]
+            if abs(vdw[0]) > 0.001:
+                rows.append([self.conf_i[k1]])
+                cols.append([self.conf_i[k1]])
+                values.append(vdw[:1])
+
+            vdw_pw = vdw[1:len(others) + 1]
+            reported = np.abs(vdw_pw) > 0.001
+            if reported.any():
+                i2 = self.conf_i[others[reported]]
+                i1 = np.full(len(i2), self.conf_i[k1])
+                rows.append(i1)
+                cols.append(i2)
+                values.append(vdw_pw[reported])
+                if symmetric:
+                    rows.append(i2)
+                    cols.append(i1)
+                    values.append(vdw_pw[reported])
+
+            # vdw1, vdw to all backbone
+            vdw1[n] = vdw[len(others) + 1:].sum()
+
+        if values:
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            values = np.concatenate(values)
+        else:
+            rows = cols = np.zeros(0, dtype=int)
+            values = np.zeros(0)
+        return ks1, vdw0, vdw1, rows, cols, values
+
+    def block_mask(self, indptr, cols_j, s1, e1, n_cols):
+        """Mark pairs of atoms [s1, e1) to atoms listed in self.pos as a boolean block."""
+        mask = np.zeros((e1 - s1, n_cols), dtype=bool)
+        a = indptr[s1]
+        b = indptr[e1]
+        rows = np.repeat(np.arange(e1 - s1), np.diff(indptr[s1:e1 + 1]))
+        cols = self.pos[cols_j[a:b]]
+        selected = cols >= 0
+        mask[rows[selected], cols[selected]] = True
+        return mask
+
+    def vdw_to(self, k1, ks2):
+        """Return vdw between packed conformer k1 and each packed conformer in ks2."""
+        vdw = np.zeros(len(ks2))
+        s1 = self.start[k1]
+        e1 = self.end[k1]
+        if s1 == e1 or len(ks2) == 0:
+            return vdw
+
+        # conformer blob screening
+        d = np.sqrt(((self.conf_center[ks2] - self.conf_center[k1]) ** 2).sum(axis=1))
+        near = np.nonzero((d <= self.conf_radius[ks2] + 6 + self.conf_radius[k1]) & (self.end[ks2] > self.start[ks2]))[0]
+        if len(near) == 0:
+            return vdw
+        starts = self.start[ks2[near]]
+        lens = self.end[ks2[near]] - starts
+        offsets = np.concatenate(([0], np.cumsum(lens)[:-1]))
+        atoms2 = np.repeat(starts - offsets, lens) + np.arange(lens.sum())
+
+        # atom pair block
+        delta = self.xyz[s1:e1, np.newaxis, :] - self.xyz[np.newaxis, atoms2, :]
+        d2 = (delta * delta).sum(axis=2)
+        in_range = vdw_in_range(delta, d2)
+
+        self.pos[atoms2] = np.arange(len(atoms2))
+        excluded = self.block_mask(self.excl_indptr, self.excl_j, s1, e1, len(atoms2))
+        scaled14 = self.block_mask(self.scale14_indptr, self.scale14_j, s1, e1, len(atoms2))
+        self.pos[atoms2] = -1
+        in_range &= ~excluded
+
+        p_lj = np.zeros(d2.shape)
+        i1, i2 = np.nonzero(in_range)
+        sig_min = self.r_vdw[s1 + i1] + self.r_vdw[atoms2[i2]]
+        eps = np.sqrt(self.e_vdw[s1 + i1] * self.e_vdw[atoms2[i2]])
+        scale = np.where(scaled14[i1, i2], VDW_SCALE14, 1.0)
+        p_lj[i1, i2] = vdw_lj(d2[i1, i2], sig_min, eps, scale)
+
+        # sum up by conformer
+        vdw_near = np.add.reduceat(p_lj.sum(axis=0), offsets)
+        vdw_near[vdw_near >= VDW_UPLIMIT] = 999.0
+        vdw[near] = vdw_near
+        vdw[ks2 == k1] *= 0.5
+        return vdw
+
+
+vdw_worker = None   # (shared memory block, VdwEngine) of a calc_vdw worker process
+
+
+def vdw_worker_init(name, layout):
+    global vdw_worker
+    shm = shared_memory.SharedMemory(name=name)
+    vdw_worker = (shm, VdwEngine.attach(shm, layout))
+
+
+def vdw_worker_rows(shard):
+    ks1, symmetric, evaluated = shard
+    return vdw_worker[1].vdw_rows(ks1, symmetric=symmetric, evaluated=evaluated)
+
+
+class ConnectTable:
+    """Connectivity of one order over packed atom indices, in CSR form.
+
+    Atoms connected to atom i are indices[indptr[i]:indptr[i+1]], sorted, so a pair lookup is a search in a row
+    of bounded length, and whole tables can be combined as sparse matrices.
+    """
+
+    def __init__(self, matrix):
+        matrix = csr_matrix(matrix)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        self.n = matrix.shape[0]
+        self.indptr = matrix.indptr.astype(np.int32)
+        self.indices = matrix.indices.astype(np.int32)
+        return
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def has(self, i, j):
+        row = self.indices[self.indptr[i]:self.indptr[i + 1]]
+        k = np.searchsorted(row, j)
+        return k < len(row) and row[k] == j
+
+    def matrix(self):
+        return csr_matrix((np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr),
+                          shape=(self.n, self.n))
+
+
+def lists2table(atoms, attr):
+    """Make a ConnectTable from the connect list attribute attr of packed atoms."""
+    rows = []
+    cols = []
+    for atom in atoms:
+        for atom2 in getattr(atom, attr):
+            rows.append(atom.i)
+            cols.append(atom2.i)
+    return ConnectTable(csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(atoms), len(atoms))))
+
+
+class ConnectView:
+    """Read only, list like view of one atom's row in a ConnectTable. It replaces the Atom.connect12/13/14 lists
+    after the tables are made, so existing code can iterate and test membership as before."""
+    __slots__ = ("table", "i", "atoms")
+
+    def __init__(self, table, i, atoms):
+        self.table = table
+        self.i = i
+        self.atoms = atoms
+
+    def __iter__(self):
+        for j in self.table.row(self.i):
+            yield self.atoms[j]
+
+    def __len__(self):
+        return int(self.table.indptr[self.i + 1] - self.table.indptr[self.i])
+
+    def __getitem__(self, k):
+        return [self.atoms[j] for j in self.table.row(self.i)][k]
+
+    def __contains__(self, atom):
+        return 0 <= atom.i < len(self.atoms) and self.atoms[atom.i] is atom and self.table.has(self.i, atom.i)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+
+class CellList:
+    """Uniform grid (cell list) index over coordinates.
+
+    Points are binned into cubic cells. A query returns the indices of points in the cells overlapping a sphere,
+    in ascending index order. This is a superset of the points within the distance, the caller does the exact test.
+    """
+
+    def __init__(self, xyz, cell_size):
+        self.cell_size = max(cell_size, 0.1)
+        self.cells = {}
+        keys = np.floor(np.asarray(xyz, dtype=float).reshape((-1, 3)) / self.cell_size).astype(int).tolist()
+        for i, key in enumerate(keys):
+            key = tuple(key)
+            if key in self.cells:
+                self.cells[key].append(i)
+            else:
+                self.cells[key] = [i]
+        return
+
+    def query(self, xyz, r):
+        lo = [int(math.floor((x - r) / self.cell_size)) for x in xyz]
+        hi = [int(math.floor((x + r) / self.cell_size)) for x in xyz]
+        found = []
+        for ix in range(lo[0], hi[0] + 1):
+            for iy in range(lo[1], hi[1] + 1):
+                for iz in range(lo[2], hi[2] + 1):
+                    cell = self.cells.get((ix, iy, iz))
+                    if cell:
+                        found += cell
+        found.sort()
+        return found
+
+
+class BlobIndex:
+    """Cell list over conformer blob centers.
+
+    neighbors() returns the conformers whose blob comes within a margin of the blob of a conformer,
+    d <= r1 + margin + r2, visiting only the cells around it. The default margin is the vdw screening distance.
+    """
+
+    def __init__(self, center, radius, margin=6.0):
+        self.center = center
+        self.radius = radius
+        if len(radius):
+            self.r_max = float(radius.max())
+        else:
+            self.r_max = 0.0
+        self.grid = CellList(center, 2 * self.r_max + margin)
+        return
+
+    def neighbors(self, k, margin=6.0):
+        """Sorted conformer indices near conformer k, including k itself."""
+        ks = np.array(self.grid.query(self.center[k], self.radius[k] + margin + self.r_max), dtype=int)
+        d = np.sqrt(((self.center[ks] - self.center[k]) ** 2).sum(axis=1))
+        return ks[d <= self.radius[ks] + margin + self.radius[k]]
+
+    def near(self, k1, k2, margin=6.0):
+        d = np.sqrt(((self.center[k1] - self.center[k2]) ** 2).sum())
+        return d <= self.radius[k1] + margin + self.radius[k2]
+
+
 class Protein:
     def __init__(self):
         self.residue = []
         self.vdw_pw = []  # place holder, will be a 2D matrix
+        self.atoms = []   # all atoms in residue and conformer order, see index_atoms()
+        self.store = None   # AtomStore of self.atoms, see index_atoms()
+        self.atom_grid = None   # cell list index of self.atoms, see make_atom_grid()
+        self.connect12 = None   # ConnectTable of each connectivity order, see make_connect12/13/14()
+        self.connect13 = None
+        self.connect14 = None
         return
 
+    def index_atoms(self):
+        """Number atoms and conformers in residue and conformer order, and pack them into an AtomStore.
+        Connectivity tables are made again after this.
+        """
+        self.store = AtomStore(self)
+        self.atoms = self.store.atoms
+        return self.atoms
+
+    def make_atom_grid(self):
+        """Build the cell list over all atoms. The cell edge is the longest possible bond distance."""
+        if self.store is None:
+            self.index_atoms()
+        if self.atoms:
+            r_max = self.store.r_vdw.max()
+        else:
+            r_max = 0.0
+        self.atom_grid = CellList(self.store.xyz, 2 * r_max * BONDDISTANCE_scaling)
+        return self.atom_grid
+
     def loadpdb(self, fname):
-        rawlines = open(fname).readlines()
-        lines = [x.strip("\n") for x in rawlines if x[:6] == "ATOM  " or x[:6] == "HETATM"]
-        for line in lines:
-            atom = Atom()
-            atom.loadline(line)
-            # reverse search if this atom belongs to an existing conformer and residue
-            found_conf = False
-            found_res = False
-            for i_res in range(len(self.residue) - 1, -1, -1):
-                insert_res = i_res
-                for i_conf in range(len(self.residue[i_res].conf) - 1, -1, -1):
-                    if self.residue[i_res].conf[i_conf].confID == atom.confID:
-                        found_conf = True
-                        self.residue[i_res].conf[i_conf].atom.append(atom)
-                        break
-                if found_conf:
-                    break
-                elif self.residue[i_res].resID == atom.resID:  # not in conf but residue ID matches
+        # Single pass over the file. Conformers and residues are indexed by confID and resID: an atom is appended to
+        # the conformer with its confID, otherwise it starts a new conformer in the residue with its resID, otherwise
+        # it starts a new residue. Residues and conformers keep the order of their first atom in the file.
+        res_byid = {}
+        conf_byid = {}
+        for res in self.residue:
+            res_byid[res.resID] = res
+            for conf in res.conf:
+                conf_byid[conf.confID] = conf
+        param_cache = {}
+
+        with open(fname) as fh:
+            for line in fh:
+                if line[:6] != "ATOM  " and line[:6] != "HETATM":
+                    continue
+                atom = Atom()
+                atom.loadline(line.strip("\n"), param_cache)
+                conf = conf_byid.get(atom.confID)
+                if conf is None:
                     conf = Conformer()
                     conf.confID = atom.confID
                     conf.resID = atom.resID
                     conf.history = atom.history
-                    conf.atom.append(atom)
-                    self.residue[i_res].conf.append(conf)
-                    found_res = True
-
-            if not found_conf and not found_res:  # new residue
-                conf = Conformer()
-                conf.confID = atom.confID
-                conf.resID = atom.resID
-                conf.history = atom.history
+                    conf_byid[conf.confID] = conf
+                    res = res_byid.get(atom.resID)
+                    if res is None:  # new residue
+                        res = Residue()
+                        res.resID = conf.resID
+                        res_byid[res.resID] = res
+                        self.residue.append(res)
+                    res.conf.append(conf)
                 conf.atom.append(atom)
-                res = Residue()
-                res.resID = conf.resID
-                res.conf.append(conf)
-                self.residue.append(res)
 
         # Insert an empty conformer for cofactors that do not have backbone
         for res in self.residue:
@@ -219,12 +759,10 @@ class Protein:
 
         # Create a 2D VDW array that will be referenced by indices
         #self.vdw_pw = np.zeros((n_conf, n_conf))
-        self.vdw_pw = lil_matrix((n_conf, n_conf))
+        self.vdw_pw = csr_matrix((n_conf, n_conf))
 
-        # Create a blob of conformer to screen vdw calculation
-        for res in self.residue:
-            for conf in res.conf:
-                conf.blob = Blob(conf)
+        # Pack atoms into arrays, this also creates the blob of conformer to screen vdw calculation
+        self.index_atoms()
         return
 
     def make_connect12(self):
@@ -235,6 +773,22 @@ class Protein:
         #    if ligated, search only residue before and after
         #    if connected atom is missing (CA), search residue before and after in case it is terminal residue
         #    all side chain conformers
+        # Distance based searches go through the atom cell list, only atoms in neighboring cells are tested.
+
+        self.make_atom_grid()
+        for atom in self.atoms:
+            atom.connect12 = []
+        n_res = len(self.residue)
+        atom_ires = self.store.atom_ires.tolist()    # residue index of each atom
+        atom_iconf = self.store.conf_inres[self.store.atom_conf].tolist()   # conformer index within residue, 0 is backbone
+        ligated = []      # atom has a ligand bond
+        for atom in self.atoms:
+            connected_atoms = env.param[("CONNECT", atom.name, atom.confType)].connected
+            ligated.append(any(["?" in x for x in connected_atoms]))
+        if self.atoms:
+            r_max = self.store.r_vdw.max()
+        else:
+            r_max = 0.0
 
         for i_res in range(len(self.residue)):
             res = self.residue[i_res]
@@ -245,59 +799,34 @@ class Protein:
                     for c_atom in connected_atoms:
                         found = False
                         if "?" in c_atom:  # ligated
-                            for res2 in self.residue:
-                                if res != res2:
-                                    for conf2 in res2.conf:
-                                        for atom2 in conf2.atom:
-                                            connect_key2 = ("CONNECT", atom2.name, atom2.confType)
-                                            connected_atoms2 = env.param[connect_key2].connected
-                                            ligated2 = False
-                                            for ligated_atom2 in connected_atoms2:
-                                                if "?" in ligated_atom2:
-                                                    ligated2 = True
-                                                    break
-                                            if ligated2:
-                                                r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
-                                                CUTOFF2 = r * r
-                                                # if " C  " in atom.atomID:
-                                                #     print("%s <-> %s: d=%.3f cut=%.3f" % (atom.atomID, atom2.atomID, math.sqrt(ddvv(atom.xyz, atom2.xyz)), math.sqrt(CUTOFF2)))
-                                                #     print(atom2.atomID, [x.atomID for x in atom.connect12])
-                                                #     print("Here", found)
-                                                if ddvv(atom.xyz, atom2.xyz) < CUTOFF2:
-                                                    if atom2 not in atom.connect12:
-                                                        atom.connect12.append(atom2)
-                                                        found = True  # after ligand found, do not break, continue to search other conformers within residue
-
-                                    if found:   # one "?" for one ligand
-                                        # print(conf.confID, atom.atomID, c_atom, res2.resID)
-                                        break
+                            # the first other residue that has ligated atoms within bond distance
+                            r_query = (atom.r_vdw + r_max) * BONDDISTANCE_scaling
+                            ligand_atoms = []
+                            for i_atom2 in self.atom_grid.query(atom.xyz, r_query):
+                                atom2 = self.atoms[i_atom2]
+                                if atom_ires[i_atom2] == i_res or not ligated[i_atom2]:
+                                    continue
+                                r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
+                                CUTOFF2 = r * r
+                                if ddvv(atom.xyz, atom2.xyz) < CUTOFF2 and atom2 not in atom.connect12:
+                                    ligand_atoms.append(i_atom2)
+                            if ligand_atoms:
+                                ligand_ires = min([atom_ires[i] for i in ligand_atoms])
+                                for i_atom2 in ligand_atoms:
+                                    # after ligand found, do not break, continue to search other conformers within residue
+                                    if atom_ires[i_atom2] == ligand_ires:
+                                        atom.connect12.append(self.atoms[i_atom2])
+                                        found = True
 
                             if not found and res.resID[:3] == "NTR" and atom.name == " CA ":   # NTR CA connects to CB of next residue
-                                res2 = self.residue[i_res+1]
-                                # find " CB "
-                                found = False
-                                for conf2 in res2.conf[1:]:
-                                    for atom2 in conf2.atom:
-                                        if atom2.name == " CB ":
-                                            r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
-                                            CUTOFF2 = r * r
-                                            if ddvv(atom.xyz, atom2.xyz) < CUTOFF2:
-                                                if atom2 not in atom.connect12:
-                                                    atom.connect12.append(atom2)
-                                                    found = True
+                                # find " CB " in side chain conformers
+                                found = self.connect_nearby(atom, " CB ", i_res + 1, atom_ires, atom_iconf,
+                                                            sidechain=True)
 
                             if not found and res.resID[:3] == "CTR" and atom.name == " C  ":   # CTR C connects to CA of previous atom
-                                res2 = self.residue[i_res-1]
-                                # find " CA "
-                                found = False
-                                for atom2 in res2.conf[0].atom:
-                                    if atom2.name == " CA ":
-                                        r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
-                                        CUTOFF2 = r * r
-                                        if ddvv(atom.xyz, atom2.xyz) < CUTOFF2:
-                                            if atom2 not in atom.connect12:
-                                                atom.connect12.append(atom2)
-                                                found = True
+                                # find " CA " in backbone
+                                found = self.connect_nearby(atom, " CA ", (i_res - 1) % n_res, atom_ires, atom_iconf,
+                                                            backbone=True)
 
                             if not found:  # no actual CTR case
                                 if atom.name == " C  ":
@@ -356,23 +885,47 @@ class Protein:
                             # 6) " CB " connects to " CA " of NTR case
                             if not found:
                                 if atom.name == " CB " and c_atom == " CA ":
-                                    res2 = self.residue[i_res - 1]
-                                    for conf2 in res2.conf:
-                                        for atom2 in conf2.atom:
-                                            if atom2.name == " CA ":
-                                                r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
-                                                CUTOFF2 = r * r
-                                                if ddvv(atom.xyz, atom2.xyz) < CUTOFF2:
-                                                    if atom2 not in atom.connect12:
-                                                        atom.connect12.append(atom2)
-                                                        found = True
-                                                        break
+                                    found = self.connect_nearby(atom, " CA ", (i_res - 1) % n_res, atom_ires,
+                                                                atom_iconf, first_per_conf=True)
 
                             if not found:
                                 print("Warning: Atom \"%s\" bond to \"%s\" was not found" % (c_atom, atom.atomID))
 
+        self.connect12 = self.store.connect12 = lists2table(self.atoms, "connect12")
+        self.set_connect_views(self.connect12, "connect12")
         return
 
+    def set_connect_views(self, table, attr):
+        self.store.vdw_engine = None
+        for atom in self.atoms:
+            setattr(atom, attr, ConnectView(table, atom.i, self.atoms))
+        return
+
+    def connect_nearby(self, atom, name, i_res2, atom_ires, atom_iconf, backbone=False, sidechain=False,
+                       first_per_conf=False):
+        """Connect atom to atoms named name in residue i_res2 within bond distance, searched by the cell list.
+        Return True if any atom was connected.
+        """
+        found = False
+        connected_confs = set()
+        r_max = atom.r_vdw + self.store.r_vdw.max()
+        for i_atom2 in self.atom_grid.query(atom.xyz, r_max * BONDDISTANCE_scaling):
+            atom2 = self.atoms[i_atom2]
+            if atom_ires[i_atom2] != i_res2 or atom2.name != name:
+                continue
+            if (backbone and atom_iconf[i_atom2] != 0) or (sidechain and atom_iconf[i_atom2] == 0):
+                continue
+            if first_per_conf and atom_iconf[i_atom2] in connected_confs:
+                continue
+            r = (atom.r_vdw + atom2.r_vdw) * BONDDISTANCE_scaling
+            CUTOFF2 = r * r
+            if ddvv(atom.xyz, atom2.xyz) < CUTOFF2:
+                if atom2 not in atom.connect12:
+                    atom.connect12.append(atom2)
+                    connected_confs.add(atom_iconf[i_atom2])
+                    found = True
+        return found
+
     def print_connect12(self):
         for res in self.residue:
             for conf in res.conf:
@@ -383,30 +936,29 @@ class Protein:
         return
 
     def make_connect13(self):
-        for res in self.residue:
-            for conf in res.conf:
-                for atom in conf.atom:
-                    for atom2 in atom.connect12:
-                        if atom2 != atom:
-                            for atom3 in atom2.connect12:
-                                if (atom3 != atom) and (atom3 not in atom.connect12) and (atom3 not in atom.connect13):
-                                    atom.connect13.append(atom3)
-                        else:
-                            print("Warning: Atom \"%s\" has itself in connect12." % atom.atomID)
+        # atoms connected to connect12 atoms, excluding itself and its connect12 atoms
+        n_atom = len(self.atoms)
+        m12 = self.connect12.matrix()
+        for i in np.nonzero(m12.diagonal())[0]:
+            print("Warning: Atom \"%s\" has itself in connect12." % self.atoms[i].atomID)
+        m12_noself = m12 - identity(n_atom, dtype=np.int8, format="csr").multiply(m12)
+        m13 = (m12_noself.astype(np.int32) @ m12.astype(np.int32)) != 0
+        m13 = m13.astype(np.int8) - m13.multiply(m12 != 0).astype(np.int8)
+        m13.setdiag(0)
+        self.connect13 = self.store.connect13 = ConnectTable(m13)
+        self.set_connect_views(self.connect13, "connect13")
         return
 
     def make_connect14(self):
-        for res in self.residue:
-            for conf in res.conf:
-                for atom in conf.atom:
-                    for atom3 in atom.connect13:
-                        if atom3 == atom: continue
-                        for atom4 in atom3.connect12:
-                            if (atom4 != atom) \
-                                    and (atom4 not in atom.connect12) \
-                                    and (atom4 not in atom.connect13) \
-                                    and (atom4 not in atom.connect14):
-                                atom.connect14.append(atom4)
+        # atoms connected to connect13 atoms, excluding itself, its connect12 and connect13 atoms
+        n_atom = len(self.atoms)
+        m12 = self.connect12.matrix()
+        m13 = self.connect13.matrix()
+        m14 = (m13.astype(np.int32) @ m12.astype(np.int32)) != 0
+        m14 = m14.astype(np.int8) - m14.multiply((m12 + m13) != 0).astype(np.int8)
+        m14.setdiag(0)
+        self.connect14 = self.store.connect14 = ConnectTable(m14)
+        self.set_connect_views(self.connect14, "connect14")
         return
 
     def print_connect13(self):
@@ -445,44 +997,49 @@ class Protein:
                     print("---->Atom %s" % atom.atomID)
         return
 
-    def calc_vdw(self, verbose=False):
-        # do it on two sides so the two-way interaction numbers can be checked
-        for res1 in self.residue:
-
-            if len(res1.conf) <= 1:
-                continue    # only backbone
-            for conf1 in res1.conf[1:]:
-                if verbose:
-                    print("   vdw - %s ..." % conf1.confID)
-                saved_time = time.time()
-
-                # compute vdw0
-                conf1.vdw0 = vdw_conf(conf1, conf1)
-
-                for res2 in self.residue:
-                    if len(res2.conf) == 1:
-                        continue  # only backbone
-                    if res1 == res2: # we need to do self to self vdw - vdw0
-                        vdw = vdw_conf(conf1, conf1)
-                        if abs(vdw) > 0.001:
-                            self.vdw_pw[conf1.i, conf1.i] = vdw
-                        continue
-                    for conf2 in res2.conf[1:]:
-                        vdw = vdw_conf(conf1, conf2)
-                        if abs(vdw) > 0.001:
-                            #print("%s - %s: %.3f" % (conf1.confID, conf2.confID, vdw))
-                            self.vdw_pw[conf1.i, conf2.i] = vdw
-
-
-                # compute vdw1, vdw to all backbone
-                vdw1 = 0.0
-                for res2 in self.residue:
-                    conf2 = res2.conf[0]
-                    vdw = vdw_conf(conf1, conf2)
-                    vdw1 += vdw
-                conf1.vdw1 = vdw1
-                elapsed = time.time() - saved_time
-                #print("   %s ... %.3f seconds" % (conf1.confID, elapsed))
+    def calc_vdw(self, verbose=False, processes=1, symmetric=True, confs=None):
+        # Each conformer is evaluated against itself, side chain conformers of other residues and all backbone
+        # pieces in one vectorized block, see VdwEngine.
+        # symmetric evaluates a conformer pair once and mirrors it, otherwise it is done on two sides so the two-way
+        # interaction numbers can be checked.
+        # With more than one process, side chain conformers are dealt out to worker processes that read the engine
+        # arrays from shared memory and send back sparse vdw_pw entries.
+        # confs limits the calculation to a list of side chain conformers. vdw_pw then only has their rows, and in
+        # symmetric mode their columns too, and vdw0/vdw1 of the other conformers are left as they are.
+        engine = self.store.vdw_engine = VdwEngine(self.store)
+        if confs is None:
+            ks1 = engine.sidechain
+            evaluated = None
+        else:
+            ks1 = np.array(sorted([conf.k for conf in confs]), dtype=int)
+            evaluated = np.zeros(len(engine.start), dtype=bool)
+            evaluated[ks1] = True
+
+        if processes > 1 and len(ks1) > 1:
+            n_shards = min(len(ks1), processes * 4)
+            # interleaved to balance the load, symmetric mode has fewer pairs for later conformers
+            shards = [(ks1[i::n_shards], symmetric, evaluated) for i in range(n_shards)]
+            shm, layout = engine.share()
+            try:
+                with multiprocessing.Pool(processes, initializer=vdw_worker_init, initargs=(shm.name, layout)) as pool:
+                    results = pool.map(vdw_worker_rows, shards)
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            results = [engine.vdw_rows(ks1, verbose=verbose, symmetric=symmetric, evaluated=evaluated)]
+
+        for ks1, vdw0, vdw1, rows, cols, values in results:
+            for n in range(len(ks1)):
+                conf1 = engine.confs[ks1[n]]
+                conf1.vdw0 = float(vdw0[n])   # self to self vdw
+                conf1.vdw1 = float(vdw1[n])   # vdw to all backbone
+
+        # merge the sparse entries of all shards
+        rows = np.concatenate([result[3] for result in results])
+        cols = np.concatenate([result[4] for result in results])
+        values = np.concatenate([result[5] for result in results])
+        self.vdw_pw = coo_matrix((values, (rows, cols)), shape=self.vdw_pw.shape).tocsr()
 
     def connect_reciprocity_check(self):
         # connectivity should be reciprocal except backbone atoms
@@ -503,17 +1060,35 @@ class Protein:
                         if atom not in atom2.connect14:
                             print("Atom %s in connect14 of atom %s but the other way is not true" % (atom2.atomID, atom.atomID))
 
-    def vdw_reciprocity_check(self):
-        for key, value in self.vdw_pw.items():
-            r_key = (key[1], key[0])
-            if r_key in self.vdw_pw:
-                r_value = self.vdw_pw[r_key]
-                if abs(value - r_value) > 0.001:
-                    print("vdw(%s<->%s = %.3f <-> %.3f" % (key[0], key[1], value, r_value))
-            else:
-                print("vdw(%s->%s = %.3f but other way not reported" % (key[0], key[1], value))
-
-        print("VDW two sides checked.")
+    def vdw_reciprocity_check(self, n_sample=1000, seed=None):
+        """Debug check of calc_vdw(). Recompute both sides of up to n_sample reported conformer pairs and compare
+        them with each other and with vdw_pw. Give n_sample=0 to check all reported pairs."""
+        engine = self.store.vdw_engine
+        if engine is None:
+            engine = self.store.vdw_engine = VdwEngine(self.store)
+        k_of_i = {}
+        for k in engine.sidechain:
+            k_of_i[engine.conf_i[k]] = k
+
+        pw = self.vdw_pw.tocoo()
+        pairs = np.nonzero(pw.row != pw.col)[0]
+        if 0 < n_sample < len(pairs):
+            pairs = np.random.default_rng(seed).choice(pairs, n_sample, replace=False)
+        for n in pairs:
+            i1 = pw.row[n]
+            i2 = pw.col[n]
+            k1 = k_of_i[i1]
+            k2 = k_of_i[i2]
+            value = engine.vdw_to(k1, np.array([k2]))[0]
+            r_value = engine.vdw_to(k2, np.array([k1]))[0]
+            if abs(value - r_value) > 0.001:
+                print("vdw(%s<->%s = %.3f <-> %.3f" % (engine.confs[k1].confID, engine.confs[k2].confID, value,
+                                                      r_value))
+            if abs(pw.data[n] - value) > 0.001:
+                print("vdw(%s->%s = %.3f but %.3f is reported" % (engine.confs[k1].confID, engine.confs[k2].confID,
+                                                                 value, pw.data[n]))
+
+        print("VDW two sides checked on %d pairs." % len(pairs))
         return
 
     def print_confindex(self):
@@ -525,9 +1100,14 @@ class Protein:
         return
     
     def update_confcrg(self):
-        for res in self.residue:
-            for conf in res.conf:
-                conf.update_crg()
+        if self.store is None:
+            for res in self.residue:
+                for conf in res.conf:
+                    conf.update_crg()
+        else:
+            crg = self.store.conf_crg().tolist()
+            for k in range(len(crg)):
+                self.store.confs[k].crg = crg[k]
         return
 
 class CONNECT_param:
@@ -555,6 +1135,24 @@ class CONFORMER_param:
             self.param[key] = value
 
 
+def intern_strings(value):
+    """Copy of nested tuples, lists and dicts with interned strings, so that pickle stores each string once."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    elif isinstance(value, tuple):
+        return tuple([intern_strings(x) for x in value])
+    elif isinstance(value, list):
+        return [intern_strings(x) for x in value]
+    elif isinstance(value, dict):
+        return {intern_strings(k): intern_strings(v) for k, v in value.items()}
+    return value
+
+
+FTPL_PARAM_CLASSES = {"CONNECT_param": CONNECT_param, "RADIUS_param": RADIUS_param,
+                      "CONFORMER_param": CONFORMER_param}
+FTPL_CACHE_VERSION = 1   # change when the parsed parameter format changes
+
+
 class ENV:
     def __init__(self):
         self.runprm = {}
@@ -614,25 +1212,122 @@ class ENV:
             elif key1 == "CONFORMER":
                 self.param[(key1, key2)] = CONFORMER_param(value_string)
 
-    def load_ftpl(self):
+    def ftpl_sources(self):
+        """Parameter files load_ftpl() reads, in reading order, as (kind, path) tuples."""
         if "FTPLDIR" in self.runprm:
             ftpldir = self.runprm["FTPLDIR"]
         else:
             ftpldir = self.runprm["MCCE_HOME"]+"/param"
-        cwd = os.getcwd()
-        os.chdir(ftpldir)
+        sources = [("ftpl", fname) for fname in sorted(glob.glob(os.path.join(ftpldir, "*.ftpl")))]
+        sources.append(("vdw", os.path.join(ftpldir, "00always_needed.tpl")))
 
-        files = glob.glob("*.ftpl")
-        files.sort()
-        logging.info("Reading parameters from %s" % ftpldir)
-        for fname in files:
-            self.read_ftpl_file(fname)
+        # user_param and new.tpl are in the working directory
+        if os.path.isdir("user_param"):
+            sources += [("user_ftpl", fname) for fname in sorted(glob.glob(os.path.join("user_param", "*.ftpl")))]
+        if os.path.exists("new.tpl"):
+            sources.append(("new_tpl", "new.tpl"))
+
+        if "EXTRA" in self.runprm:
+            extratpl = self.runprm["EXTRA"]
+        else:
+            extratpl = self.runprm["MCCE_HOME"]+"/extra.tpl"
+        sources.append(("extra", extratpl))
+        return sources
+
+    def ftpl_cache_file(self, sources):
+        """Cache file of the parameters compiled from sources, named by the paths, mtimes and sizes of sources.
+        Return None if a source is missing."""
+        key = [FTPL_CACHE_VERSION]
+        for kind, fname in sources:
+            if not os.path.isfile(fname):
+                return None
+            stat = os.stat(fname)
+            key.append((kind, os.path.abspath(fname), stat.st_mtime_ns, stat.st_size))
+        if "FTPL_CACHE" in self.runprm:
+            cache_dir = self.runprm["FTPL_CACHE"]
+        else:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "mcce")
+        return os.path.join(cache_dir, "ftpl_%s.pickle" % hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def load_ftpl_cache(self, cache_file):
+        """Load parameters from a cache file. Return False if there is no usable cache."""
+        try:
+            with open(cache_file, "rb") as fh:
+                cached = pickle.load(fh)
+        except Exception:
+            return False
+
+        # parameter objects are saved as (class name, attributes)
+        for key, value in cached.items():
+            if isinstance(value, tuple) and len(value) == 2 and value[0] in FTPL_PARAM_CLASSES:
+                param_value = FTPL_PARAM_CLASSES[value[0]].__new__(FTPL_PARAM_CLASSES[value[0]])
+                param_value.__dict__.update(value[1])
+                value = param_value
+            self.param[key] = value
+        return True
 
+    def save_ftpl_cache(self, cache_file):
+        cached = {}
+        for key, value in self.param.items():
+            if type(value).__name__ in FTPL_PARAM_CLASSES:
+                value = (type(value).__name__, vars(value))
+            cached[intern_strings(key)] = intern_strings(value)
+
+        # write to a temporary file and rename, so that a concurrent run never reads a partial cache
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = "%s.%d" % (cache_file, os.getpid())
+            with open(tmp_file, "wb") as fh:
+                pickle.dump(cached, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logging.debug("Parameter cache %s not saved: %s" % (cache_file, e))
+        return
+
+    def load_ftpl(self, cache=True):
+        """Load ftpl parameters, from the compiled parameter cache when none of the source files has changed."""
+        sources = self.ftpl_sources()
+        cache_file = None
+        if cache and not self.param:
+            cache_file = self.ftpl_cache_file(sources)
+            if cache_file and self.load_ftpl_cache(cache_file):
+                logging.info("Loaded parameters from cache %s" % cache_file)
+                return
+
+        files = {}
+        for kind, fname in sources:
+            files.setdefault(kind, []).append(fname)
+
+        logging.info("Reading parameters from %s" % os.path.dirname(files["vdw"][0]))
+        for fname in files.get("ftpl", []):
+            self.read_ftpl_file(fname)
 
         # Update vdw with 00always_needed.tpl
-        fname = "00always_needed.tpl"
-        lines = open(fname).readlines()
+        fname = files["vdw"][0]
         logging.info("Updating vdw parameters from %s" % os.path.abspath(fname))
+        self.read_vdw_tpl(fname)
+
+        # read from user_param
+        if "user_ftpl" in files:
+            print("Reading parameters from user_param")
+            for fname in files["user_ftpl"]:
+                self.read_ftpl_file(fname)
+
+        # read and convert from new.tpl
+        # Only CONNECT records are read and converted from new.tpl
+        if "new_tpl" in files:
+            print("Reading CONNECT parameters from %s" % files["new_tpl"][0])
+            self.read_new_tpl(files["new_tpl"][0])
+
+        # read from extra.tpl
+        self.read_extra_tpl(files["extra"][0])
+
+        if cache_file:
+            self.save_ftpl_cache(cache_file)
+        return
+
+    def read_vdw_tpl(self, fname):
+        lines = open(fname).readlines()
         for line in lines:
             end = line.find("#")
             line = line[:end].strip()
@@ -656,56 +1351,34 @@ class ENV:
                     param_value.e_vdw = value
                 self.param[new_key] = param_value
 
-        os.chdir(cwd)
-
-        # read from user_param
-        ftpldir = "user_param"
-        if os.path.isdir(ftpldir):
-            print("Reading parameters from %s" % ftpldir)
-            os.chdir(ftpldir)
-            files = glob.glob("*.ftpl")
-            files.sort()
-            for fname in files:
-                self.read_ftpl_file(fname)
-            os.chdir(cwd)
-
-        # read and convert from new.tpl
-        # Only CONNECT records are read and converted from new.tpl
-        newtpl = "new.tpl"
-        if os.path.exists(newtpl):
-            print("Reading CONNECT parameters from %s" % newtpl)
-            lines = open(newtpl).readlines()
-            for line in lines:
-                if len(line) > 10:
-                    key1 = line[:9].strip()
-                    if key1 == "CONNECT":
-                        key3 = line[9:14]
-                        key2 = line[15:19]
-                        orbital = line[20:29].strip()
-                        atoms_str = line[30:].rstrip()+"   "
-                        n_atoms = len(atoms_str)//10
-                        atoms = []
-                        for i in range(n_atoms):
-                            a = atoms_str[:10]
-                            ires = a[:5].strip()
-                            atom_name = a[5:9]
-                            if ires != "0":
-                                atom_name = " ?  "
-                            atoms.append(atom_name)
-                            atoms_str = atoms_str[10:]
-
-                        new_atoms_str = ",".join(["\"%s\"" % x for x in atoms])
-                        value_string = "%s, %s" % (orbital, new_atoms_str)
-                        self.param[(key1, key2, key3)] = CONNECT_param(value_string)
-                        #print("(%s, %s, %s): %s" % (key1, key2, key3, value_string))
-
-        # read from extra.tpl
-        # self.print_runprm()
-        if "EXTRA" in self.runprm:
-            extratpl = self.runprm["EXTRA"]
-        else:
-            extratpl = self.runprm["MCCE_HOME"]+"/extra.tpl"
-        lines = open(extratpl).readlines()
+    def read_new_tpl(self, fname):
+        lines = open(fname).readlines()
+        for line in lines:
+            if len(line) > 10:
+                key1 = line[:9].strip()
+                if key1 == "CONNECT":
+                    key3 = line[9:14]
+                    key2 = line[15:19]
+                    orbital = line[20:29].strip()
+                    atoms_str = line[30:].rstrip()+"   "
+                    n_atoms = len(atoms_str)//10
+                    atoms = []
+                    for i in range(n_atoms):
+                        a = atoms_str[:10]
+                        ires = a[:5].strip()
+                        atom_name = a[5:9]
+                        if ires != "0":
+                            atom_name = " ?  "
+                        atoms.append(atom_name)
+                        atoms_str = atoms_str[10:]
+
+                    new_atoms_str = ",".join(["\"%s\"" % x for x in atoms])
+                    value_string = "%s, %s" % (orbital, new_atoms_str)
+                    self.param[(key1, key2, key3)] = CONNECT_param(value_string)
+                    #print("(%s, %s, %s): %s" % (key1, key2, key3, value_string))
+
+    def read_extra_tpl(self, fname):
+        lines = open(fname).readlines()
         for line in lines:
             if len(line) > 10:
                 key1 = line[:9].strip()
@@ -713,8 +1386,6 @@ class ENV:
                 value = float(line[20:].strip())
                 self.param[(key1, key2)] = value
 
-        return
-
     def print_param(self):
         for key, value in self.param.items():
             if len(key) == 3:
@@ -729,6 +1400,13 @@ class ENV:
                 print(key, value)
 
 def vdw_conf(conf1, conf2, cutoff=0.001, verbose=False, display=False):
+    store = conf1.store
+    if not (verbose or display) and store is not None and store is conf2.store and store.connect14 is not None:
+        # read packed arrays
+        if store.vdw_engine is None:
+            store.vdw_engine = VdwEngine(store)
+        return float(store.vdw_engine.vdw_to(conf1.k, np.array([conf2.k]))[0])
+
     vdw = 0.0
 
     d = math.sqrt(ddvv(conf1.blob.center, conf2.blob.center))
@@ -852,13 +1530,33 @@ def vdw_atom(atom1, atom2):
     return p_lj
 
 def torsion(conf):  # estimate torsion energy by 1-4 vdw
+    store = conf.store
+    if store is not None and store.connect14 is not None:
+        # 1-4 pairs of this conformer to atoms in the same conformer or backbone, read from packed arrays
+        indptr = store.connect14.indptr
+        s = conf.atom_start
+        e = conf.atom_end
+        i1 = np.repeat(np.arange(s, e), np.diff(indptr[s:e + 1]))
+        i2 = store.connect14.indices[indptr[s]:indptr[e]]
+        selected = (store.conf_num[i2] == store.conf_num[i1]) | (store.conf_num[i2] == 0)
+        i1 = i1[selected]
+        i2 = i2[selected]
+        delta = store.xyz[i1] - store.xyz[i2]
+        d2 = (delta * delta).sum(axis=1)
+        in_range = vdw_in_range(delta, d2)
+        i1 = i1[in_range]
+        i2 = i2[in_range]
+        sig_min = store.r_vdw[i1] + store.r_vdw[i2]
+        eps = np.sqrt(store.e_vdw[i1] * store.e_vdw[i2])
+        return float(vdw_lj(d2[in_range], sig_min, eps, np.full(len(i1), VDW_SCALE14)).sum())
+
     vdw = 0.0
-    calculated_pairs = []
+    calculated_pairs = set()
     for atom1 in conf.atom:
         for atom2 in atom1.connect14:
             if (atom2.confNum == atom1.confNum or atom2.confNum == 0) and ((atom2, atom1) not in calculated_pairs):
                 vdw += vdw_atom(atom1, atom2)
-                calculated_pairs.append((atom2, atom1))   # ensure only calculate a pair once
+                calculated_pairs.add((atom2, atom1))   # ensure only calculate a pair once
 
     return vdw
 
@@ -3,16 +3,26 @@
 Step 3 computes energy look up table. 
 The input is step2_out.pdb.
 The output is energies/*.opp, energies/*.oppl and head3.lst
+Raw electrostatic results of the PB solver are kept in binary shards energies/raw_*.bin, see RawWriter and RawTable,
+and compacted to one shard after a run that completes all conformers.
 
 Command line options:
 -d number: dielectric constant (default 4)
--s PBSolver: PB solver name (default delphi)
+-s PBSolver: PB solver name, delphi, the in-process finite difference solver fd, or the screening modes gb and coulomb
+   (default delphi)
 -p number: run with number of threads (default 1)
+-a number: run delphi asynchronously in one process with up to number of delphi processes at a time (default 0, off)
 -c start end: run conformer from start to end (default 0 to 99999)
 -t path: temporary folder path (default /tmp) 
 --vdw: run vdw calculation only
 --fly: on-the-fly rxn0 calculation
 --refresh: recreate *.opp and head3.lst from step2_out.pdb and *.oppl files without doing calculation
+--incremental: only recalculate conformers whose atoms or surroundings changed since the last run. If conformers were
+   added or removed, or any charge changed, all conformers are solved again by the PB solver. Otherwise a conformer
+   that moved only has the PB solver run again on the conformers within ENV_CUTOFF of it, and the conformers further
+   away keep their pairwise interactions to it from the last run.
+--resume: only calculate conformers in the -c range without a complete raw record from an interrupted run
+--raw: also export raw electrostatic results as energies/*.raw text files
 -l file: load above options from a file
 
 Usage examples:
@@ -22,28 +32,66 @@ Usage examples:
 
 """
 
-import sys, argparse, shutil, logging, time, os, json
+import sys, argparse, shutil, logging, time, os, json, hashlib, asyncio
 from multiprocess import Pool, current_process
 from pdbio import *
 from pbs_interfaces import *
 
 energy_folder = "energies"
 PW_CUTOFF = 0.001   # cut off value for pairwise interaction to report
+MANIFEST = "step3_manifest.json"   # conformer hashes of the last complete run, for --incremental
+VDW_CACHE = "step3_vdw.npz"        # vdw of the last complete run, for --incremental
+ENV_CUTOFF = 20.0   # conformers with blobs within this distance make the PB environment of a conformer
+TIMING_LOG = "step3_timing.log"    # time spent on each PB task
+SOLVER_LOG = "step3_solver.log"    # time spent on each delphi call of an asynchronous run
+PROGRESS_INTERVAL = 10.0   # seconds between progress lines
+RAW_TMP = ".raw.tmp"       # raw files are written under this suffix and renamed when complete
+RAW_END = "[RXN, kcal/mol]"   # last record of a complete raw file
+RAW_MAGIC = b"MCCERAW1"    # first bytes of a binary raw shard
+RAW_RECORD_END = 0x52415745   # last 4 bytes of a complete binary raw record
+RAW_RECORD = np.dtype([("k", "<i4"), ("all_0", "<i4"), ("n_pw", "<i4"), ("n_bkb", "<i4"), ("bkb_total", "<f4"),
+                       ("rxn", "<f4")])
+RAW_PW = np.dtype([("k", "<i4"), ("single", "<f4"), ("multi", "<f4"), ("ref", "u1")])
+RAW_BKB = np.dtype([("k", "<i4"), ("pw", "<f4")])
+ELE_REF = 1     # "*", pw to the reference conformer of a residue in the single side chain boundary
+ELE_CLASH = 2   # "?", the single side chain boundary has a clash of this conformer and the reference conformer
+ELE_MARKS = ("", "*", "?", "?*")   # mark strings by mark bits
 
 
 
 global protein, run_options
 
 
-class ElePW:
-    def __init__(self):
-        self.mark = ""
-        self.multi = 0.0
-        self.single = 0.0
-        self.scaled = 0.0
-        self.averaged = 0.0
+class EleMatrix:
+    """Pairwise electrostatic interactions from the raw records, in CSR layout by packed conformer index.
+
+    conf2[indptr[k]:indptr[k + 1]] are the conformers that conformer k interacts with, conf1 is the row of each entry.
+    single, multi, scaled and averaged are in kcal/mol, and mark is a bitmask of ELE_REF and ELE_CLASH.
+    """
+    def __init__(self, raw):
+        self.indptr = raw.pw_indptr
+        self.conf1 = np.repeat(np.arange(len(raw.done)), np.diff(raw.pw_indptr))
+        self.conf2 = raw.pw_conf
+        self.single = raw.pw_single
+        self.multi = raw.pw_multi
+        self.mark = np.where(raw.pw_ref, ELE_REF, 0).astype(np.uint8)
+        self.scaled = np.zeros(len(self.conf2))
+        self.averaged = np.zeros(len(self.conf2))
         return
 
+    def reverse(self):
+        """Index of the (conf2, conf1) entry of each entry, -1 if there is none."""
+        reverse = np.full(len(self.conf2), -1)
+        if len(reverse) > 0:
+            n = len(self.indptr) - 1
+            key = self.conf1 * n + self.conf2
+            order = np.argsort(key)
+            reverse_key = self.conf2 * n + self.conf1
+            pos = np.minimum(np.searchsorted(key, reverse_key, sorter=order), len(key) - 1)
+            found = key[order[pos]] == reverse_key
+            reverse[found] = order[pos[found]]
+        return reverse
+
 
 class RunOptions:
     def __init__(self, args):
@@ -53,6 +101,7 @@ class RunOptions:
         self.d = float(args.d)
         self.s = args.s
         self.p = args.p
+        self.a = args.a
         self.t = args.t
         self.ftpl = args.ftpl
         self.salt = args.salt
@@ -60,6 +109,9 @@ class RunOptions:
         self.fly = args.fly
         self.debug = args.debug
         self.refresh = args.refresh
+        self.incremental = args.incremental
+        self.resume = args.resume
+        self.raw = args.raw
         if args.l:  # load options from the specified file 
             lines = open(args.l).readlines()
             for line in lines:
@@ -76,6 +128,8 @@ class RunOptions:
                         self.s = fields[1]
                     elif key == "-p":
                         self.p = int(fields[1])
+                    elif key == "-a":
+                        self.a = int(fields[1])
                     elif key == "-t":
                         self.t = fields[1]
                     elif key == "--vdw":
@@ -84,6 +138,12 @@ class RunOptions:
                         self.fly = True
                     elif key == "--refresh":
                         self.refresh = True
+                    elif key == "--incremental":
+                        self.incremental = True
+                    elif key == "--resume":
+                        self.resume = True
+                    elif key == "--raw":
+                        self.raw = True
                     elif key == "--debug":
                         self.debug = True
                     elif key == "-ftpl":
@@ -93,16 +153,92 @@ class RunOptions:
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 
 
-class ExchangeAtom:
-    def __init__(self, atom):
-        self.x = atom.xyz[0]
-        self.y = atom.xyz[1]
-        self.z = atom.xyz[2]
-        self.r = atom.r_bound  # radius
-        self.c = 0.0  # default to boundary defining atom, charge should be set as 0
-        self.p = 0.0
+class StaticBoundary:
+    """Parts of the dielectric boundary that are the same for every conformer, composed once as arrays.
+
+    Boundary lines are packed atom indices. The single side chain boundary is the backbone, then the native conformer
+    of every residue, the first charged conformer if any, otherwise the first. The multi side chain boundary is the
+    backbone, then the atoms of all conformers of every residue, where identical atoms of a residue share one line.
+    res_single and res_multi give the lines of each residue, so a conformer's atoms can be spliced in place of its own
+    residue. The arrays can be published to worker processes through shared memory, see share() and attach().
+    """
+    ARRAYS = ("xyz", "r_bound", "charge", "atom_conf", "single_atom", "res_single", "multi_indptr", "multi_atom",
+              "res_multi")
+
+    def __init__(self, protein=None, arrays=None):
+        if arrays is None:
+            store = protein.store
+            arrays = {"xyz": store.xyz, "r_bound": store.r_bound, "charge": store.charge, "atom_conf": store.atom_conf}
+
+            # backbone
+            single_atom = []
+            multi_lines = []
+            for res in protein.residue:
+                if res.conf:
+                    for atom in res.conf[0].atom:
+                        single_atom.append(atom.i)
+                        multi_lines.append([atom.i])
+
+            res_single = [len(single_atom)]
+            res_multi = [len(multi_lines)]
+            for res in protein.residue:
+                if len(res.conf) > 1:  # skip dummy or backbone only residue
+                    # find the first charged conformer if any, otherwise use the first
+                    i_useconf = 1
+                    for iconf in range(1, len(res.conf)):
+                        if abs(res.conf[iconf].crg) > 0.0001:
+                            i_useconf = iconf
+                            break
+                    single_atom += range(res.conf[i_useconf].atom_start, res.conf[i_useconf].atom_end)
+                    multi_lines += self.merge_identical(store, res.conf[1].atom_start, res.conf[-1].atom_end)
+                res_single.append(len(single_atom))
+                res_multi.append(len(multi_lines))
+
+            arrays["single_atom"] = np.array(single_atom, dtype=int)
+            arrays["res_single"] = np.array(res_single, dtype=int)
+            arrays["multi_indptr"] = np.cumsum([0] + [len(line) for line in multi_lines])
+            arrays["multi_atom"] = np.array([i for line in multi_lines for i in line], dtype=int)
+            arrays["res_multi"] = np.array(res_multi, dtype=int)
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.shm = None   # shared memory block the arrays are in, if attached
         return
 
+    @staticmethod
+    def merge_identical(store, start, end):
+        """Group atoms [start, end) into boundary lines, an atom joins the first line with xyz and r within 0.001."""
+        xyzr = np.column_stack((store.xyz[start:end], store.r_bound[start:end]))
+        identical = np.all(np.abs(xyzr[:, np.newaxis, :] - xyzr[np.newaxis, :, :]) < 0.001, axis=2)
+        lines = []
+        first = []   # first atom of each line, in block index
+        for j in range(end - start):
+            matched = np.nonzero(identical[j, first])[0]
+            if len(matched):
+                lines[matched[0]].append(start + j)
+            else:
+                first.append(j)
+                lines.append([start + j])
+        return lines
+
+    def share(self):
+        return share_arrays(dict([(name, getattr(self, name)) for name in self.ARRAYS]))
+
+    @staticmethod
+    def attach(shm, layout):
+        boundary = StaticBoundary(arrays=attach_arrays(shm, layout))
+        boundary.shm = shm
+        return boundary
+
+    def xyzrcp(self, atoms, charged):
+        """xyzrcp records of boundary lines given by their first atoms. Atoms from charged on carry their charge."""
+        xyzrcp = np.zeros(len(atoms), dtype=XYZRCP).view(np.recarray)
+        xyzrcp.x = self.xyz[atoms, 0]
+        xyzrcp.y = self.xyz[atoms, 1]
+        xyzrcp.z = self.xyz[atoms, 2]
+        xyzrcp.r = self.r_bound[atoms]
+        xyzrcp.c[charged[0]:charged[1]] = self.charge[atoms[charged[0]:charged[1]]]
+        return xyzrcp
+
 
 class Exchange:  # This is the data passed to the PB wrapper, together with runoptions
     # We have to abadon the mop on and off mechanism when modifying the dielectric boundary.
@@ -113,179 +249,110 @@ class Exchange:  # This is the data passed to the PB wrapper, together with runo
     # * index to match multiple atoms to boundary line number 
     # * method to compose single side chain condition
     # * method to compose multi side chain condition
-
-    def __init__(self, protein):
-        # initilaize backbone
-        self.backbone_xyzrcp = []
-        self.backbone_atom = []
-        for res in protein.residue:
-            if res.conf:
-                for atom in res.conf[0].atom:
-                    xyzrcp = ExchangeAtom(atom)
-                    self.backbone_xyzrcp.append(xyzrcp)
-                    self.backbone_atom.append([
-                                                  atom])  # the atom is in an array because it is allowed to have multiple atoms to match the same line in xyzrcp line
-
-        self.single_bnd_xyzrcp = []
-        self.single_bnd_atom = []
-        self.multi_bnd_xyzrcp = []
-        self.multi_bnd_atom = []
+    # The static parts are in StaticBoundary, and each boundary line is a record of xyzrcp arrays. The atoms
+    # matched to a line are packed atom indices: single_bnd_atom has one per line, and multi_bnd_atom lists the
+    # atoms of line n at [multi_bnd_indptr[n], multi_bnd_indptr[n+1]).
+
+    def __init__(self, boundary):
+        self.boundary = boundary
+        self.single_bnd_xyzrcp = np.zeros(0, dtype=XYZRCP).view(np.recarray)
+        self.single_bnd_atom = np.zeros(0, dtype=int)
+        self.multi_bnd_xyzrcp = np.zeros(0, dtype=XYZRCP).view(np.recarray)
+        self.multi_bnd_indptr = np.zeros(1, dtype=int)
+        self.multi_bnd_atom = np.zeros(0, dtype=int)
         return
 
     def compose_single(self, protein, ir, ic):
         """ Compose a single side chain boundary condition.
             The atoms are added in addition to backbone.
-            Atoms other than in residue[ir], conformer[ic] are then appended.
-            Atoms in residue[ir], conformer[ic] are appended last
+            Atoms in residue[ir], conformer[ic] replace the native conformer of residue[ir], the other residues
+            keep their native conformer.
         """
-        self.single_bnd_xyzrcp = self.backbone_xyzrcp.copy()
-        self.single_bnd_atom = self.backbone_atom.copy()
-
-        for ires in range(len(protein.residue)):
-            # print(protein.residue[ires].resID)
-            if ires == ir:  # this is the residue we want to put desired side chain conf
-                for atom in protein.residue[ires].conf[ic].atom:
-                    xyzrcp = ExchangeAtom(atom)
-                    xyzrcp.c = atom.charge
-                    self.single_bnd_xyzrcp.append(xyzrcp)
-                    self.single_bnd_atom.append([atom])
-
-            else:  # find the first charged conformer if any, otherwise use the first
-                if len(protein.residue[ires].conf) > 1:  # skip dummy or backbone only residue
-                    i_useconf = 1  # defaul the first conformer
-                    for iconf in range(1, len(protein.residue[ires].conf)):
-                        # print(protein.residue[ires].conf[iconf].confID, protein.residue[ires].conf[iconf].crg)
-                        if abs(protein.residue[ires].conf[iconf].crg) > 0.0001:
-                            i_useconf = iconf
-                            break
-
-                    # just for boundary
-                    for atom in protein.residue[ires].conf[i_useconf].atom:
-                        xyzrcp = ExchangeAtom(atom)
-                        self.single_bnd_xyzrcp.append(xyzrcp)
-                        self.single_bnd_atom.append([atom])
-
-        # Error checking, basic
-        # for atom_list in self.ibound2atoms:
-        #     print(len(atom_list), atom_list[0].atomID)
-        #     if len(atom_list) != 1:
-        #         print("ERROR")
-        #         break
+        bound = self.boundary
+        conf = protein.residue[ir].conf[ic]
+        a = bound.res_single[ir]
+        b = bound.res_single[ir + 1]
+        self.single_bnd_atom = np.concatenate((bound.single_atom[:a], np.arange(conf.atom_start, conf.atom_end),
+                                               bound.single_atom[b:]))
+        self.single_bnd_xyzrcp = bound.xyzrcp(self.single_bnd_atom, (a, a + conf.atom_end - conf.atom_start))
 
         logging.debug("%s Single-sidechain boundary record length should be equal: %d, %d" % (
-        protein.residue[ir].conf[ic].confID, len(self.single_bnd_xyzrcp), len(self.single_bnd_atom)))
+        conf.confID, len(self.single_bnd_xyzrcp), len(self.single_bnd_atom)))
 
         return
 
     def compose_multi(self, protein, ir, ic):
         """ Compose a multi side chain boundary condition.
             The atoms are added in addition to backbone.
-            Atoms other than in residue[ir], conformer[ic] are appended next.
-            Atoms in residue[ir], conformer[ic] are appended last.
-            When appending an atom, this subroutine will check if the same atom (xyzrc identical) already exists. If yes, just update icound
+            Atoms in residue[ir], conformer[ic] replace the conformers of residue[ir], the other residues keep all
+            their conformers, where identical atoms of a residue share one line.
         """
-        self.multi_bnd_xyzrcp = self.backbone_xyzrcp.copy()
-        self.multi_bnd_atom = self.backbone_atom.copy()
-        for ires in range(len(protein.residue)):
-            # print(protein.residue[ires].resID)
-            if ires == ir:  # this is the residue we want to put desired side chain conf
-                for atom in protein.residue[ires].conf[ic].atom:
-                    xyzrcp = ExchangeAtom(atom)
-                    xyzrcp.c = atom.charge
-                    self.multi_bnd_xyzrcp.append(xyzrcp)
-                    self.multi_bnd_atom.append([atom])
-
-            else:  # other residues will have all conformers with 0 charge
-                if len(protein.residue[ires].conf) > 1:  # skip dummy or backbone only residue
-                    residue_bnd_xyzrcp = []  # this is the xyzrcp record for all side chain atoms of this residue
-                    residue_bnd_atom = []  # this points to the atom records of each line in residue_bnd_xyzrpc
-                    for iconf in range(1, len(protein.residue[ires].conf)):
-                        for atom in protein.residue[ires].conf[iconf].atom:
-                            xyzrcp = ExchangeAtom(atom)
-                            # test if this atom existed within this residue already
-                            found = False
-                            for ib in range(len(residue_bnd_xyzrcp)):
-                                if abs(residue_bnd_xyzrcp[ib].x - xyzrcp.x) < 0.001 and \
-                                        abs(residue_bnd_xyzrcp[ib].y - xyzrcp.y) < 0.001 and \
-                                        abs(residue_bnd_xyzrcp[ib].z - xyzrcp.z) < 0.001 and \
-                                        abs(residue_bnd_xyzrcp[ib].r - xyzrcp.r) < 0.001:  # identical atom
-                                    residue_bnd_atom[ib].append(atom)
-                                    found = True
-                                    break
-
-                            if not found:
-                                residue_bnd_xyzrcp.append(xyzrcp)
-                                residue_bnd_atom.append([atom])
-
-                    # merge this residue to the multi-bnd
-                    self.multi_bnd_xyzrcp += residue_bnd_xyzrcp
-                    self.multi_bnd_atom += residue_bnd_atom
+        bound = self.boundary
+        conf = protein.residue[ir].conf[ic]
+        a = bound.res_multi[ir]
+        b = bound.res_multi[ir + 1]
+        n_atom = conf.atom_end - conf.atom_start
+        line_lens = np.diff(bound.multi_indptr)
+        self.multi_bnd_indptr = np.cumsum(np.concatenate(([0], line_lens[:a], np.ones(n_atom, dtype=int),
+                                                          line_lens[b:])))
+        self.multi_bnd_atom = np.concatenate((bound.multi_atom[:bound.multi_indptr[a]],
+                                              np.arange(conf.atom_start, conf.atom_end),
+                                              bound.multi_atom[bound.multi_indptr[b]:]))
+        self.multi_bnd_xyzrcp = bound.xyzrcp(self.multi_bnd_atom[self.multi_bnd_indptr[:-1]], (a, a + n_atom))
 
         # Basic error checking
         logging.debug("%s Multi-sidechain boundary record length should be equal: %d, %d" % (
-        protein.residue[ir].conf[ic].confID, len(self.multi_bnd_xyzrcp), len(self.multi_bnd_atom)))
+        conf.confID, len(self.multi_bnd_xyzrcp), len(self.multi_bnd_indptr) - 1))
 
         return
 
     def write_single_bnd(self, fname):
         "This writes out both the xyzrcp and atom index files, for error checking and potentially as data exchange with PB wrapper."
-        # write xyzrpc
-        lines = []
-        for xyzrcp in self.single_bnd_xyzrcp:
-            line = "%8.3f %8.3f %8.3f %8.3f %8.3f %8.3f\n" % (xyzrcp.x,
-                                                              xyzrcp.y,
-                                                              xyzrcp.z,
-                                                              xyzrcp.r,
-                                                              xyzrcp.c,
-                                                              xyzrcp.p)
-            lines.append(line)
-        open(fname + ".xyzrcp", "w").writelines(lines)
-
-        # write index file
-        lines = []
-        for matched_atoms in self.single_bnd_atom:
-            atoms = " ".join([atom.atomID for atom in matched_atoms])
-            xyzrc = "%8.3f %8.3f %8.3f %8.3f %8.3f" % (matched_atoms[0].xyz[0],
-                                                       matched_atoms[0].xyz[1],
-                                                       matched_atoms[0].xyz[2],
-                                                       matched_atoms[0].r_bound,
-                                                       matched_atoms[0].charge)
-
-            line = "%s %s\n" % (xyzrc, atoms)
-            lines.append(line)
-        open(fname + ".atoms", "w").writelines(lines)
+        write_bnd(fname, self.single_bnd_xyzrcp, np.arange(len(self.single_bnd_atom) + 1), self.single_bnd_atom)
 
     def write_multi_bnd(self, fname):
         "This writes out both the xyzrcp and atom index files, for error checking and potentially as data exchange with PB wrapper."
-        # write xyzrpc
-        lines = []
-        for xyzrcp in self.multi_bnd_xyzrcp:
-            line = "%8.3f %8.3f %8.3f %8.3f %8.3f %8.3f\n" % (xyzrcp.x,
-                                                              xyzrcp.y,
-                                                              xyzrcp.z,
-                                                              xyzrcp.r,
-                                                              xyzrcp.c,
-                                                              xyzrcp.p)
-            lines.append(line)
-        open(fname + ".xyzrcp", "w").writelines(lines)
-
-        # write index file
-        lines = []
-        for matched_atoms in self.multi_bnd_atom:
-            atoms = " ".join([atom.atomID for atom in matched_atoms])
-            xyzrc = "%8.3f %8.3f %8.3f %8.3f %8.3f" % (matched_atoms[0].xyz[0],
-                                                       matched_atoms[0].xyz[1],
-                                                       matched_atoms[0].xyz[2],
-                                                       matched_atoms[0].r_bound,
-                                                       matched_atoms[0].charge)
+        write_bnd(fname, self.multi_bnd_xyzrcp, self.multi_bnd_indptr, self.multi_bnd_atom)
+
+
+def write_bnd(fname, xyzrcp, indptr, atoms):
+    # write xyzrpc
+    lines = []
+    for x, y, z, r, c, p in xyzrcp.tolist():
+        line = "%8.3f %8.3f %8.3f %8.3f %8.3f %8.3f\n" % (x, y, z, r, c, p)
+        lines.append(line)
+    open(fname + ".xyzrcp", "w").writelines(lines)
+
+    # write index file
+    lines = []
+    for n in range(len(xyzrcp)):
+        matched_atoms = [protein.atoms[i] for i in atoms[indptr[n]:indptr[n + 1]]]
+        atom_ids = " ".join([atom.atomID for atom in matched_atoms])
+        xyzrc = "%8.3f %8.3f %8.3f %8.3f %8.3f" % (matched_atoms[0].xyz[0],
+                                                   matched_atoms[0].xyz[1],
+                                                   matched_atoms[0].xyz[2],
+                                                   matched_atoms[0].r_bound,
+                                                   matched_atoms[0].charge)
+
+        line = "%s %s\n" % (xyzrc, atom_ids)
+        lines.append(line)
+    open(fname + ".atoms", "w").writelines(lines)
 
-            line = "%s %s\n" % (xyzrc, atoms)
-            lines.append(line)
-        open(fname + ".atoms", "w").writelines(lines)
+
+static_boundary = None   # StaticBoundary of this process, see boundary_worker_init()
+
+
+def boundary_worker_init(name, layout):
+    """Attach a PB worker process to the static boundary in shared memory."""
+    global static_boundary
+    static_boundary = StaticBoundary.attach(shared_memory.SharedMemory(name=name), layout)
 
 
 def def_boundary(ir, ic):
-    boundary = Exchange(protein)
+    global static_boundary
+    if static_boundary is None:
+        static_boundary = StaticBoundary(protein)
+    boundary = Exchange(static_boundary)
 
     boundary.compose_single(protein, ir, ic)
     boundary.compose_multi(protein, ir, ic)
@@ -298,16 +365,137 @@ def def_boundary(ir, ic):
     return boundary
 
 
-def get_conflist(protein):
-    conf_list = []
-    bkb_list = []
+def conformer_hashes(protein, run_options):
+    """Hash each conformer by its own atoms, and by its environment: the conformers around it and the run options.
+    The PB environment reaches ENV_CUTOFF, the vdw environment the vdw screening distance.
+    Return a dictionary {confID: [self hash, PB environment hash, vdw environment hash, charge hash]}."""
+    store = protein.store
+    self_hashes = []
+    charge_hashes = []
+    for conf in store.confs:
+        s = conf.atom_start
+        e = conf.atom_end
+        h = hashlib.sha1(conf.confID.encode())
+        h.update(" ".join([atom.name for atom in conf.atom]).encode())
+        for array in (store.xyz, store.r_bound, store.charge, store.r_vdw, store.e_vdw):
+            h.update(np.ascontiguousarray(array[s:e]).tobytes())
+        self_hashes.append(h.hexdigest())
+        h_crg = hashlib.sha1(conf.confID.encode())
+        h_crg.update(np.ascontiguousarray(store.charge[s:e]).tobytes())
+        charge_hashes.append(h_crg.hexdigest())
+
+    options = repr((run_options.d, run_options.s, run_options.salt))
+    hashes = {}
+    for k in range(len(store.confs)):
+        h_pb = hashlib.sha1(options.encode())
+        for k2 in store.blob_index.neighbors(k, ENV_CUTOFF):
+            h_pb.update(self_hashes[k2].encode())
+        h_vdw = hashlib.sha1()
+        for k2 in store.blob_index.neighbors(k):
+            h_vdw.update(self_hashes[k2].encode())
+        hashes[store.confs[k].confID] = [self_hashes[k], h_pb.hexdigest(), h_vdw.hexdigest(), charge_hashes[k]]
+    return hashes
+
+
+def changed_conformers(hashes, vdw=False):
+    """confIDs whose own or PB environment hash, or vdw environment hash if vdw is True, is different from the
+    manifest of the last complete run."""
+    if os.path.isfile(MANIFEST):
+        manifest = json.load(open(MANIFEST))["conformers"]
+    else:
+        manifest = {}
+    if vdw:
+        compared = [0, 2]
+    else:
+        compared = [0, 1]
+    changed = set()
+    for confid in hashes:
+        if confid not in manifest or [manifest[confid][i] for i in compared] != [hashes[confid][i] for i in compared]:
+            changed.add(confid)
+    return changed
+
+
+def conformers_recharged(hashes):
+    """True if conformers were added or removed, or any charge changed, since the manifest of the last complete run.
+    Every conformer then has pairwise interactions to recalculate, not only those around a change."""
+    if not os.path.isfile(MANIFEST):
+        return True
+    manifest = json.load(open(MANIFEST))["conformers"]
+    if set(manifest) != set(hashes):
+        return True
+    return any([len(manifest[confid]) < 4 or manifest[confid][3] != hashes[confid][3] for confid in hashes])
+
+
+def save_manifest(hashes):
+    with open(MANIFEST + ".tmp", "w") as fh:
+        json.dump({"conformers": hashes}, fh, indent=1)
+    os.replace(MANIFEST + ".tmp", MANIFEST)
+
+
+def save_vdw_cache(protein):
+    """Save vdw of this run for --incremental. Pairs refer to conformers by their position in the saved confid array,
+    so the cache does not depend on conf.i of this structure. Dummy conformers have no vdw and are left out."""
+    confs = [conf for res in protein.residue for conf in res.conf[1:] if conf.mark != "d"]
+    position = np.full(protein.vdw_pw.shape[0], -1)
+    position[[conf.i for conf in confs]] = np.arange(len(confs))
+    pw = protein.vdw_pw.tocoo()
+    np.savez(VDW_CACHE + ".tmp.npz", confid=np.array([conf.confID for conf in confs]),
+             vdw0=np.array([conf.vdw0 for conf in confs]), vdw1=np.array([conf.vdw1 for conf in confs]),
+             conf_rows=position[pw.row], conf_cols=position[pw.col], values=pw.data)
+    os.replace(VDW_CACHE + ".tmp.npz", VDW_CACHE)
+
+
+def incremental_vdw(protein, changed, processes=1):
+    """Recalculate vdw of the changed conformers only, and take the rest from the vdw cache of the last run."""
+    cached = np.load(VDW_CACHE) if os.path.isfile(VDW_CACHE) else {}
+    if "conf_rows" not in cached:   # no cache, or one that refers to conformers by conf.i of its run
+        protein.calc_vdw(processes=processes)
+        return
+
+    confs = [conf for res in protein.residue for conf in res.conf[1:] if conf.confID in changed]
+    logging.info("Recalculating vdw of %d conformers" % len(confs))
+    protein.calc_vdw(processes=processes, confs=confs)
+
+    # map cached conformers by confID to the current index, -1 if gone or recalculated
+    conf_byid = {}
     for res in protein.residue:
-        for conf in res.conf:
-            if conf.confID[3:5] == "BK":
-                bkb_list.append(conf.confID)
-            else:
-                conf_list.append(conf.confID)
-    return conf_list, bkb_list
+        for conf in res.conf[1:]:
+            conf_byid[conf.confID] = conf
+    new_i = np.full(len(cached["confid"]), -1)
+    for n in range(len(cached["confid"])):
+        confid = str(cached["confid"][n])
+        if confid in conf_byid and confid not in changed:
+            conf = conf_byid[confid]
+            new_i[n] = conf.i
+            conf.vdw0 = float(cached["vdw0"][n])
+            conf.vdw1 = float(cached["vdw1"][n])
+
+    rows = new_i[cached["conf_rows"]]
+    cols = new_i[cached["conf_cols"]]
+    kept = (rows >= 0) & (cols >= 0)
+    reused = coo_matrix((cached["values"][kept], (rows[kept], cols[kept])), shape=protein.vdw_pw.shape)
+    protein.vdw_pw = (protein.vdw_pw + reused).tocsr()
+    return
+
+
+def sum_by_conformer(p, atom_conf):
+    """Sum p of atoms over |p| > 0.0001 by conformer. Return a dictionary {packed conformer index: sum in kcal}."""
+    reported = np.abs(p) > 0.0001
+    sums = np.bincount(atom_conf[reported], weights=p[reported], minlength=len(protein.store.confs))
+    pw = {}
+    for k in np.unique(atom_conf[reported]):
+        pw[int(k)] = sums[k] / KCAL2KT
+    return pw
+
+
+def as_printed(x):
+    """Value as it reads back from a raw file, with 3 decimals."""
+    return float("%.3f" % x)
+
+
+def pbe_tmp(confid=""):
+    """Temporary folder of the PB solver for a conformer, under the -t folder and named after this run's folder."""
+    return run_options.t + "/pbe_" + os.getcwd().strip("/").replace("/", ".") + "/" + confid
 
 
 def pbe(iric):
@@ -315,153 +503,465 @@ def pbe(iric):
     ic = iric[1]
     pid = current_process()  # Identify this worker
     confid = protein.residue[ir].conf[ic].confID
-    resid = confid[:3] + confid[5:11]
     bound = def_boundary(ir, ic)
     rxn = 0.0
 
     # skip pbe if atoms in this conformer are all 0 charged
-    all_0 = True
-    for atom in protein.residue[ir].conf[ic].atom:
-        if abs(atom.charge) > 0.001:
-            all_0 = False
-            break
+    all_0 = is_all_0(protein.residue[ir].conf[ic])
     if all_0:  # skip
         logging.info("Skipping PBE solver for non-charge confortmer %s..." % confid)
+    elif run_options.s.upper() in PBS_IN_PROCESS:
+        # in-process solver, no temporary folder
+        logging.info("%s: Calling %s solver to calulate conformer %s" % (pid.name, run_options.s, confid))
+        rxn = PBS_IN_PROCESS[run_options.s.upper()]().run(bound, run_options)
     else:
-        # switch to temporary unique directory
-        cwd = os.getcwd()
-        # tmp_pbe = run_options.t + "/pbe_" + cwd.strip("/").replace("/", ".") + "/" + uuid.uuid4().hex[:6]
-        tmp_pbe = run_options.t + "/pbe_" + cwd.strip("/").replace("/", ".") + "/" + confid
+        # the solver runs in a temporary unique directory, the current directory stays
+        tmp_pbe = pbe_tmp(confid)
         if not os.path.exists(tmp_pbe):
             os.makedirs(tmp_pbe)
-        os.chdir(tmp_pbe)
 
         # decide which pb solver, delphi = delphi legacy
         if run_options.s.upper() == "DELPHI":
             logging.info("%s: Calling delphi to calulate conformer %s" % (pid.name, confid))
             pbs_delphi = PBS_DELPHI()
-            rxn = pbs_delphi.run(bound, run_options)
+            rxn = pbs_delphi.run(bound, run_options, tmp_pbe)
 
         else:
             print("No compatible PBE solver detected, given pb solver is %s" % run_options.s)
 
-        # switch back to the current directory
         if not run_options.debug:
             shutil.rmtree(tmp_pbe)
-        os.chdir(cwd)
 
-    # write raw opp file
-    fname = "%s/%s.raw" % (energy_folder, confid)
+    save_pbe(ir, ic, bound, rxn, all_0)
+    return (ir, ic)
+
 
-    if not os.path.exists(energy_folder):
-        os.mkdir(energy_folder)
+async def pbe_async(iric, slots, latency):
+    """pbe() with delphi calls through asyncio, see run_pbe_async().
+    The (confID, boundary, run, seconds) of each delphi call is appended to latency."""
+    ir = iric[0]
+    ic = iric[1]
+    confid = protein.residue[ir].conf[ic].confID
+    bound = def_boundary(ir, ic)
+    rxn = 0.0
 
+    all_0 = is_all_0(protein.residue[ir].conf[ic])
     if all_0:
-        # create an empty file as a marker to indicate this conformer has been calculated
-        with open(fname, 'w') as fp:
-            pass
+        logging.info("Skipping PBE solver for non-charge confortmer %s..." % confid)
     else:
-        # generate electrostatic interaction raw file
-        raw_lines = []
-
-        # Part 1: Method = run_options.s
-        line = "[Method] %s\n" % run_options.s
-        raw_lines.append(line)
-
-        # Part 2: pw to other conformers, single and multi
-        pw_single = {}
-        pw_multi = {}
-        for ia in range(len(bound.single_bnd_xyzrcp)):
-            # print(confid, bound.single_bnd_atom[ia][0].confID, bound.single_bnd_atom[ia][0].name)
-            pw_confname = bound.single_bnd_atom[ia][0].confID  # single conformer
-            p = bound.single_bnd_xyzrcp[ia].p * bound.single_bnd_atom[ia][0].charge
-            if abs(p) > 0.0001:
-                if pw_confname in pw_single:
-                    pw_single[pw_confname] += p
-                else:
-                    pw_single[pw_confname] = p
-
-        # convert to Kcal and remove interaction within residue including backbone piece
-        pw_single.update((key, value / KCAL2KT) for key, value in pw_single.items())
-
-        # print(pw_single)
-        # print(len(pw_single))
-
-        pw_multi = {}
-        for ia in range(len(bound.multi_bnd_xyzrcp)):
-            for atom in bound.multi_bnd_atom[ia]:
-                pw_confname = atom.confID
-                if pw_confname[3:5] == "BK":
-                    continue
-                p = bound.multi_bnd_xyzrcp[ia].p * atom.charge
-                if abs(p) > 0.0001:
-                    if pw_confname in pw_multi:
-                        pw_multi[pw_confname] += p
-                    else:
-                        pw_multi[pw_confname] = p
-
-        # convert to Kcal
-        pw_multi.update((key, value / KCAL2KT) for key, value in pw_multi.items())
-        # for key, value in pw_multi.items():
-        #     if abs(value) >= 0.001:
-        #         print("%s %8.3f" % (key, value))
-
-        # get conformer list and backbone segment list
-        conf_list, bkb_list = get_conflist(protein)
-
-        # write pw section
-        line = "\n[PAIRWISE confID single multi flag, kcal/mol]\n"
-        raw_lines.append(line)
-
-        for pw_conf in conf_list:
+        logging.info("Calling delphi to calulate conformer %s" % confid)
+        tmp_pbe = pbe_tmp(confid)
+        calls = []
+        rxn = await PBS_DELPHI().run_async(bound, run_options, tmp_pbe, slots, calls)
+        latency += [(confid,) + call for call in calls]
+        if not run_options.debug:
+            await asyncio.to_thread(shutil.rmtree, tmp_pbe)
+
+    save_pbe(ir, ic, bound, rxn, all_0)
+    return (ir, ic)
+
+
+def run_pbe_async(work_load, costs, slots, progress, timing_log):
+    """Run pbe on work_load in this process, with up to slots delphi processes in flight across all conformers.
+    Conformers start by estimated cost, most expensive first, and no more than slots of them are open at a time.
+    Return the latency list of pbe_async()."""
+    async def run_all():
+        solver_slots = asyncio.Semaphore(slots)
+        conformer_slots = asyncio.Semaphore(slots)
+        latency = []
+
+        async def task(iric, cost):
+            async with conformer_slots:
+                start = time.time()
+                await pbe_async(iric, solver_slots, latency)
+                timing_log.write("%-15s %8.2f %10.2f %10.3f %s\n" % (protein.residue[iric[0]].conf[iric[1]].confID,
+                                                                     cost, start - progress.start, time.time() - start,
+                                                                     "async"))
+                timing_log.flush()
+                progress.update(1, cost)
+
+        order = sorted(range(len(work_load)), key=lambda n: -costs[n])
+        await asyncio.gather(*[task(work_load[n], costs[n]) for n in order])
+        return latency
+
+    return asyncio.run(run_all())
+
+
+def save_pbe(ir, ic, bound, rxn, all_0):
+    """Append the raw electrostatic record of a solved conformer."""
+    confid = protein.residue[ir].conf[ic].confID
+    resid = confid[:3] + confid[5:11]
+
+    # append raw electrostatic results to the raw shard of this process
+    conf = protein.residue[ir].conf[ic]
+    if all_0:
+        # an empty record marks this conformer as calculated
+        raw_writer().append(conf.k, all_0=True)
+    else:
+        # pw to other conformers, single and multi
+        # sum up potential * charge of atoms by conformer, in kcal
+        static = bound.boundary
+        pw_single = sum_by_conformer(bound.single_bnd_xyzrcp.p * static.charge[bound.single_bnd_atom],
+                                     static.atom_conf[bound.single_bnd_atom])
+
+        line_p = np.repeat(bound.multi_bnd_xyzrcp.p, np.diff(bound.multi_bnd_indptr))
+        atom_conf = static.atom_conf[bound.multi_bnd_atom]
+        sidechain = protein.store.conf_inres[atom_conf] != 0
+        pw_multi = sum_by_conformer(line_p[sidechain] * static.charge[bound.multi_bnd_atom[sidechain]],
+                                    atom_conf[sidechain])
+
+        # conformers in packed order, side chain conformers make the pw section, backbone pieces the backbone sections
+        pw = []
+        bkb = []
+        bkb_total = 0.0
+        for k2, conf2 in enumerate(protein.store.confs):
+            pw_conf = conf2.confID
+            if pw_conf[3:5] == "BK":
+                if k2 in pw_single:
+                    bkb_pw = pw_single[k2]
+                    bkb_total += bkb_pw  # do inclusive calculation for now
+                    if abs(bkb_pw) >= PW_CUTOFF:
+                        bkb.append((k2, as_printed(bkb_pw)))
+                continue
             if resid == pw_conf[:3] + pw_conf[5:11]:
                 continue  # skip conformer within residue
-            single = 0.0
-            multi = 0.0
-            non0 = False
-            reference = ""
-            if pw_conf in pw_single:
-                non0 = True
-                single = pw_single[pw_conf]
-                reference = "*"  # this is marked as a reference conformer for boundary correction
-            if pw_conf in pw_multi:
-                non0 = True
-                multi = pw_multi[pw_conf]
-            if non0 and (abs(single) >= PW_CUTOFF or abs(multi) >= PW_CUTOFF):
-                line = "%s %8.3f %8.3f %s\n" % (pw_conf, single, multi, reference)
-                raw_lines.append(line)
-
-        # Part 3: backbone interaction total
-        bkb_total = 0.0
-        bkb_breakdown_lines = ["\n[BACKBONE breakdown, kcal/mol]\n"]
-        for pw_conf in bkb_list:
-            non0 = False
-            bkb_pw = 0.0
-            if pw_conf in pw_single:
-                non0 = True
-                bkb_pw = pw_single[pw_conf]
-                # if resid != (pw_conf[:3] + pw_conf[5:11]):    # exclude the backbone piece when calculating the total
-                #     bkb_total += bkb_pw
-                bkb_total += bkb_pw  # do inclusive calculation for now
-
-            if non0 and abs(bkb_pw) >= PW_CUTOFF:
-                line = "%s %8.3f\n" % (pw_conf, bkb_pw)
-                bkb_breakdown_lines.append(line)
-
-        line = "\n[BACKBONE total including self, kcal/mol] %8.3f\n" % bkb_total
-        raw_lines.append(line)
-
-        # Part 4: backbone interaction breakdown
-        line = "\n[BACKBONE breakdown]\n"
-        raw_lines += bkb_breakdown_lines
-
-        # Part 5: rxn
-        line = "\n[RXN, kcal/mol] %8.3f" % rxn
-        raw_lines.append(line)
-
-        open(fname, "w").writelines(raw_lines)
+            single = pw_single.get(k2, 0.0)
+            multi = pw_multi.get(k2, 0.0)
+            reference = k2 in pw_single  # this is marked as a reference conformer for boundary correction
+            if (reference or k2 in pw_multi) and (abs(single) >= PW_CUTOFF or abs(multi) >= PW_CUTOFF):
+                pw.append((k2, as_printed(single), as_printed(multi), reference))
 
-    return (ir, ic)
+        raw_writer().append(conf.k, np.array(pw, dtype=RAW_PW), np.array(bkb, dtype=RAW_BKB), as_printed(bkb_total),
+                            as_printed(rxn))
+
+    return
+
+
+class RawWriter:
+    """Append-only shard of raw electrostatic records, one per process.
+
+    The shard starts with the confIDs of the structure, and records refer to conformers by their index in this table.
+    A record is a RAW_RECORD header, its RAW_PW and RAW_BKB arrays and an end marker, appended in one write and synced
+    to disk, so a record cut off by a killed job is recognized and ignored by RawTable.
+    """
+    def __init__(self, protein, folder):
+        self.pid = os.getpid()
+        os.makedirs(folder, exist_ok=True)
+        self.fname = "%s/raw_%s_%d_%d.bin" % (folder, os.uname().nodename, self.pid, time.time_ns())
+        confids = np.array([conf.confID for conf in protein.store.confs], dtype="S")
+        self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.write(RAW_MAGIC + np.array([len(confids), confids.itemsize], dtype="<i4").tobytes() + confids.tobytes())
+        return
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            data = data[os.write(self.fd, data):]
+        os.fsync(self.fd)
+        return
+
+    def append(self, k, pw=np.zeros(0, dtype=RAW_PW), bkb=np.zeros(0, dtype=RAW_BKB), bkb_total=0.0, rxn=0.0,
+               all_0=False):
+        header = np.array((k, all_0, len(pw), len(bkb), bkb_total, rxn), dtype=RAW_RECORD)
+        self.write(header.tobytes() + pw.tobytes() + bkb.tobytes() + np.uint32(RAW_RECORD_END).tobytes())
+        return
+
+
+raw_shard = None   # RawWriter of this process, see raw_writer()
+
+
+def raw_writer():
+    """RawWriter of this process, a worker opens its own shard at its first record."""
+    global raw_shard
+    if raw_shard is None or raw_shard.pid != os.getpid():
+        raw_shard = RawWriter(protein, energy_folder)
+    return raw_shard
+
+
+def read_raw_shard(fname):
+    """Read complete records from a binary raw shard. Return the shard's confIDs and a list of
+    (RAW_RECORD, RAW_PW array, RAW_BKB array) in the order they were written."""
+    data = open(fname, "rb").read()
+    records = []
+    if data[:len(RAW_MAGIC)] != RAW_MAGIC or len(data) < len(RAW_MAGIC) + 8:
+        return [], records
+    n_conf, width = np.frombuffer(data, dtype="<i4", count=2, offset=len(RAW_MAGIC))
+    offset = len(RAW_MAGIC) + 8 + n_conf * width
+    if len(data) < offset:
+        return [], records
+    confids = np.frombuffer(data, dtype="S%d" % width, count=n_conf, offset=len(RAW_MAGIC) + 8).astype(str)
+    while offset + RAW_RECORD.itemsize <= len(data):
+        header = np.frombuffer(data, dtype=RAW_RECORD, count=1, offset=offset)[0]
+        pw_offset = offset + RAW_RECORD.itemsize
+        bkb_offset = pw_offset + header["n_pw"] * RAW_PW.itemsize
+        end = bkb_offset + header["n_bkb"] * RAW_BKB.itemsize
+        if end + 4 > len(data) or np.frombuffer(data, dtype="<u4", count=1, offset=end)[0] != RAW_RECORD_END:
+            break  # cut off record
+        records.append((header, np.frombuffer(data, dtype=RAW_PW, count=header["n_pw"], offset=pw_offset),
+                        np.frombuffer(data, dtype=RAW_BKB, count=header["n_bkb"], offset=bkb_offset)))
+        offset = end + 4
+    return confids, records
+
+
+def read_raw_text(fname, k_byid):
+    """Read a complete raw text file from an earlier version of step 3. Return (RAW_RECORD, RAW_PW, RAW_BKB) of it,
+    the conformer indices are those of k_byid."""
+    text = open(fname).read()
+    header = np.zeros((), dtype=RAW_RECORD)
+    pw = []
+    bkb = []
+    if not text:
+        header["all_0"] = 1
+    section = ""
+    for line in text.split("\n"):
+        if line.startswith("["):
+            section = line
+            fields = line.split("]")
+            if line.startswith("[BACKBONE total"):
+                header["bkb_total"] = float(fields[-1])
+            elif line.startswith("[RXN"):
+                header["rxn"] = float(fields[-1])
+            continue
+        fields = line.split()
+        if section.startswith("[PAIRWISE") and len(fields) >= 3 and fields[0] in k_byid:
+            pw.append((k_byid[fields[0]], float(fields[1]), float(fields[2]), len(fields) > 3 and "*" in fields[3]))
+        elif section.startswith("[BACKBONE breakdown") and len(fields) == 2 and fields[0] in k_byid:
+            bkb.append((k_byid[fields[0]], float(fields[1])))
+    header["n_pw"] = len(pw)
+    header["n_bkb"] = len(bkb)
+    return header, np.array(pw, dtype=RAW_PW), np.array(bkb, dtype=RAW_BKB)
+
+
+class RawTable:
+    """Raw electrostatic results of the structure, merged from the binary raw shards of a folder.
+
+    Arrays are by packed conformer index k: done, all_0, bkb_total and rxn, and pw_* and bkb_* in CSR layout, where
+    pw_conf[pw_indptr[k]:pw_indptr[k + 1]] are the conformers with a pairwise interaction to conformer k. Values have
+    the 3 decimals of a raw text file. A later record of a conformer replaces an earlier one. A conformer without a
+    record takes a complete raw text file from an earlier version of step 3 if there is one.
+    """
+    def __init__(self, protein, folder=energy_folder):
+        confs = protein.store.confs
+        n = len(confs)
+        k_byid = {}
+        for k in range(n):
+            k_byid[confs[k].confID] = k
+
+        # the latest record of each conformer, with conformer indices mapped from the shard table to this structure
+        latest = {}
+        self.shards = []
+        if os.path.isdir(folder):
+            self.shards = [folder + "/" + x for x in os.listdir(folder) if x.startswith("raw_") and x.endswith(".bin")]
+        for fname in sorted(self.shards, key=lambda x: (os.path.getmtime(x), x)):
+            confids, records = read_raw_shard(fname)
+            new_k = np.array([k_byid.get(confid, -1) for confid in confids], dtype=int)
+            for header, pw, bkb in records:
+                k = new_k[header["k"]]
+                if k >= 0:
+                    latest[k] = (header, pw[new_k[pw["k"]] >= 0], bkb[new_k[bkb["k"]] >= 0], new_k)
+        for k in range(n):
+            if k not in latest and confs[k].confID[3:5] != "BK":
+                fname = "%s/%s.raw" % (folder, confs[k].confID)
+                if raw_text_complete(fname, is_all_0(confs[k])):
+                    header, pw, bkb = read_raw_text(fname, k_byid)
+                    latest[k] = (header, pw, bkb, np.arange(n))
+
+        self.done = np.zeros(n, dtype=bool)
+        self.all_0 = np.zeros(n, dtype=bool)
+        self.bkb_total = np.zeros(n)
+        self.rxn = np.zeros(n)
+        self.pw_indptr = np.zeros(n + 1, dtype=int)
+        self.bkb_indptr = np.zeros(n + 1, dtype=int)
+        pws = [np.zeros(0, dtype=RAW_PW)]
+        bkbs = [np.zeros(0, dtype=RAW_BKB)]
+        for k in sorted(latest):
+            header, pw, bkb, new_k = latest[k]
+            self.done[k] = True
+            self.all_0[k] = header["all_0"]
+            self.bkb_total[k] = header["bkb_total"]
+            self.rxn[k] = header["rxn"]
+            self.pw_indptr[k + 1] = len(pw)
+            self.bkb_indptr[k + 1] = len(bkb)
+            pw = pw.copy()
+            pw["k"] = new_k[pw["k"]]
+            bkb = bkb.copy()
+            bkb["k"] = new_k[bkb["k"]]
+            pws.append(pw)
+            bkbs.append(bkb)
+        self.pw_indptr = np.cumsum(self.pw_indptr)
+        self.bkb_indptr = np.cumsum(self.bkb_indptr)
+        pw = np.concatenate(pws)
+        bkb = np.concatenate(bkbs)
+
+        # float32 values back to the float64 of their 3 decimals
+        self.pw_conf = pw["k"].astype(int)
+        self.pw_single = np.round(pw["single"].astype(float), 3)
+        self.pw_multi = np.round(pw["multi"].astype(float), 3)
+        self.pw_ref = pw["ref"].astype(bool)
+        self.bkb_conf = bkb["k"].astype(int)
+        self.bkb_pw = np.round(bkb["pw"].astype(float), 3)
+        self.bkb_total = np.round(self.bkb_total, 3)
+        self.rxn = np.round(self.rxn, 3)
+        return
+
+    def compact(self, protein, folder=energy_folder):
+        """Write the records of this table to one new shard and delete the shards it was read from, which it
+        supersedes. Records of conformers no longer in the structure are dropped."""
+        shard = RawWriter(protein, folder)
+        for k in np.where(self.done)[0]:
+            pw = np.zeros(self.pw_indptr[k + 1] - self.pw_indptr[k], dtype=RAW_PW)
+            pw["k"] = self.pw_conf[self.pw_indptr[k]:self.pw_indptr[k + 1]]
+            pw["single"] = self.pw_single[self.pw_indptr[k]:self.pw_indptr[k + 1]]
+            pw["multi"] = self.pw_multi[self.pw_indptr[k]:self.pw_indptr[k + 1]]
+            pw["ref"] = self.pw_ref[self.pw_indptr[k]:self.pw_indptr[k + 1]]
+            bkb = np.zeros(self.bkb_indptr[k + 1] - self.bkb_indptr[k], dtype=RAW_BKB)
+            bkb["k"] = self.bkb_conf[self.bkb_indptr[k]:self.bkb_indptr[k + 1]]
+            bkb["pw"] = self.bkb_pw[self.bkb_indptr[k]:self.bkb_indptr[k + 1]]
+            shard.append(k, pw, bkb, self.bkb_total[k], self.rxn[k], all_0=self.all_0[k])
+        os.close(shard.fd)
+        for fname in self.shards:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        self.shards = [shard.fname]
+        return
+
+    def export(self, protein, method, folder=energy_folder):
+        """Write the raw text file of each calculated conformer."""
+        confs = protein.store.confs
+        for k in np.where(self.done)[0]:
+            raw_lines = []
+            if not self.all_0[k]:
+                raw_lines.append("[Method] %s\n" % method)
+                raw_lines.append("\n[PAIRWISE confID single multi flag, kcal/mol]\n")
+                for j in range(self.pw_indptr[k], self.pw_indptr[k + 1]):
+                    reference = "*" if self.pw_ref[j] else ""
+                    raw_lines.append("%s %8.3f %8.3f %s\n" % (confs[self.pw_conf[j]].confID, self.pw_single[j],
+                                                             self.pw_multi[j], reference))
+                raw_lines.append("\n[BACKBONE total including self, kcal/mol] %8.3f\n" % self.bkb_total[k])
+                raw_lines.append("\n[BACKBONE breakdown, kcal/mol]\n")
+                for j in range(self.bkb_indptr[k], self.bkb_indptr[k + 1]):
+                    raw_lines.append("%s %8.3f\n" % (confs[self.bkb_conf[j]].confID, self.bkb_pw[j]))
+                raw_lines.append("\n%s %8.3f" % (RAW_END, self.rxn[k]))
+            write_atomic("%s/%s.raw" % (folder, confs[k].confID), raw_lines)
+        return
+
+
+def write_atomic(fname, lines):
+    """Write lines to a temporary file and rename it to fname, so fname is either absent or complete."""
+    tmp_fname = "%s%s%d" % (fname, RAW_TMP, os.getpid())
+    with open(tmp_fname, "w") as fh:
+        fh.writelines(lines)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_fname, fname)
+    return
+
+
+def raw_text_complete(fname, all_0):
+    """A raw file is complete if it ends with the RXN record, or is empty for a conformer without charge."""
+    if not os.path.isfile(fname):
+        return False
+    if all_0:
+        return os.path.getsize(fname) == 0
+    lines = open(fname).read().split("\n")
+    return lines[-1].startswith(RAW_END) and len(lines[-1].split()) == 3
+
+
+def resume_work_load(work_load, raw):
+    """Drop conformers with a complete raw record from work_load, and temporary files left by an interrupted run."""
+    if os.path.isdir(energy_folder):
+        for fname in os.listdir(energy_folder):
+            if RAW_TMP in fname:
+                os.remove("%s/%s" % (energy_folder, fname))
+    todo = [(ir, ic) for ir, ic in work_load if not raw.done[protein.residue[ir].conf[ic].k]]
+    logging.info("Resume: %d conformers reused, %d conformers to calculate" % (len(work_load) - len(todo), len(todo)))
+    return todo
+
+
+def clash_margin(store, use_r_bound=True):
+    """Blob margin beyond which two conformers can not clash in is_conf_clash()."""
+    if use_r_bound:
+        return float(store.r_bound.max())
+    else:
+        return 2 * float(store.r_vdw.max())
+
+
+def is_all_0(conf):
+    """Conformer has no charged atom, so pbe() skips the PB solver."""
+    return not (np.abs(protein.store.charge[conf.atom_start:conf.atom_end]) > 0.001).any()
+
+
+def estimate_cost(ir, ic):
+    """Relative cost of pbe() on a conformer: the number of focusing runs times a base cost plus the conformer size.
+    A conformer without charge costs nothing."""
+    conf = protein.residue[ir].conf[ic]
+    if is_all_0(conf):
+        return 0.0
+    bound = def_boundary(ir, ic)
+    depth = PBS_DELPHI().depth(bound)   # delphi runs this many times on both boundary conditions
+    return 2 * depth * (1.0 + (conf.atom_end - conf.atom_start) / 100.0)
+
+
+def schedule(work_load, costs, processes):
+    """Split work_load into chunks, longest tasks first.
+    Expensive tasks go alone, cheap tasks are packed up to a chunk cost that keeps several chunks per process."""
+    order = sorted(range(len(work_load)), key=lambda n: -costs[n])
+    chunk_cost = max(sum(costs) / (processes * 8), 1.0)
+    chunks = []
+    chunk = []
+    cost = 0.0
+    for n in order:
+        chunk.append(work_load[n])
+        cost += costs[n]
+        if cost >= chunk_cost or len(chunk) >= 50:
+            chunks.append(chunk)
+            chunk = []
+            cost = 0.0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def pbe_chunk(chunk):
+    """Run pbe() on a chunk of (ir, ic). Return the (ir, ic, start time, seconds, worker name) of each task."""
+    timing = []
+    for iric in chunk:
+        start = time.time()
+        pbe(iric)
+        timing.append((iric[0], iric[1], start, time.time() - start, current_process().name))
+    return timing
+
+
+class Progress:
+    """Progress line of PB tasks with throughput and an ETA by estimated cost."""
+    def __init__(self, costs):
+        self.n_total = len(costs)
+        self.cost_total = sum(costs)
+        self.n_done = 0
+        self.cost_done = 0.0
+        self.start = time.time()
+        self.reported = self.start
+        return
+
+    def update(self, n, cost):
+        self.n_done += n
+        self.cost_done += cost
+        now = time.time()
+        if now - self.reported >= PROGRESS_INTERVAL or self.n_done == self.n_total:
+            self.reported = now
+            logging.info(self.line(now))
+        return
+
+    def line(self, now):
+        elapsed = now - self.start
+        if self.cost_done > 0 and self.cost_total > self.cost_done:
+            eta = "%.0f s" % (elapsed * (self.cost_total - self.cost_done) / self.cost_done)
+        elif self.n_done == self.n_total:
+            eta = "0 s"
+        else:
+            eta = "unknown"
+        return "PB progress: %d/%d conformers, %.2f conformers/s, elapsed %.0f s, ETA %s" % \
+               (self.n_done, self.n_total, self.n_done / max(elapsed, 0.001), elapsed, eta)
 
 
 def is_conf_clash(conf1, conf2, use_r_bound=True):
@@ -470,6 +970,12 @@ def is_conf_clash(conf1, conf2, use_r_bound=True):
         otherwise use r_vdw, Van der Waals radius
     """
     clash = False
+    store = conf1.store
+    if store is not None and store is conf2.store:
+        # no clash if the conformer blobs are farther apart than the largest clash distance
+        if not store.blob_index.near(conf1.k, conf2.k, clash_margin(store, use_r_bound)):
+            return clash
+
     for atom1 in conf1.atom:
         if clash:
             break
@@ -491,106 +997,84 @@ def is_conf_clash(conf1, conf2, use_r_bound=True):
     return clash
 
 
-def postprocess_ele():
-    conf_list, _ = get_conflist(protein)
-    ele_matrix = {}
-    ele_k_s2m_byresid = {}
+def conf_clashes(pairs, use_r_bound=True):
+    """Batch version of is_conf_clash() on an array of (k1, k2) packed conformer index pairs. Return a bool array.
+    Atoms of the k2 conformers are binned in a cell list, and each k1 conformer tests all its atoms at once against the
+    atoms in clash distance of its blob."""
+    store = protein.store
+    clash = np.zeros(len(pairs), dtype=bool)
+    if len(pairs) == 0:
+        return clash
+    if use_r_bound:
+        r = store.r_bound * 0.5  # artificially allow less strict clash detection to match old mcce
+    else:
+        r = store.r_vdw
+    margin = clash_margin(store, use_r_bound)
+    xyz = store.xyz
+
+    k2s = np.unique(pairs[:, 1])
+    atoms2 = np.concatenate([np.arange(store.conf_start[k], store.conf_end[k]) for k in k2s])
+    grid = CellList(xyz[atoms2], float(store.conf_radius.max()) + margin)
+
+    order = np.argsort(pairs[:, 0], kind="stable")
+    k1s, starts = np.unique(pairs[order, 0], return_index=True)
+    for k1, group in zip(k1s, np.split(order, starts[1:])):
+        atoms1 = np.arange(store.conf_start[k1], store.conf_end[k1])
+        near = atoms2[grid.query(store.conf_center[k1], store.conf_radius[k1] + margin)]
+        if len(atoms1) == 0 or len(near) == 0:
+            continue
+        dx = xyz[atoms1, 0][:, None] - xyz[near, 0][None, :]
+        dy = xyz[atoms1, 1][:, None] - xyz[near, 1][None, :]
+        dz = xyz[atoms1, 2][:, None] - xyz[near, 2][None, :]
+        hit = (dx * dx + dy * dy + dz * dz < (r[atoms1][:, None] + r[near][None, :]) ** 2).any(axis=0)
+        clash[group] = np.isin(pairs[group, 1], store.atom_conf[near[hit]])
 
-    # load raw
-    for conf in conf_list:
-        fname = "%s/%s.raw" % (energy_folder, conf)
-        if os.path.isfile(fname):
-            lines = open(fname).readlines()
-            pw_start = False
-            resid1 = conf[:3] + conf[5:11]
+    return clash
 
-            for line in lines:
-                if line[:9] == "[PAIRWISE":
-                    pw_start = True
-                    continue
-                elif line[:9] == "[BACKBONE":
-                    break
-                if pw_start:
-                    fields = line.split()
-                    if len(fields) >= 3:
-                        conf2 = fields[0]
-                        single = float(fields[1])
-                        multi = float(fields[2])
-                        if len(fields) > 3:
-                            mark = fields[3]
-                        else:
-                            mark = ""
-                        ele_pw = ElePW()
-                        ele_pw.multi = multi
-                        ele_pw.single = single
-                        ele_pw.mark = mark
-                        ele_matrix[(conf, conf2)] = ele_pw
-
-                        if "*" in mark:
-                            resid2 = conf2[:3] + conf2[5:11]
-                            if abs(multi) > 0.1:
-                                k_single_multi = single / multi
-                            else:
-                                k_single_multi = 1.0
-                            if k_single_multi > 1.0:
-                                k_single_multi = 1.0
-                            ele_k_s2m_byresid[(resid1, resid2)] = k_single_multi
 
-    # scale multi by the k factor, or use single for reference point
-    for conf_pair, ele_pw in ele_matrix.items():
-        conf1, conf2 = conf_pair
-        resid1 = conf1[:3] + conf1[5:11]
-        resid2 = conf2[:3] + conf2[5:11]
-        key = (resid1, resid2)
-        if key in ele_k_s2m_byresid:
-            k = ele_k_s2m_byresid[(resid1, resid2)]
-        else:
-            k = 1.0
-        if "*" in ele_pw.mark:
-            ele_pw.scaled = ele_pw.single  # use the reference directly
-        else:
-            ele_pw.scaled = k * ele_pw.multi
+def postprocess_ele(raw):
+    store = protein.store
+    ele = EleMatrix(raw)
+
+    # conformers of a residue share a resid number, charged conformers are "C" type and the others "D" type
+    resids = {}
+    conf_resid = np.array([resids.setdefault(conf.confID[:3] + conf.confID[5:11], len(resids)) for conf in store.confs],
+                          dtype=int)
+    charged = np.array([conf.confID[3] in "+-" for conf in store.confs], dtype=bool)
+    resid_pair = conf_resid[ele.conf1] * len(resids) + conf_resid[ele.conf2]
 
-    # for conf_pair, ele_pw in ele_matrix.items():
-    #     print("%s: %8.3f %8.3f %8.3f %s" % (conf_pair, ele_pw.scaled, ele_pw.single, ele_pw.multi, ele_pw.mark))
+    # single to multi ratio of the reference conformer by resid pair, the last conformer of res1 with a reference to
+    # res2 sets the ratio for res1 to res2
+    ref = np.where(ele.mark & ELE_REF)[0]
+    k_single_multi = np.ones(len(ref))
+    big = np.abs(ele.multi[ref]) > 0.1
+    k_single_multi[big] = ele.single[ref[big]] / ele.multi[ref[big]]
+    k_single_multi[k_single_multi > 1.0] = 1.0
+    ref_pairs, last = np.unique(resid_pair[ref][::-1], return_index=True)
+    ref_k = k_single_multi[::-1][last]
+
+    # scale multi by the k factor, or use single for reference point
+    k = np.ones(len(resid_pair))
+    if len(ref_pairs) > 0:
+        pos = np.minimum(np.searchsorted(ref_pairs, resid_pair), len(ref_pairs) - 1)
+        found = ref_pairs[pos] == resid_pair
+        k[found] = ref_k[pos[found]]
+    ele.scaled = np.where(ele.mark & ELE_REF, ele.single, k * ele.multi)
 
     # Find clashing dielectric boundary. This is because the single conformation boundary is composed by the selected
     # conformer + the native conformer of other residues. This selected conformer may have geometry conflict with the
     # native conformers. If a clash is identified, a question mark will be added to the ele_pw mark.
     logging.debug("Detecting conformer to conformer clashes ...")
-    for res1 in protein.residue:
-        if len(res1.conf) > 1:  # skip dummy or backbone only residue
-            for conf1 in res1.conf[1:]:
-                conf1_id = conf1.confID
-                for res2 in protein.residue:
-                    if res2 == res1:
-                        continue
-                    # find the reference conformer to res2
-                    conf2_ref = None
-                    if len(res2.conf) > 1:  # skip dummy or backbone only residue
-                        for conf2 in res2.conf[1:]:
-                            conf2_id = conf2.confID
-                            key = (conf1_id, conf2_id)
-                            if key in ele_matrix:
-                                ele_pw = ele_matrix[key]
-                                if "*" in ele_pw.mark:
-                                    conf2_ref = conf2
-                                    break
-
-                    # detect the clash between conf1 and conf2_ref
-                    clash = False
-                    if conf2_ref:
-                        clash = is_conf_clash(conf1, conf2_ref)
-
-                    # mark res2 conformers with "?"
-                    if clash:
-                        # print(conf1.confID, conf2_ref.confID)
-                        for conf2 in res2.conf[1:]:
-                            conf2_id = conf2.confID
-                            key = (conf1_id, conf2_id)
-                            if key in ele_matrix:
-                                ele_pw = ele_matrix[key]
-                                ele_pw.mark = "?" + ele_pw.mark
+    n_res = len(protein.residue)
+    entry_res_pair = ele.conf1 * n_res + store.conf_ires[ele.conf2]   # conf1 and the residue of conf2
+    # the reference conformer of res2 to conf1 is the first conformer of res2 with a "*" mark
+    res_pairs, first = np.unique(entry_res_pair[ref], return_index=True)
+    ref_entries = ref[first]
+    other_res = store.conf_ires[ele.conf1[ref_entries]] != store.conf_ires[ele.conf2[ref_entries]]
+    ref_entries = ref_entries[other_res]
+    clash = conf_clashes(np.column_stack((ele.conf1[ref_entries], ele.conf2[ref_entries])))
+    # mark res2 conformers with "?"
+    ele.mark[np.isin(entry_res_pair, res_pairs[other_res][clash])] |= ELE_CLASH
 
     # ele correction and average
     # The correction starts with ele_pw.scaled, and follow the following rules to make correction
@@ -598,115 +1082,119 @@ def postprocess_ele():
     # C-C: Charged to charged normal case: average scaled pws
     # D-D: dipole to dipole, reduce by a factor of 2.0
     # C-D: charged to dipole,
-    for conf_pair, ele_pw in ele_matrix.items():
-        if conf_pair[0][3] == "+" or conf_pair[0][3] == "-":
-            conf1_type = "C"
-        else:
-            conf1_type = "D"
-        if conf_pair[1][3] == "+" or conf_pair[1][3] == "-":
-            conf2_type = "C"
-        else:
-            conf2_type = "D"
-        reversed_key = (conf_pair[1], conf_pair[0])
-        if reversed_key in ele_matrix:
-            reversed_ele_pw = ele_matrix[reversed_key]
-        else:
-            reversed_ele_pw = ElePW()
-        if conf1_type == "C" and conf2_type == "C":
-            # abnormal case, opposite sign when scaled, or both directions have ? mark, scaled down by factor 1.5 from
-            # the smaller of the two multi
-            if ele_pw.scaled * ele_pw.multi < 0 or \
-                    reversed_ele_pw.scaled * reversed_ele_pw.multi < 0 or \
-                    ("?" in ele_pw.mark and "?" in reversed_ele_pw.mark):
-                if abs(ele_pw.multi) < abs(reversed_ele_pw.multi):
-                    ele_pw.averaged = ele_pw.multi / 1.5
-                    reversed_ele_pw.averaged = ele_pw.multi / 1.5
-                else:
-                    ele_pw.averaged = reversed_ele_pw.multi / 1.5
-                    reversed_ele_pw.averaged = reversed_ele_pw.multi / 1.5
-                # debug
-                # print("%s -> %s    |    %s -> %s" % (conf_pair[0], conf_pair[1], reversed_key[0], reversed_key[1]))
-                # print("Multi:        %8.3f              |          %8.3f" % (ele_matrix[conf_pair].multi, ele_matrix[reversed_key].multi))
-                # print("Single:       %8.3f              |          %8.3f" % (ele_matrix[conf_pair].single, ele_matrix[reversed_key].single))
-                # print("Scaled:       %8.3f              |          %8.3f" % (ele_matrix[conf_pair].scaled, ele_matrix[reversed_key].scaled))
-                # print("Averaged:     %8.3f              |          %8.3f" % (ele_matrix[conf_pair].averaged, ele_matrix[reversed_key].averaged))
-                # print(vars(ele_pw))
-                # print(vars(reversed_ele_pw))
-            elif "?" in ele_pw.mark and "?" not in reversed_ele_pw.mark:
-                ele_pw.averaged = reversed_ele_pw.scaled
-                reversed_ele_pw.averaged = reversed_ele_pw.scaled
-            elif "?" not in ele_pw.mark and "?" in reversed_ele_pw.mark:
-                ele_pw.averaged = ele_pw.scaled
-                reversed_ele_pw.averaged = ele_pw.scaled
-            else:
-                if abs(ele_pw.scaled) < abs(reversed_ele_pw.scaled):
-                    ele_pw.averaged = reversed_ele_pw.averaged = ele_pw.scaled
-                else:
-                    ele_pw.averaged = reversed_ele_pw.averaged = reversed_ele_pw.scaled
-        elif conf1_type == "D" and conf2_type == "D":
-            ele_pw.averaged = reversed_ele_pw.averaged = (ele_pw.scaled + reversed_ele_pw.scaled)/2.0  # Originally averaging multi
-        else:  # must be "D" to "C"
-            if ele_pw.scaled * ele_pw.multi < 0 or \
-                    reversed_ele_pw.scaled * reversed_ele_pw.multi < 0 or \
-                    ("?" in ele_pw.mark and "?" in reversed_ele_pw.mark):
-                ele_pw.averaged = reversed_ele_pw.averaged = (ele_pw.multi+reversed_ele_pw.multi)/2.0/1.5
-            elif "?" in ele_pw.mark and "?" not in reversed_ele_pw.mark:
-                ele_pw.averaged = reversed_ele_pw.averaged = reversed_ele_pw.scaled
-            elif "?" not in ele_pw.mark and "?" in reversed_ele_pw.mark:
-                ele_pw.averaged = reversed_ele_pw.averaged = ele_pw.scaled
-            else:
-                ele_pw.averaged = reversed_ele_pw.averaged = (ele_pw.scaled + reversed_ele_pw.scaled) / 2.0
-
-    return ele_matrix
-
-
-def compose_opp(protein, ele_matrix):
+    # Each rule is evaluated from both directions of a pair, a pair without the reversed entry takes 0 and no mark for
+    # the reversed values.
+    reverse = ele.reverse()
+    has_reverse = reverse >= 0
+    multi = ele.multi
+    scaled = ele.scaled
+    clash = (ele.mark & ELE_CLASH) > 0
+    reversed_multi = np.where(has_reverse, multi[reverse], 0.0)
+    reversed_scaled = np.where(has_reverse, scaled[reverse], 0.0)
+    reversed_clash = has_reverse & clash[reverse]
+    cc = charged[ele.conf1] & charged[ele.conf2]
+    dd = ~charged[ele.conf1] & ~charged[ele.conf2]
+    # abnormal case, opposite sign when scaled, or both directions have ? mark
+    abnormal = (scaled * multi < 0) | (reversed_scaled * reversed_multi < 0) | (clash & reversed_clash)
+    clash_only = clash & ~reversed_clash
+    reversed_clash_only = ~clash & reversed_clash
+
+    averaged = (scaled + reversed_scaled) / 2.0     # D-D and normal C-D
+    averaged = np.where(cc, np.where(np.abs(scaled) < np.abs(reversed_scaled), scaled, reversed_scaled), averaged)
+    averaged = np.where(clash_only, reversed_scaled, averaged)
+    averaged = np.where(reversed_clash_only, scaled, averaged)
+    # C-C abnormal case, scaled down by factor 1.5 from the smaller of the two multi
+    averaged = np.where(cc & abnormal, np.where(np.abs(multi) < np.abs(reversed_multi), multi, reversed_multi) / 1.5,
+                        averaged)
+    averaged = np.where(~cc & abnormal, (multi + reversed_multi) / 2.0 / 1.5, averaged)
+    averaged = np.where(dd, (scaled + reversed_scaled) / 2.0, averaged)
+
+    # both entries of a pair take the value of the entry in the higher row, as both are set when either is corrected
+    ele.averaged = np.where(has_reverse & (ele.conf1 < ele.conf2), averaged[reverse], averaged)
+
+    return ele
+
+
+def write_opp_files(files):
+    """Format and write opp files, each given as (fname, confIDs, i2, average, vdw, scaled, multi, mark) arrays."""
+    for fname, confids, i2, average, vdw, scaled, multi, mark in files:
+        lines = ["%05d %s %8.3f %7.3f %7.3f %7.3f %s\n" % (i2[j], confids[j], average[j], vdw[j], scaled[j], multi[j],
+                                                          ELE_MARKS[mark[j]]) for j in range(len(i2))]
+        open(fname, "w").writelines(lines)
+    return len(files)
+
+
+def compose_opp(protein, ele, raw, processes=1):
+    """Write the opp file of each conformer with a raw record. The ele and vdw matrices are merged on conformer pairs
+    in vdw index, and the pairs of different residues above PW_CUTOFF are selected in bulk."""
     epath = "energies"
-    for res1 in protein.residue:
-        for conf1 in res1.conf[1:]:
-            fname = "%s/%s.raw" % (epath, conf1.confID)
-            if os.path.isfile(fname):  # only create opp files when a raw file exists
-                fname = "%s/%s.opp" % (epath, conf1.confID)
-                lines = []
-                for res2 in protein.residue:
-                    if res2 != res1:
-                        for conf2 in res2.conf[1:]:
-                            conf_pair = (conf1.confID, conf2.confID)
-                            i1 = conf1.i
-                            i2 = conf2.i
-                            if conf_pair in ele_matrix:
-                                average = ele_matrix[conf_pair].averaged
-                                scaled = ele_matrix[conf_pair].scaled
-                                multi = ele_matrix[conf_pair].multi
-                                mark = ele_matrix[conf_pair].mark
-                            else:
-                                average = scaled = multi = 0.0
-                                mark = ""
-                            if abs(protein.vdw_pw[i1, i2]) > PW_CUTOFF or abs(average) > PW_CUTOFF:
-                                lines.append("%05d %s %8.3f %7.3f %7.3f %7.3f %s\n" % (conf2.i, conf2.confID, average, protein.vdw_pw[i1, i2], scaled, multi, mark))
-                open(fname, "w").writelines(lines)
+    store = protein.store
+    n = protein.vdw_pw.shape[0]
+    i_of_k = np.full(len(store.confs), -1)
+    k_of_i = np.zeros(n, dtype=int)
+    for res in protein.residue:
+        for conf in res.conf[1:]:
+            i_of_k[conf.k] = conf.i
+            k_of_i[conf.i] = conf.k
+    confid_of_i = np.array([store.confs[k].confID for k in k_of_i])
+    ires_of_i = store.conf_ires[k_of_i]
+
+    # all pairs with an ele or a vdw entry, sorted by (i1, i2)
+    ele_key = i_of_k[ele.conf1] * n + i_of_k[ele.conf2]
+    vdw = protein.vdw_pw.tocoo()
+    vdw_key = vdw.row.astype(int) * n + vdw.col
+    vdw_order = np.argsort(vdw_key, kind="stable")
+    vdw_key = vdw_key[vdw_order]
+    key = np.union1d(ele_key, vdw_key)
+    i1 = key // n
+    i2 = key % n
+
+    average = np.zeros(len(key))
+    scaled = np.zeros(len(key))
+    multi = np.zeros(len(key))
+    mark = np.zeros(len(key), dtype=np.uint8)
+    pos = np.searchsorted(key, ele_key)
+    average[pos] = ele.averaged
+    scaled[pos] = ele.scaled
+    multi[pos] = ele.multi
+    mark[pos] = ele.mark
+    vdw_value = np.zeros(len(key))
+    # duplicates are summed like vdw_pw.toarray() does
+    np.add.at(vdw_value, np.searchsorted(key, vdw_key), vdw.data[vdw_order])
+
+    selected = (ires_of_i[i1] != ires_of_i[i2]) & ((np.abs(vdw_value) > PW_CUTOFF) | (np.abs(average) > PW_CUTOFF))
+    # only create opp files when a raw record exists
+    done_i = np.where(raw.done[k_of_i])[0]
+    selected &= np.isin(i1, done_i)
+    indptr = np.searchsorted(i1[selected], np.arange(n + 1))
+    columns = (i2[selected], average[selected], vdw_value[selected], scaled[selected], multi[selected], mark[selected])
+
+    files = []
+    for i in done_i:
+        row = slice(indptr[i], indptr[i + 1])
+        files.append(("%s/%s.opp" % (epath, confid_of_i[i]), confid_of_i[columns[0][row]]) +
+                     tuple(column[row] for column in columns))
+
+    if processes > 1 and len(files) > 1:
+        n_shards = min(len(files), processes * 4)
+        with Pool(processes) as pool:
+            pool.map(write_opp_files, [files[j::n_shards] for j in range(n_shards)])
+    else:
+        write_opp_files(files)
 
     return
 
 
-def compose_head3(protein):
-    epath = "energies"
+def compose_head3(protein, raw):
     head3lines = ["iConf CONFORMER     FL  occ    crg   Em0  pKa0 ne nH    vdw0    vdw1    tors    epol   dsolv   extra    history\n"]
-    # read backbone ele interaction epol
+    # backbone ele interaction epol, conformers without charge have no record
     epol_all = {}
     rxn_all = {}
     for res in protein.residue:
         for conf in res.conf[1:]:
-            fname = "%s/%s.raw" % (epath, conf.confID)
-            if os.path.isfile(fname):
-                lines = open(fname).readlines()
-                for line in lines:
-                    if line.startswith("[BACKBONE total"):
-                        fields = line.split("]")
-                        epol_all[conf.confID] = float(fields[-1])
-                    elif line.startswith("[RXN"):
-                        fields = line.split("]")
-                        rxn_all[conf.confID] = float(fields[-1])
+            if raw.done[conf.k] and not raw.all_0[conf.k]:
+                epol_all[conf.confID] = float(raw.bkb_total[conf.k])
+                rxn_all[conf.confID] = float(raw.rxn[conf.k])
 
     # natom dictonary to determine dummy conformers
     natom_byconftype = {}
@@ -783,8 +1271,7 @@ def compose_head3(protein):
             else:
                 extra = 0.0
 
-            fname = "%s/%s.raw" % (epath, conf.confID)
-            if os.path.isfile(fname):  # only create opp files when a raw file exists
+            if conf.mark != "d" and raw.done[conf.k]:  # only create opp files when a raw record exists
                 mark = "t"
             else:
                 mark = "f"
@@ -806,10 +1293,13 @@ if __name__ == "__main__":
                         type=int)
     parser.add_argument("-d", metavar="epsilon", default="4.0", help="protein dielectric constant, default to 4.0")
     parser.add_argument("-s", metavar="pbs_name", default="delphi",
-                        help="PSE solver. Choices are delphi. default to \"delphi\"")
+                        help="PSE solver. Choices are delphi, fd, gb and coulomb. default to \"delphi\"")
     parser.add_argument("-t", metavar="tmp folder", default="/tmp", help="PB solver temporary folder, default to /tmp")
     parser.add_argument("-p", metavar="processes", default=1, help="run step 3 with number of processes, default to 1",
                         type=int)
+    parser.add_argument("-a", metavar="solvers", default=0, type=int,
+                        help="run delphi asynchronously in one process with up to this number of delphi processes at "
+                             "a time, default to 0 (off)")
     parser.add_argument("-ftpl", metavar="ftpl folder", default="",
                         help="ftpl folder, default to \"param/\" of mcce exeuctable location")
     parser.add_argument("-salt", metavar="salt concentration", default=0.15,
@@ -820,6 +1310,14 @@ if __name__ == "__main__":
                         help="recreate *.opp and head3.lst from step2_out.pdb and *.oppl files", action="store_true")
     parser.add_argument("--debug", default=False, help="print debug information and keep pb solver tmp",
                         action="store_true")
+    parser.add_argument("--incremental", default=False,
+                        help="only recalculate conformers whose atoms or surroundings changed since the last run",
+                        action="store_true")
+    parser.add_argument("--resume", default=False,
+                        help="only calculate conformers without a complete raw record from an interrupted run",
+                        action="store_true")
+    parser.add_argument("--raw", default=False, help="also export raw electrostatic results as energies/*.raw files",
+                        action="store_true")
     parser.add_argument("-l", metavar="file", default="", help="load above options from a file")
     args = parser.parse_args()
 
@@ -856,63 +1354,121 @@ if __name__ == "__main__":
     # make conformer list with their corresponding ir and ic. This list or (ir, ic) will be passed as an array 
     # that multiprocess module will take in as work load.
     work_load = []
+    out_of_range = []
     counter = 1
     for ir in range(len(protein.residue)):
         if len(protein.residue[ir].conf) > 1:  # skip dummy or backbone only residue
             for ic in range(1, len(protein.residue[ir].conf)):
                 if run_options.end >= counter >= run_options.start:
                     work_load.append((ir, ic))
+                else:
+                    out_of_range.append(protein.residue[ir].conf[ic].confID)
                 counter += 1
+    hashes = conformer_hashes(protein, run_options)
+    if run_options.incremental or run_options.resume:
+        raw = RawTable(protein)
+    if run_options.incremental:
+        # skip conformers with unchanged hashes and an existing raw record
+        if conformers_recharged(hashes):
+            logging.info("Conformers or charges changed since the last run, all conformers are recalculated")
+            changed = set(hashes)
+        else:
+            changed = changed_conformers(hashes)
+        work_load = [(ir, ic) for ir, ic in work_load
+                     if protein.residue[ir].conf[ic].confID in changed or not raw.done[protein.residue[ir].conf[ic].k]]
+        logging.info("Incremental run, %d conformers changed" % len(work_load))
+    if run_options.resume:
+        work_load = resume_work_load(work_load, raw)
     logging.debug("work_load as (ir ic) list [%s]" % ','.join(map(str, work_load)))
 
     # Set up parallel envrionment and run PB solver
     max_pool = run_options.p
-    logging.info("Running PBE solver in %d threads" % max_pool)
-    with Pool(max_pool) as process:
-        work_out = process.imap(pbe, work_load)
-        logging.debug("Done PDE solving on %s" % str(list(work_out)))
-
-    cwd = os.getcwd()
-    pbe_folder = run_options.t + "/pbe_" + cwd.strip("/").replace("/", ".")
+    # the static part of the dielectric boundary is composed once and shared with the workers
+    static_boundary = StaticBoundary(protein)
+
+    # dispatch the most expensive conformers first, and log each task's time as it is done
+    costs = [estimate_cost(ir, ic) for ir, ic in work_load]
+    progress = Progress(costs)
+    cost_of = dict(zip(work_load, costs))
+    if run_options.a > 0 and run_options.s.upper() == "DELPHI":
+        logging.info("Running delphi asynchronously with %d solver processes" % run_options.a)
+        with open(TIMING_LOG, "w") as timing_log:
+            timing_log.write("%-15s %8s %10s %10s %s\n" % ("confID", "cost", "start", "seconds", "worker"))
+            latency = run_pbe_async(work_load, costs, run_options.a, progress, timing_log)
+        with open(SOLVER_LOG, "w") as solver_log:
+            solver_log.write("%-15s %8s %4s %10s\n" % ("confID", "boundary", "run", "seconds"))
+            for confid, bnd, run, seconds in latency:
+                solver_log.write("%-15s %8s %4d %10.3f\n" % (confid, bnd, run, seconds))
+        if latency:
+            seconds = np.array([x[3] for x in latency])
+            logging.info("%d delphi calls, latency mean %.2f s, median %.2f s, 95%% %.2f s, max %.2f s" %
+                         (len(seconds), seconds.mean(), np.median(seconds), np.percentile(seconds, 95), seconds.max()))
+    else:
+        logging.info("Running PBE solver in %d threads" % max_pool)
+        shm, layout = static_boundary.share()
+        try:
+            with Pool(max_pool, initializer=boundary_worker_init, initargs=(shm.name, layout)) as process, \
+                    open(TIMING_LOG, "w") as timing_log:
+                timing_log.write("%-15s %8s %10s %10s %s\n" % ("confID", "cost", "start", "seconds", "worker"))
+                for timing in process.imap_unordered(pbe_chunk, schedule(work_load, costs, max_pool)):
+                    for ir, ic, start, seconds, worker in timing:
+                        timing_log.write("%-15s %8.2f %10.2f %10.3f %s\n" % (protein.residue[ir].conf[ic].confID,
+                                                                             cost_of[(ir, ic)],
+                                                                             start - progress.start, seconds, worker))
+                    timing_log.flush()
+                    progress.update(len(timing), sum([cost_of[(x[0], x[1])] for x in timing]))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    pbe_folder = pbe_tmp()
     if not run_options.debug and os.path.exists(pbe_folder):
         shutil.rmtree(pbe_folder)
 
     # Post-process electrostatic potential
+    raw = RawTable(protein)
+    if raw.done[[conf.k for res in protein.residue for conf in res.conf[1:]]].all() and len(raw.shards) > 1:
+        logging.info("Compacting %d raw shards ..." % len(raw.shards))
+        raw.compact(protein)
+    if run_options.raw:
+        logging.info("Exporting raw files ...")
+        raw.export(protein, run_options.s)
     logging.info("Processing ele pairwise interaction...")
-    ele_matrix = postprocess_ele()
+    ele = postprocess_ele(raw)
     logging.info("Processing ele pairwise interaction...Done")
 
-    # Debug
-    # for conf_pair, ele_pw in ele_matrix.items():
-    #     reversed_key = (conf_pair[1], conf_pair[0])
-    #     ele_pw = ele_matrix[conf_pair]
-    #     if reversed_key in ele_matrix:
-    #         reversed_ele_pw = ele_matrix[reversed_key]
-    #     else:
-    #         reversed_ele_pw = ElePW()
-    #
-    #     if abs(ele_pw.multi) < 0.1:
-    #         continue
-    #     print("%s -> %s    |    %s -> %s" % (conf_pair[0], conf_pair[1], reversed_key[0], reversed_key[1]))
-    #     print("Multi:        %8.3f              |          %8.3f" % (ele_pw.multi, reversed_ele_pw.multi))
-    #     print("Single:       %8.3f              |          %8.3f" % (ele_pw.single, reversed_ele_pw.single))
-    #     print("Scaled:       %8.3f              |          %8.3f" % (ele_pw.scaled, reversed_ele_pw.scaled))
-    #     print("Averaged:     %8.3f              |          %8.3f" % (ele_pw.averaged, reversed_ele_pw.averaged))
-    #     print("Mark:         %8s              |          %8s" % (ele_pw.mark, reversed_ele_pw.mark))
-
-    # Compute vdw, not doing parallelization at this moment
+    # Compute vdw, conformers are shared by the same number of processes as PB solver
     logging.info("Making atom connectivity ...")
     protein.make_connect12()
     protein.make_connect13()
     protein.make_connect14()
 
-    logging.info("Calculating vdw ...")
-    protein.calc_vdw()
+    logging.info("Calculating vdw in %d processes ..." % max_pool)
+    if run_options.incremental:
+        incremental_vdw(protein, changed_conformers(hashes, vdw=True), processes=max_pool)
+    else:
+        protein.calc_vdw(processes=max_pool)
+    if run_options.debug:
+        protein.vdw_reciprocity_check()
     # For efficiency reason, the vdw pairwise table is a matrix protein.vdw_pw[conf1.i, conf2.i]
 
     # Assemble output files
     logging.info("Composing opp files ...")
-    compose_opp(protein, ele_matrix)
+    compose_opp(protein, ele, raw, processes=max_pool)
+    save_vdw_cache(protein)   # before compose_head3() adds dummy conformers
 
     logging.info("Composing head3.lst ...")
-    compose_head3(protein)
+    compose_head3(protein, raw)
+
+    # Record this run for --incremental, conformers out of -c range keep the record of their last calculation
+    if os.path.isfile(MANIFEST):
+        manifest = json.load(open(MANIFEST))["conformers"]
+        for confid in out_of_range:
+            if confid in manifest:
+                hashes[confid] = manifest[confid]
+            else:
+                del hashes[confid]
+    else:
+        for confid in out_of_range:
+            del hashes[confid]
+    save_manifest(hashes)
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import tempfile
 from pathlib import Path
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+import numpy as np
 import ms_analysis as msa
 
 
@@ -50,6 +53,80 @@ def test_alt_head3_path(h3_path):
             assert n_new > 0
 
 
+def test_msbin_roundtrip(ms_file):
+    """A text ms_out file converted by msout2bin.py and opened by memory mapping has the header and the unique
+    microstates, in order of first appearance, that read_msout() streams from the text file."""
+
+    records = msa.read_msout(ms_file)
+    header = next(records)
+    iconf2ires = {iconf: ires for ires, res in enumerate(header["free_residues"]) for iconf in res}
+    state = [0] * len(header["free_residues"])
+    unique = {}
+    for state_delta, E, count in records:
+        for ic in state_delta:
+            state[iconf2ires[ic]] = ic
+        if E is not None:
+            unique.setdefault(tuple(state), [E, 0])[1] += count
+
+    with tempfile.TemporaryDirectory() as folder:
+        bin_file = os.path.join(folder, "ms.bin")
+        msa.convert_msout(ms_file, bin_file)
+        msout = msa.MSout(bin_file)
+        print(f"{msout.N_uniq} unique microstates in {bin_file}, {len(unique)} from read_msout")
+        assert isinstance(msout.store.E, np.memmap)
+        assert (msout.T, msout.pH, msout.Eh) == (header["T"], header["pH"], header["Eh"])
+        assert msout.fixed_iconfs == header["fixed_iconfs"] and msout.free_residues == header["free_residues"]
+        assert msout.N_ms == sum(count for E, count in unique.values())
+        assert [tuple(row) for row in msout.store.states.tolist()] == list(unique)
+        assert msout.store.E.tolist() == [E for E, count in unique.values()]
+        assert msout.store.count.tolist() == [count for E, count in unique.values()]
+        assert msout.lowest_E == min(E for E, count in unique.values())
+        assert msout.highest_E == max(E for E, count in unique.values())
+        del msout
+
+
+def test_sampling(ms_file, size=200, seed=0):
+    """sample_ms_indices() picks the microstates that the former get_sampled_ms() scan of Microstate objects,
+    np.where((sampled_cumsum - c) > 0)[0][0], picks for the same sampled counts."""
+
+    msout = msa.MSout(ms_file)
+    ms_list = list(msout.microstates.values())
+
+    def scan(ms_list, sampled_ms_indices):
+        sampled_cumsum = np.cumsum([mc.count for mc in ms_list])
+        return [ms_list[np.where((sampled_cumsum - c) > 0)[0][0]] for c in sampled_ms_indices]
+
+    def same(rows, ms_sampled):
+        return [(ms.state, ms.E, ms.count) for ms in ms_sampled] == \
+            [(ms.state, ms.E, ms.count) for ms in (msout.store.microstate(i) for i in rows.tolist())]
+
+    counts = msa.ms_counts(ms_list)
+    deterministic = np.arange(size, counts - size, counts / size, dtype=int)
+    random = np.random.default_rng(seed=seed).integers(low=0, high=counts, size=size, endpoint=True)
+    rng = np.random.default_rng(seed=seed)
+    stratified = ((np.arange(size) + rng.random(size)) * (counts / size)).astype(np.int64)
+    for kind, sampled_ms_indices in (("deterministic", deterministic), ("random", random),
+                                     ("stratified", stratified)):
+        rows = msout.sample_ms_indices(size, kind, seed)
+        # the scan raised IndexError on the endpoint draw of 'random', which now picks the last microstate
+        valid = sampled_ms_indices < counts
+        print(f"{kind}: {len(rows)} samples, {valid.sum()} compared with the scan")
+        assert len(rows) == len(sampled_ms_indices)
+        assert same(rows[valid], scan(ms_list, sampled_ms_indices[valid]))
+        assert (rows[~valid] == len(ms_list) - 1).all()
+        assert [[i, ms.state] for i, ms in msout.get_sampled_ms(size, kind, seed)] == \
+            [[i, msout.store.microstate(i).state] for i in rows.tolist()]
+
+    low, high = msout.lowest_E, msout.average_E
+    in_range = [ms for ms in ms_list if low <= ms.E < high]
+    counts = msa.ms_counts(in_range)
+    random = np.random.default_rng(seed=seed).integers(low=0, high=counts, size=size, endpoint=True)
+    rows = msout.sample_ms_indices(size, "random", seed, E_range=(low, high))
+    valid = random < counts
+    print(f"E_range: {len(rows)} samples of {len(in_range)} microstates")
+    assert same(rows[valid], scan(in_range, random[valid]))
+
+
 def cli_parser():
 
     def resolved_path(p: str):
@@ -69,6 +146,20 @@ def cli_parser():
         ms_analysis.py (using default head3 path) vs that created when an alternate
         path to head3.lst is provided at the command line.""",
     )
+    p.add_argument(
+        "-test_msbin",
+        metavar="ms_file",
+        default=None,
+        help="""Test that a text microstate file converted to the binary format reads back
+        the microstates of read_msout.""",
+    )
+    p.add_argument(
+        "-test_sampling",
+        metavar="ms_file",
+        default=None,
+        help="""Test that each kind of MSout.sample_ms_indices picks the microstates
+        of the former linear scan of get_sampled_ms.""",
+    )
 
     return p
 
@@ -79,10 +170,18 @@ def main(argv=None):
     cli_parse = cli_parser()
     args = cli_parse.parse_args(argv)
 
-    if args.test_alt_head3_path is None or argv is None:
+    if (args.test_alt_head3_path is None and args.test_msbin is None and args.test_sampling is None) \
+            or argv is None:
         cli_parse.print_help()
         return
-    
+
+    if args.test_msbin is not None:
+        test_msbin_roundtrip(args.test_msbin)
+    if args.test_sampling is not None:
+        test_sampling(args.test_sampling)
+    if args.test_alt_head3_path is None:
+        return
+
     h3 = Path(args.test_alt_head3_path)
     print(f"Resolved cli path: {h3}\npwd: {Path.cwd()}")
 
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Checks of step3.py features on a structure. Run in a folder with run.prm and step2_out.pdb, such as the output folder
+of step 2. The checks work in temporary folders and use the fast in-process coulomb solver, step3.py -s coulomb.
+    test_step3.py -incremental
+The binary raw shard checks run on synthetic records anywhere:
+    test_step3.py -raw
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import numpy as np
+
+STEP3 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "step3.py")
+sys.path.insert(0, os.path.dirname(STEP3))
+
+
+def run_step3(folder, options):
+    result = subprocess.run([sys.executable, STEP3, "-s", "coulomb"] + options, cwd=folder, capture_output=True,
+                            text=True)
+    assert result.returncode == 0, "step3.py failed in %s:\n%s" % (folder, result.stderr[-2000:])
+
+
+def add_conformer(pdb_lines, shift=0.5):
+    """Copy the last side chain conformer of the first residue with one as a new conformer, shifted by shift in x."""
+    sidechain = [line for line in pdb_lines if line[:6] in ("ATOM  ", "HETATM") and line[27:30] != "000"]
+    resid = sidechain[0][17:26]
+    confs = [line[17:30] for line in sidechain if line[17:26] == resid]
+    last = max(i for i, line in enumerate(pdb_lines) if line[17:30] == confs[-1])
+    new_confid = "%s%03d" % (resid + "_", int(confs[-1][-3:]) + 1)
+    new_lines = [line[:17] + new_confid + "%8.3f" % (float(line[30:38]) + shift) + line[38:]
+                 for line in pdb_lines if line[17:30] == confs[-1]]
+    return pdb_lines[:last + 1] + new_lines + pdb_lines[last + 1:], new_confid
+
+
+def vdw_cache(folder):
+    """vdw0, vdw1 and pairwise vdw of a vdw cache by confID."""
+    cached = np.load(os.path.join(folder, "step3_vdw.npz"))
+    confids = [str(x) for x in cached["confid"]]
+    terms = {}
+    for n, confid in enumerate(confids):
+        terms[confid] = (round(float(cached["vdw0"][n]), 6), round(float(cached["vdw1"][n]), 6))
+    for row, col, value in zip(cached["conf_rows"], cached["conf_cols"], cached["values"]):
+        terms[(confids[row], confids[col])] = round(float(value), 6)
+    return terms
+
+
+def same_output(folder1, folder2):
+    """Names of head3.lst and opp files that are different in two step 3 folders."""
+    different = []
+    names = ["head3.lst"] + ["energies/" + x for x in sorted(os.listdir(os.path.join(folder1, "energies")))
+                             if x.endswith(".opp")]
+    for name in names:
+        fname1 = os.path.join(folder1, name)
+        fname2 = os.path.join(folder2, name)
+        if not os.path.isfile(fname2) or open(fname1).read() != open(fname2).read():
+            different.append(name)
+    return different
+
+
+def test_incremental_parity(folder):
+    """An incremental run after a conformer is added has the same opp files, head3.lst and vdw as a full run."""
+    work = tempfile.mkdtemp()
+    try:
+        incremental = os.path.join(work, "incremental")
+        full = os.path.join(work, "full")
+        for target in (incremental, full):
+            os.makedirs(target)
+            shutil.copy(os.path.join(folder, "run.prm"), target)
+        shutil.copy(os.path.join(folder, "step2_out.pdb"), incremental)
+        run_step3(incremental, ["--incremental"])
+
+        pdb_lines, new_confid = add_conformer(open(os.path.join(folder, "step2_out.pdb")).readlines())
+        for target in (incremental, full):
+            open(os.path.join(target, "step2_out.pdb"), "w").writelines(pdb_lines)
+        run_step3(incremental, ["--incremental"])
+        run_step3(full, [])
+
+        different = same_output(full, incremental)
+        print("Added %s, %d different output files" % (new_confid, len(different)))
+        assert not different, "incremental and full runs differ: %s" % " ".join(different[:10])
+        assert vdw_cache(full) == vdw_cache(incremental), "incremental and full vdw differ"
+        shards = [x for x in os.listdir(os.path.join(incremental, "energies")) if x.startswith("raw_")]
+        assert len(shards) == 1, "%d raw shards left after the incremental runs" % len(shards)
+    finally:
+        shutil.rmtree(work)
+
+
+def random_records(rng, n_conf, ks):
+    """Raw records of conformers ks with values of 3 decimals, as step 3 writes them."""
+    from step3 import RAW_PW, RAW_BKB
+    records = {}
+    for k in ks:
+        pw = np.zeros(rng.integers(0, 5), dtype=RAW_PW)
+        pw["k"] = rng.choice(n_conf, len(pw), replace=False)
+        pw["single"] = np.round(rng.normal(size=len(pw)), 3)
+        pw["multi"] = np.round(rng.normal(size=len(pw)), 3)
+        pw["ref"] = rng.integers(0, 2, len(pw))
+        bkb = np.zeros(rng.integers(0, 3), dtype=RAW_BKB)
+        bkb["k"] = rng.choice(n_conf, len(bkb), replace=False)
+        bkb["pw"] = np.round(rng.normal(size=len(bkb)), 3)
+        records[k] = (pw, bkb, round(float(rng.normal()), 3), round(float(rng.normal()), 3), bool(rng.integers(0, 2)))
+    return records
+
+
+def same_table(raw, records):
+    """RawTable raw has the values of records."""
+    for k, (pw, bkb, bkb_total, rxn, all_0) in records.items():
+        pw_range = slice(raw.pw_indptr[k], raw.pw_indptr[k + 1])
+        bkb_range = slice(raw.bkb_indptr[k], raw.bkb_indptr[k + 1])
+        if not (raw.done[k] and raw.all_0[k] == all_0 and raw.bkb_total[k] == bkb_total and raw.rxn[k] == rxn and
+                (raw.pw_conf[pw_range] == pw["k"]).all() and
+                (raw.pw_single[pw_range] == np.round(pw["single"].astype(float), 3)).all() and
+                (raw.pw_multi[pw_range] == np.round(pw["multi"].astype(float), 3)).all() and
+                (raw.pw_ref[pw_range] == pw["ref"].astype(bool)).all() and
+                (raw.bkb_conf[bkb_range] == bkb["k"]).all() and
+                (raw.bkb_pw[bkb_range] == np.round(bkb["pw"].astype(float), 3)).all()):
+            return False
+    return len(records) == raw.done.sum()
+
+
+def test_raw_roundtrip():
+    """Records written by RawWriter read back in RawTable, the latest record of a conformer wins, a cut off record is
+    ignored, and compact() leaves one shard with the same table."""
+    from step3 import RawWriter, RawTable
+    rng = np.random.default_rng(0)
+    confids = ["LYSBK0001_000", "LYS+1A0001_001", "LYS01A0001_002", "GLUBK0007_000", "GLU-1A0007_001",
+               "GLU01A0007_002", "GLU01A0007_003"]
+    protein = SimpleNamespace(store=SimpleNamespace(confs=[SimpleNamespace(confID=x) for x in confids]))
+    folder = tempfile.mkdtemp()
+    try:
+        records = random_records(rng, len(confids), range(len(confids)))
+        shard = RawWriter(protein, folder)
+        for k, (pw, bkb, bkb_total, rxn, all_0) in records.items():
+            shard.append(k, pw, bkb, bkb_total, rxn, all_0=all_0)
+        updates = random_records(rng, len(confids), [1, 4])
+        shard = RawWriter(protein, folder)
+        for k, (pw, bkb, bkb_total, rxn, all_0) in updates.items():
+            shard.append(k, pw, bkb, bkb_total, rxn, all_0=all_0)
+        shard.write(np.zeros(3, dtype="<i4").tobytes())   # a record cut off by a killed job
+        records.update(updates)
+
+        raw = RawTable(protein, folder)
+        print("%d records in %d shards" % (raw.done.sum(), len(raw.shards)))
+        assert same_table(raw, records), "RawTable differs from the records written"
+        raw.compact(protein, folder)
+        assert len(os.listdir(folder)) == 1, "compact() left %d shards" % len(os.listdir(folder))
+        assert same_table(RawTable(protein, folder), records), "RawTable differs after compact()"
+    finally:
+        shutil.rmtree(folder)
+
+
+def cli_parser():
+    p = ArgumentParser(
+        prog="test_step3",
+        description="Check features of bin/step3.py on the structure in the current folder.",
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    p.add_argument("-incremental", action="store_true",
+                   help="an incremental run after adding a conformer gives the output of a full run")
+    p.add_argument("-raw", action="store_true", help="binary raw shards read back as written, and compact")
+    return p
+
+
+def main(argv=None):
+    """Command line interface to check features of bin/step3.py."""
+
+    cli_parse = cli_parser()
+    args = cli_parse.parse_args(argv)
+    if not (args.incremental or args.raw):
+        cli_parse.print_help()
+        return
+
+    if args.incremental:
+        test_incremental_parity(os.getcwd())
+    if args.raw:
+        test_raw_roundtrip()
+    print("Passed")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
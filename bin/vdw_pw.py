@@ -66,12 +66,11 @@ def update_opp(protein, verbose=False):
                 # positive_interaction = np.max(protein.vdw_pw[conf.i])
                 # negative_interaction = np.min(protein.vdw_pw[conf.i])
                 row = protein.vdw_pw[conf.i].data
-                positive_interaction = max(row[0])
-                negative_interaction = min(row[0])
-                if abs(positive_interaction) > 0.01 or abs(negative_interaction) > 0.01:
+                if len(row) > 0 and np.abs(row).max() > 0.01:
                     write_opp = True
 
             if write_opp:   # write new opp files
+                vdw_row = protein.vdw_pw[conf.i].toarray()[0]
                 if verbose:
                     print("   opp - %s ..." % conf.confID)
 
@@ -88,7 +87,7 @@ def update_opp(protein, verbose=False):
                         #     new_pw = protein.vdw_pw[pw_key]
                         # else:
                         #     new_pw = 0.0
-                        new_pw = protein.vdw_pw[conf.i, conf2.i]
+                        new_pw = vdw_row[conf2.i]
 
                         newline = ""
                         iconf = iconf_dict[conf2.confID]